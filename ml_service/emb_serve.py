@@ -1,6 +1,12 @@
+import asyncio
+import json
 import os
+import time
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 from ray.serve import Application
 from fastapi import FastAPI
 from fastembed import TextEmbedding
@@ -11,14 +17,66 @@ from utils.base import load_env
 from utils.loggers import Logger, load_loggers
 from utils.parsers import DictObjectParser, YamlParser
 from utils.exception import ConfigFileMissingError
-from typing import Dict, List
+from ml.emb import codec
+from ml.emb.admission import AdmissionController, AdmissionTicket
+from ml.emb.batching import (
+    DynamicBatcher,
+    length_sorted_order,
+    restore_order,
+)
+from ml.emb.cache import EmbeddingCache
+from ml.emb.registry import ModelRegistry
+from ml.emb.quantize import QUANTIZATION_TYPES, quantize, truncate
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, Deque, Dict, List, Optional, Tuple
 from fastapi.exceptions import RequestValidationError
-from utils.http import create_error_response
+from utils.http import (
+    CleanupStreamingResponse,
+    create_error_response,
+    request_deadline,
+    time_left,
+)
 from http import HTTPStatus
 
+try:
+    from fastembed import SparseTextEmbedding
+
+    SPARSE_EMBEDDING = True
+except ImportError:
+    SPARSE_EMBEDDING = False
+
 # FastAPI app
 APP = FastAPI()
 
+EMBED_TYPES = ["PASSAGE_EMBED", "QUERY_EMBED", "PLAIN_EMBED"]
+
+# interactive query embeds get their own executor lane, so they never
+# queue behind bulk ingestion traffic
+EMBED_LANES = {
+    "QUERY_EMBED": "query",
+    "PASSAGE_EMBED": "passage",
+    "PLAIN_EMBED": "passage",
+}
+
+
+@dataclass
+class SubBatches:
+    """Sub-batches of a streamed request, `pending` ones are not queued yet,
+    `queued` ones are submitted to the batcher in stream order"""
+
+    pending: Deque[Tuple[int, List[str]]]
+    queued: Deque[Tuple[int, asyncio.Task]] = field(default_factory=deque)
+
+    @classmethod
+    def split(cls, texts: List[str], batch_size: int) -> "SubBatches":
+        return cls(
+            pending=deque(
+                (start, texts[start : start + batch_size])
+                for start in range(0, len(texts), batch_size)
+            )
+        )
+
 
 @APP.exception_handler(RequestValidationError)
 async def validation_exception_handler(
@@ -44,34 +102,535 @@ class EMBDeployment:
         """
         self.logger = logger
         self.logger.info("EMB Deployment Initialized")
-        self.model = TextEmbedding(**config.serve_config.to_dict())
+
+        # named models are loaded on their first request, a deployment
+        # with only a `serve_config` serves that single model
+        if hasattr(config, "models"):
+            models = config.models.to_dict()
+            default_model = config.default_model
+        else:
+            default_model = config.serve_config.model_name
+            models = {default_model: {"serve_config": config.serve_config.to_dict()}}
+        loaders = {"dense": TextEmbedding}
+        if SPARSE_EMBEDDING:
+            loaders["sparse"] = SparseTextEmbedding
+        for name, model_config in list(models.items()):
+            if model_config.get("kind", "dense") not in loaders:
+                self.logger.warning(f"Model {name} needs a newer fastembed, skipped")
+                del models[name]
+
+        registry = config.registry.to_dict() if hasattr(config, "registry") else {}
+        self.registry = ModelRegistry(
+            models=models,
+            default_model=default_model,
+            loaders=loaders,
+            logger=self.logger,
+            idle_ttl=registry.get("idle_ttl"),
+            max_memory_mb=registry.get("max_memory_mb"),
+        )
+        for name in registry.get("preload", [default_model]):
+            self.registry.load_sync(name)
+
+        self.cache: Optional[EmbeddingCache] = None
+        if hasattr(config, "cache"):
+            self.cache = EmbeddingCache(**config.cache.to_dict(), logger=self.logger)
+
+        self.admission: Optional[AdmissionController] = None
+        if hasattr(config, "admission"):
+            self.admission = AdmissionController(**config.admission.to_dict())
+
+        # requests which can not be embedded before their deadline are
+        # refused, queued sub-batches are dropped once it passed
+        deadline = config.deadline.to_dict() if hasattr(config, "deadline") else {}
+        self.min_time_left: float = deadline.get("min_time_left", 0.05)
+        self.deadline_exceeded: Dict[str, int] = {"refused": 0, "expired": 0}
+
+        # onnxruntime releases the GIL, so inference runs on thread pools
+        # instead of blocking the replica's event loop
+        executor = config.executor.to_dict() if hasattr(config, "executor") else {}
+        self.lane_workers: Dict[str, int] = {
+            "query": executor.get("query_workers", 1),
+            "passage": executor.get("passage_workers", 1),
+        }
+        self.executors: Dict[str, ThreadPoolExecutor] = {
+            lane: ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix=f"emb-{lane}"
+            )
+            for lane, workers in self.lane_workers.items()
+        }
+
+        batching = config.batching.to_dict() if hasattr(config, "batching") else {}
+        self.batching = batching
+        self.bucket_size: int = batching.get("bucket_size", 16)
+        self.stream_batch_size: int = batching.get("stream_batch_size", 16)
+        self.stream_prefetch: int = batching.get("stream_prefetch", 2)
+        self.batchers: Dict[Tuple[str, str], DynamicBatcher] = {}
+
+        # replica only reports ready once the models are warm
+        self.ready = False
+        self.warm_up_timings: Dict[str, float] = {}
+        self._warm_up(config.warm_up.to_dict() if hasattr(config, "warm_up") else {})
+
+    def __del__(self) -> None:
+        # ray serve calls it when the replica shuts down, the disk tier of
+        # the cache is only flushed periodically
+        if getattr(self, "cache", None) is not None:
+            self.cache.close()
+
+    def _warm_up(self, warm_up: Dict) -> None:
+        """Run representative inputs through every loaded model on every
+        executor thread, so the onnx sessions are warm before Ray routes
+        traffic to the replica"""
+        if not warm_up.get("enabled", True):
+            self.ready = True
+            return
+
+        queries = warm_up.get("queries") or ["What is a binary search tree?"]
+        passages = warm_up.get("passages") or [" ".join(["warm up"] * 256)]
+        start = time.perf_counter()
+        try:
+            for name, entry in list(self.registry.loaded.items()):
+                for req_type in EMBED_TYPES:
+                    texts = queries if req_type == "QUERY_EMBED" else passages
+                    lane = EMBED_LANES[req_type]
+                    lane_start = time.perf_counter()
+                    futures = [
+                        self.executors[lane].submit(
+                            self._embed_sync, entry.model, req_type, texts
+                        )
+                        for _ in range(self.lane_workers[lane])
+                    ]
+                    for future in futures:
+                        future.result()
+                    self.warm_up_timings[f"{name}/{req_type}"] = round(
+                        time.perf_counter() - lane_start, 3
+                    )
+            self.ready = True
+        except Exception:
+            self.logger.error("Warm-up failed, replica is not ready", exc_info=True)
+
+        self.logger.info(
+            f"Warm-up finished in {time.perf_counter() - start:.2f}s: "
+            f"{self.warm_up_timings}"
+        )
+
+    def _batcher(self, model: str, req_type: str) -> DynamicBatcher:
+        """one batcher per model and embedding type, so that only requests
+        which need the same model call are merged together"""
+        key = (model, req_type)
+        if key not in self.batchers:
+            self.batchers[key] = DynamicBatcher(
+                handler=partial(self._embed, model, req_type),
+                max_batch_size=self.batching.get("max_batch_size", 64),
+                max_wait_time=self.batching.get("max_wait_time", 0.01),
+                max_concurrent_batches=self.lane_workers[EMBED_LANES[req_type]],
+            )
+        return self.batchers[key]
+
+    def _token_lengths(self, model: TextEmbedding, texts: List[str]) -> List[int]:
+        """Tokenized length of the texts, falls back to the character
+        length if the model does not expose its tokenizer"""
+        tokenizer = getattr(getattr(model, "model", None), "tokenizer", None)
+        if tokenizer is None:
+            return [len(text) for text in texts]
+        # the tokenizer pads to the longest text, so count the attention mask
+        return [sum(enc.attention_mask) for enc in tokenizer.encode_batch(texts)]
+
+    def _embed_sync(
+        self, model: TextEmbedding, req_type: str, texts: List[str]
+    ) -> List[np.ndarray]:
+        """Run the fastembed model on a merged batch of texts
+
+        fastembed pads every text of a batch to the longest one, so the texts
+        are sorted by length and run in buckets of `bucket_size` before the
+        original order is restored
+        """
+        order = length_sorted_order(self._token_lengths(model, texts))
+        sorted_texts = [texts[i] for i in order]
+
+        if req_type == "PASSAGE_EMBED":
+            embed = model.passage_embed
+        elif req_type == "QUERY_EMBED":
+            embed = model.query_embed
+        else:
+            embed = model.embed
+
+        embedding = list(embed(sorted_texts, batch_size=self.bucket_size))
+        return restore_order(embedding, order)
+
+    async def _embed(
+        self, model: str, req_type: str, texts: List[str]
+    ) -> List[np.ndarray]:
+        """Run the inference on the executor lane of the embedding type"""
+        loop = asyncio.get_running_loop()
+        lane = EMBED_LANES[req_type]
+        async with self.registry.use(model) as instance:
+            start = time.perf_counter()
+            embedding = await loop.run_in_executor(
+                self.executors[lane],
+                self._embed_sync,
+                instance,
+                req_type,
+                texts,
+            )
+        if self.admission is not None:
+            self.admission.observe(
+                lane, len(texts), time.perf_counter() - start, self.lane_workers[lane]
+            )
+        return embedding
+
+    async def _cached_embed(
+        self,
+        model: str,
+        req_type: str,
+        texts: List[str],
+        ticket: Optional[AdmissionTicket] = None,
+    ) -> List[np.ndarray]:
+        """Serve the texts from the cache, only the (deduplicated) misses
+        are submitted to the model. Sparse embeddings are not cached.
+        Admitted texts are released right away for the hits and by the
+        batcher for the submitted texts"""
+        if self.cache is None or self.registry.kind(model) == "sparse":
+            return await self._batcher(model, req_type).submit(
+                texts, on_done=ticket.hand_over(len(texts)) if ticket else None
+            )
+
+        model_name = self.registry.model_name(model)
+        keys = [EmbeddingCache.key(model_name, req_type, text) for text in texts]
+        embedding: List[Optional[np.ndarray]] = await self.cache.get_many(keys)
+
+        missing: Dict[str, str] = {
+            key: text
+            for key, text, vector in zip(keys, texts, embedding)
+            if vector is None
+        }
+        if ticket is not None:
+            ticket.release(len(texts) - len(missing))
+        if missing:
+            computed = await self._batcher(model, req_type).submit(
+                list(missing.values()),
+                on_done=ticket.hand_over(len(missing)) if ticket else None,
+            )
+            self.cache.put_many(list(missing.keys()), computed)
+            computed = dict(zip(missing.keys(), computed))
+            embedding = [
+                computed[key] if vector is None else vector
+                for key, vector in zip(keys, embedding)
+            ]
+
+        return embedding
 
     @APP.get("/health")
     async def health(self) -> Response:
         """Health check endpoint."""
         return Response(status_code=200)
 
+    @APP.get("/ready")
+    async def readiness(self) -> JSONResponse:
+        """Readiness endpoint, succeeds only after the warm-up."""
+        return JSONResponse(
+            status_code=200 if self.ready else 503,
+            content={"ready": self.ready, "warm_up": self.warm_up_timings},
+        )
+
+    @APP.get("/stats")
+    async def stats(self) -> JSONResponse:
+        """Cache, admission and deadline statistics endpoint."""
+        return JSONResponse(
+            content={
+                "cache": self.cache.stats() if self.cache else None,
+                "admission": self.admission.stats() if self.admission else None,
+                "deadline_exceeded": self.deadline_exceeded,
+            }
+        )
+
+    def _validate_output_options(self, data: Dict) -> None:
+        for field in ["dimensions", "stream_batch_size"]:
+            value = data.get(field)
+            if value is not None and (not isinstance(value, int) or value <= 0):
+                detail = f"Invalid {field}. It should be a positive integer"
+                raise RequestValidationError(
+                    [{"loc": ("query", field), "msg": detail, "type": "value_error"}]
+                )
+
+        quantization = data.get("quantization")
+        if quantization is not None and quantization not in QUANTIZATION_TYPES:
+            detail = "Invalid quantization. Valid types are: int8, uint8, binary"
+            raise RequestValidationError(
+                [
+                    {
+                        "loc": ("query", "quantization"),
+                        "msg": detail,
+                        "type": "value_error",
+                    }
+                ]
+            )
+
+    def _shape_output(
+        self, embedding: List[np.ndarray], data: Dict
+    ) -> Tuple[np.ndarray, Optional[str], int]:
+        """Apply the requested truncation and quantization
+
+        Returns
+        -------
+        Tuple[np.ndarray, Optional[str], int]
+            output matrix, its dtype (None if the float vectors are returned
+            unchanged) and the dim of the vectors, binary vectors hold it
+            packed into ceil(dim / 8) bytes
+        """
+        matrix = codec.to_matrix(embedding)
+        if data.get("dimensions") is not None:
+            matrix = truncate(matrix, data["dimensions"])
+
+        quantization = data.get("quantization")
+        return quantize(matrix, quantization), quantization, matrix.shape[1]
+
+    def _to_json(self, model: str, embedding: List[np.ndarray], data: Dict) -> List:
+        if self.registry.kind(model) == "sparse":
+            return [
+                {"indices": x.indices.tolist(), "values": x.values.tolist()}
+                for x in embedding
+            ]
+        if data.get("dimensions") is not None or data.get("quantization") is not None:
+            matrix, _, _ = self._shape_output(embedding, data)
+            return matrix.tolist()
+        return [x.tolist() for x in embedding]
+
+    def _queue_sub_batch(
+        self,
+        model: str,
+        req_type: str,
+        texts: List[str],
+        ticket: Optional[AdmissionTicket],
+    ) -> asyncio.Task:
+        return asyncio.ensure_future(
+            self._cached_embed(model, req_type, texts, ticket)
+        )
+
+    def _admit(
+        self, req_type: str, num_texts: int
+    ) -> Tuple[Optional[AdmissionTicket], Optional[Response]]:
+        """Ticket of the admitted texts (None without admission control),
+        else a 429 response"""
+        if self.admission is None:
+            return None, None
+
+        lane = EMBED_LANES[req_type]
+        retry_after = self.admission.try_acquire(lane, num_texts)
+        if retry_after is None:
+            return AdmissionTicket(self.admission, lane, num_texts), None
+
+        response = create_error_response(
+            HTTPStatus.TOO_MANY_REQUESTS,
+            "Embedding service is overloaded, retry later",
+        )
+        response.headers["Retry-After"] = str(retry_after)
+        return None, response
+
+    def _refuse_late(
+        self, req_type: str, num_texts: int, deadline: Optional[float]
+    ) -> Optional[Response]:
+        """None if the texts can be embedded before the deadline at the
+        observed throughput of their lane, else a 504 response"""
+        left = time_left(deadline)
+        if left is None:
+            return None
+        estimate = None
+        if self.admission is not None:
+            estimate = self.admission.estimate(EMBED_LANES[req_type], num_texts)
+        if left >= self.min_time_left and (estimate is None or estimate <= left):
+            return None
+
+        self.deadline_exceeded["refused"] += 1
+        return create_error_response(
+            HTTPStatus.GATEWAY_TIMEOUT,
+            f"The request has {max(left, 0):.2f}s left, embedding the texts "
+            f"needs {estimate or self.min_time_left:.2f}s",
+        )
+
+    def _deadline_response(self) -> Response:
+        self.deadline_exceeded["expired"] += 1
+        return create_error_response(
+            HTTPStatus.GATEWAY_TIMEOUT,
+            "The deadline passed before the texts were embedded",
+        )
+
+    async def _stream_embedding(
+        self,
+        model: str,
+        req_type: str,
+        sub_batches: SubBatches,
+        data: Dict,
+        media_type: str,
+        dtype: str,
+        ticket: Optional[AdmissionTicket] = None,
+        deadline: Optional[float] = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """Emit every sub-batch as soon as it is computed, either as a NDJSON
+        line or as a binary frame. At most `stream_prefetch` sub-batches are
+        queued ahead of the one being streamed, so a slow client holds back
+        the rest of the document. The stream ends early once the deadline
+        passed"""
+        pending, queued = sub_batches.pending, sub_batches.queued
+        while pending or queued:
+            while pending and len(queued) <= self.stream_prefetch:
+                start, texts = pending.popleft()
+                task = self._queue_sub_batch(model, req_type, texts, ticket)
+                queued.append((start, task))
+
+            start, task = queued[0]
+            try:
+                embedding = await asyncio.wait_for(task, time_left(deadline))
+            except asyncio.TimeoutError:
+                self.deadline_exceeded["expired"] += 1
+                return
+            queued.popleft()
+            if media_type == codec.STREAM_MEDIA_TYPE:
+                matrix, quantized_dtype, dim = self._shape_output(embedding, data)
+                yield codec.encode_frame(matrix, start, quantized_dtype or dtype, dim)
+            else:
+                line = {
+                    "index": start,
+                    "embedding": self._to_json(model, embedding, data),
+                }
+                yield (json.dumps(line) + "\n").encode("utf-8")
+
+    async def _close_stream(
+        self, sub_batches: SubBatches, ticket: Optional[AdmissionTicket]
+    ) -> None:
+        """Cancel the sub-batches which are still queued, the batcher drops
+        them before they reach the model, and release the texts which were
+        never handed to the batcher"""
+        for _, task in sub_batches.queued:
+            task.cancel()
+        sub_batches.queued.clear()
+        sub_batches.pending.clear()
+        if ticket is not None:
+            ticket.close()
+
+    @APP.get("/models")
+    async def models(self) -> JSONResponse:
+        """Configured models and which of them are currently loaded."""
+        self.registry.evict_idle()
+        return JSONResponse(
+            content={
+                "models": self.registry.status(),
+                "memory_mb": self.registry.memory_mb(),
+            }
+        )
+
     @APP.post("/")
-    async def generate_embedding(self, request: Request) -> JSONResponse:
+    async def generate_embedding(self, request: Request) -> Response:
+        """Embed the texts, the body format is negotiated with the `Accept`
+        header: json (default), `application/x-embedding` or
+        `application/x-npy`, binary formats accept a `dtype` parameter of
+        float32 or float16
+
+        Optional request fields `dimensions` (truncate and renormalize) and
+        `quantization` (int8, uint8 or binary) shrink the returned vectors.
+
+        `model` selects one of the configured models, sparse models return
+        `{"indices": [..], "values": [..]}` per text and are always json.
+
+        With `stream` set, sub-batches of `stream_batch_size` texts are
+        streamed as NDJSON lines `{"index": .., "embedding": ..}` or, if
+        binary is accepted, as `application/x-embedding-stream` frames.
+        """
         data = await request.json()
         req_type = data.get("type")
 
-        if req_type not in ["PASSAGE_EMBED", "QUERY_EMBED", "PLAIN_EMBED"]:
+        if req_type not in EMBED_TYPES:
             detail = "Invalid embedding type. Valid types are: PASSAGE_EMBED, QUERY_EMBED, PLAIN_EMBED"
             raise RequestValidationError(
                 [{"loc": ("query", "type"), "msg": detail, "type": "value_error"}]
             )
+        self._validate_output_options(data)
 
-        if req_type == "PASSAGE_EMBED":
-            embedding: List[np.ndarray] = list(
-                self.model.passage_embed(data.get("data"))
+        try:
+            model = self.registry.resolve(data.get("model"))
+        except KeyError:
+            detail = f"Invalid model. Valid models are: {', '.join(self.registry.configs)}"
+            raise RequestValidationError(
+                [{"loc": ("query", "model"), "msg": detail, "type": "value_error"}]
+            )
+
+        sparse = self.registry.kind(model) == "sparse"
+        if sparse and (data.get("dimensions") or data.get("quantization")):
+            detail = "dimensions and quantization are not supported by sparse models"
+            raise RequestValidationError(
+                [{"loc": ("query", "model"), "msg": detail, "type": "value_error"}]
+            )
+
+        texts = data.get("data")
+        if isinstance(texts, str):
+            texts = [texts]
+        if (
+            not isinstance(texts, list)
+            or not texts
+            or not all(isinstance(text, str) for text in texts)
+        ):
+            detail = "Invalid data. It should be a string or a non-empty list of strings"
+            raise RequestValidationError(
+                [{"loc": ("query", "data"), "msg": detail, "type": "value_error"}]
+            )
+
+        deadline = request_deadline(request)
+        refused = self._refuse_late(req_type, len(texts), deadline)
+        if refused is not None:
+            return refused
+
+        ticket, rejected = self._admit(req_type, len(texts))
+        if rejected is not None:
+            return rejected
+
+        media_type, dtype = codec.negotiate(request.headers.get("accept"))
+        if sparse:
+            media_type = codec.JSON_MEDIA_TYPE
+
+        if data.get("stream"):
+            if media_type == codec.JSON_MEDIA_TYPE:
+                media_type = codec.NDJSON_MEDIA_TYPE
+            else:
+                media_type = codec.STREAM_MEDIA_TYPE
+            sub_batches = SubBatches.split(
+                texts, data.get("stream_batch_size") or self.stream_batch_size
+            )
+            return CleanupStreamingResponse(
+                self._stream_embedding(
+                    model,
+                    req_type,
+                    sub_batches,
+                    data,
+                    media_type,
+                    dtype,
+                    ticket,
+                    deadline,
+                ),
+                on_close=partial(self._close_stream, sub_batches, ticket),
+                media_type=media_type,
+            )
+
+        try:
+            embedding: List[np.ndarray] = await asyncio.wait_for(
+                self._cached_embed(model, req_type, texts, ticket),
+                time_left(deadline),
+            )
+        except asyncio.TimeoutError:
+            return self._deadline_response()
+        finally:
+            # texts still held by the batcher are released once their batch
+            # finished, see `_cached_embed`
+            if ticket is not None:
+                ticket.close()
+
+        if media_type != codec.JSON_MEDIA_TYPE:
+            matrix, quantized_dtype, dim = self._shape_output(embedding, data)
+            return Response(
+                content=codec.encode(matrix, media_type, quantized_dtype or dtype, dim),
+                media_type=media_type,
             )
-        elif req_type == "QUERY_EMBED":
-            embedding: List[np.ndarray] = list(self.model.query_embed(data.get("data")))
-        elif req_type == "PLAIN_EMBED":
-            embedding: List[np.ndarray] = list(self.model.embed(data.get("data")))
 
-        embedding = [x.tolist() for x in embedding]
+        embedding = self._to_json(model, embedding, data)
 
         return JSONResponse(content={"embedding": embedding})
 
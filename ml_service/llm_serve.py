@@ -1,31 +1,105 @@
 import asyncio
+import json
 import os
 import uuid
+from functools import partial
 from http import HTTPStatus
-from typing import AsyncGenerator, Dict, List
+from typing import AsyncGenerator, Dict, List, Optional, Tuple, Union
 
-from fastapi import BackgroundTasks, FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException
 from fastapi.exceptions import RequestValidationError
-from ml.llm.protocol import GenerateRequest, GenerateResponse
+from ml.llm.admission import AdmissionRejected, PriorityScheduler, Ticket
+from ml.llm.cache import ResponseCache
+from ml.llm.engine import EngineBackend, load_engine
+from ml.llm.prompt_format import Message
+from ml.llm.stream import (
+    DEADLINE_FINISH_REASON,
+    FlushPolicy,
+    GenerationProgress,
+    coalesce,
+    encode_frame,
+    track,
+)
+from ml.llm.tokenization import PromptTokenizer
+from ml.llm.truncation import TRUNCATION_STRATEGIES, render_context, truncate
+from ml.llm.protocol import (
+    BatchGenerateRequest,
+    BatchItemResponse,
+    BatchSummary,
+    ChatCompletionChoice,
+    ChatCompletionRequest,
+    ChatCompletionResponse,
+    ChatCompletionStreamChoice,
+    ChatCompletionStreamResponse,
+    ChatMessage,
+    CompletionChoice,
+    CompletionRequest,
+    CompletionResponse,
+    DeltaMessage,
+    GenerateRequest,
+    GenerateResponse,
+    OpenAIRequest,
+    TruncationReport,
+    UsageInfo,
+)
 from ray import serve
 from ray.serve import Application
 from starlette.requests import Request
-from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.responses import JSONResponse, Response
 
 import time
 from utils.base import load_env, load_model_config
-from utils.exception import MaximumContextLengthError, ConfigFileMissingError
-from utils.http import create_error_response
+from utils.exception import (
+    ConfigFileMissingError,
+    DeadlineExceededError,
+    MaximumContextLengthError,
+)
+from utils.http import (
+    CleanupStreamingResponse,
+    create_error_response,
+    request_deadline,
+    time_left,
+)
 from utils.loggers import Logger, load_loggers
 from utils.parsers import DictObjectParser, YamlParser
-from vllm.engine.arg_utils import AsyncEngineArgs
-from vllm.engine.async_llm_engine import AsyncLLMEngine
-from vllm.sampling_params import SamplingParams
 from typing import Any
 
 # FastAPI APP
 APP = FastAPI()
 
+# request fields overriding the deployment's FlushPolicy
+FLUSH_FIELDS = ["flush_interval", "flush_tokens", "flush_bytes"]
+# priority class of batch items which do not select one
+BATCH_PRIORITY = "batch"
+# GenerateRequest fields which are not sampling parameters
+NON_SAMPLING_FIELDS = [
+    "prompt",
+    "messages",
+    "stream",
+    "stream_format",
+    "priority",
+    "user",
+    "context",
+    "truncation",
+    *FLUSH_FIELDS,
+]
+
+# chat affinity, the session key (chat_id) is sent as the multiplexed model
+# id so that Ray routes every turn of a chat to the replica which holds its
+# prefix in the KV cache, needs ray>=2.7
+SESSION_AFFINITY = hasattr(serve, "multiplexed")
+MAX_SESSIONS_PER_REPLICA = int(os.environ.get("LLM_MAX_SESSIONS_PER_REPLICA", 1024))
+
+
+def session_affinity(func):
+    """Register the decorated session loader as a multiplexed model loader
+    if the installed Ray supports it"""
+    if not SESSION_AFFINITY:
+        return func
+    return serve.multiplexed(max_num_models_per_replica=MAX_SESSIONS_PER_REPLICA)(
+        func
+    )
+
 
 @APP.exception_handler(RequestValidationError)
 async def validation_exception_handler(
@@ -54,16 +128,22 @@ class LLMDeployment:
         load_env(config.env_file if hasattr(config, "env_file") else ())
         self.logger = logger
         self.config = config
-        async_engine_args = AsyncEngineArgs(**self.config.serve_config.to_dict())
 
-        # Engine Args
-        self.engine = AsyncLLMEngine.from_engine_args(async_engine_args)
-        self.engine_model_config = self.engine.engine.get_model_config()
-        self.tokenizer = self.engine.engine.tokenizer
+        # Engine, vllm or the fake engine which runs on CPU
+        self.engine: EngineBackend = load_engine(
+            self.config.engine if hasattr(self.config, "engine") else "vllm",
+            self.config.serve_config.to_dict(),
+            **(
+                self.config.fake_engine.to_dict()
+                if hasattr(self.config, "fake_engine")
+                else {}
+            ),
+        )
+        self.tokenizer = self.engine.tokenizer
         self.max_model_len: float = self.config.serve_config.max_model_len
 
         self.logger.info(f"Deployment Inititalized")
-        self.logger.info(f"LLM Deployment Config: {async_engine_args}")
+        self.logger.info(f"LLM Deployment Engine: {self.engine}")
 
         self.config.root_path = os.environ.get("ROOT_PATH", None)
         try:
@@ -82,6 +162,159 @@ class LLMDeployment:
             self.logger.warning(f"No Model Config for: {self.config.model_name}")
             self.model_config = None
 
+        # prompts are tokenized off the event loop, segment by segment
+        tokenizer = (
+            self.config.tokenizer.to_dict() if hasattr(self.config, "tokenizer") else {}
+        )
+        self.prompt_tokenizer = PromptTokenizer(
+            self.tokenizer, **tokenizer, logger=self.logger
+        )
+        self._verify_segments()
+
+        # streamed responses coalesce tokens, `time_consecutive_res` is the
+        # time limit of older configs
+        stream = self.config.stream.to_dict() if hasattr(self.config, "stream") else {}
+        if hasattr(self.config, "time_consecutive_res"):
+            stream.setdefault("flush_interval", self.config.time_consecutive_res)
+        self.flush_policy = FlushPolicy(**stream)
+
+        # retrieved chunks are rendered in front of the last user message
+        context = (
+            self.config.context.to_dict() if hasattr(self.config, "context") else {}
+        )
+        self.context_template: str = context.get(
+            "template", "Related Content: {context}\n{message}"
+        )
+        self.chunk_template: str = context.get("chunk_template", " \n{index}. {chunk}")
+
+        # what is dropped from a prompt which does not fit the context window
+        truncation = (
+            self.config.truncation.to_dict()
+            if hasattr(self.config, "truncation")
+            else {}
+        )
+        self.truncation_strategies: List[str] = truncation.get("strategies", [])
+        self.keep_last_turns: int = truncation.get("keep_last_turns", 6)
+        self._validate_strategies(self.truncation_strategies)
+        self.truncated: Dict[str, int] = {
+            "requests": 0,
+            "messages": 0,
+            "context": 0,
+            "tokens": 0,
+        }
+
+        # limits of the batch endpoint
+        batch = self.config.batch.to_dict() if hasattr(self.config, "batch") else {}
+        self.batch_max_items: int = batch.get("max_items", 256)
+        self.batch_max_concurrency: int = batch.get("max_concurrency", 64)
+
+        # priority classes with their own budgets in front of the engine
+        self.scheduler: Optional[PriorityScheduler] = None
+        if hasattr(self.config, "admission"):
+            self.scheduler = PriorityScheduler(**self.config.admission.to_dict())
+
+        # opt-in cache of the outputs of greedy requests
+        self.response_cache: Optional[ResponseCache] = None
+        if hasattr(self.config, "response_cache"):
+            response_cache = self.config.response_cache.to_dict()
+            if response_cache.pop("enabled", True):
+                self.response_cache = ResponseCache(**response_cache)
+
+        # requests with less time left than `min_time_left` are refused,
+        # running ones are aborted once their deadline passed
+        deadline = (
+            self.config.deadline.to_dict() if hasattr(self.config, "deadline") else {}
+        )
+        self.min_time_left: float = deadline.get("min_time_left", 1.0)
+        self.deadline_exceeded: Dict[str, int] = {
+            "refused": 0,
+            "aborted": 0,
+            "output_tokens": 0,
+        }
+
+        # requests aborted because their client went away
+        self.aborted: Dict[str, int] = {
+            "requests": 0,
+            "output_tokens": 0,
+            "max_tokens_not_generated": 0,
+        }
+
+        # replica only reports ready once the engine is warm
+        self.ready = False
+        self.warm_up_timings: Dict[str, float] = {}
+        self._warm_up()
+
+    def _verify_segments(self) -> None:
+        """Check whether the prompt format renders segments which can be
+        tokenized separately, by comparing a multi-turn prompt with its
+        whole tokenization"""
+        if not self.model_config:
+            return
+        messages = [
+            Message(role="user", content="What is a binary search tree?"),
+            Message(role="assistant", content="A tree which keeps its keys sorted."),
+            Message(role="user", content="How fast is a lookup in it?"),
+        ]
+        segments = self.model_config.prompt_format.generate_prompt_segments(messages)
+        # logs a warning if it falls back to whole prompts
+        self.prompt_tokenizer.verify(segments)
+
+    def _warm_up(self) -> None:
+        """Run representative prompts through the tokenizer, the prompt
+        format and the engine before Ray routes traffic to the replica.
+
+        The engine backend runs the request synchronously, e.g. vllm's
+        engine is stepped directly as its background loop only starts with
+        the first request.
+        """
+        warm_up = (
+            self.config.warm_up.to_dict() if hasattr(self.config, "warm_up") else {}
+        )
+        if not warm_up.get("enabled", True):
+            self.ready = True
+            return
+
+        messages = warm_up.get("messages") or [
+            {"role": "user", "content": "What is a binary search tree?"}
+        ]
+        sampling_params = self.engine.sampling_params(
+            max_tokens=warm_up.get("max_tokens", 16), temperature=0
+        )
+        start = time.perf_counter()
+        try:
+            step_start = time.perf_counter()
+            if self.model_config:
+                segments = self.model_config.prompt_format.generate_prompt_segments(
+                    [Message(**message) for message in messages]
+                )
+            else:
+                segments = ["\n".join(message["content"] for message in messages)]
+            prompt = "".join(segments)
+            self.warm_up_timings["prompt_format"] = time.perf_counter() - step_start
+
+            step_start = time.perf_counter()
+            prompt_token_ids = self.prompt_tokenizer.encode_sync(segments)
+            self.warm_up_timings["tokenize"] = time.perf_counter() - step_start
+
+            step_start = time.perf_counter()
+            if self.engine.warm_up(
+                prompt=prompt,
+                prompt_token_ids=prompt_token_ids,
+                sampling_params=sampling_params,
+                request_id=f"warm-up-{self._next_request_id()}",
+            ):
+                self.warm_up_timings["generate"] = time.perf_counter() - step_start
+
+            self.ready = True
+        except Exception:
+            self.logger.error("Warm-up failed, replica is not ready", exc_info=True)
+
+        self.warm_up_timings = {k: round(v, 3) for k, v in self.warm_up_timings.items()}
+        self.logger.info(
+            f"Warm-up finished in {time.perf_counter() - start:.2f}s: "
+            f"{self.warm_up_timings}"
+        )
+
     def reconfigure(self, config: Dict[str, Any]):
         """on-the-fly change in the config"""
         pass
@@ -90,13 +323,20 @@ class LLMDeployment:
         """produce unique id using host ID, sequence number and time"""
         return str(uuid.uuid1().hex)
 
-    def _convert_prompt_to_tokens(
-        self, prompt: str, request: GenerateRequest
+    async def _convert_prompt_to_tokens(
+        self, segments: List[str], request: GenerateRequest
     ) -> List[int]:
-        input_ids = self.tokenizer.encode(prompt)
+        input_ids = await self.prompt_tokenizer.encode(segments)
         if self._check_length(input_ids=input_ids, request=request):
             return input_ids
 
+    def _fits(self, prompt_len: int, max_tokens: Optional[int]) -> bool:
+        """whether the prompt and the tokens to generate fit the context
+        window, a request without max_tokens needs room for one token"""
+        if max_tokens is None:
+            return prompt_len < self.max_model_len
+        return prompt_len + max_tokens <= self.max_model_len
+
     def _check_length(self, input_ids, request: GenerateRequest) -> List[int]:
         prompt_len = len(input_ids)  # total num of tokens in input
 
@@ -104,7 +344,7 @@ class LLMDeployment:
             request.max_tokens = (
                 self.max_model_len - prompt_len
             )  # assigining max_tokens that can be generated if not assigned
-        if prompt_len - request.max_tokens > self.max_model_len:
+        if request.max_tokens <= 0 or not self._fits(prompt_len, request.max_tokens):
             raise MaximumContextLengthError(
                 max_model_len=self.max_model_len,
                 prompt_len=prompt_len,
@@ -116,58 +356,585 @@ class LLMDeployment:
         )
         return True
 
-    async def _stream_results(self, output_generator) -> AsyncGenerator[bytes, None]:
-        """Stream the results of the output generator every second"""
-        last_streamed_time = time.time()
-        num_returned = 0
-        output_token_count = 0
+    def _validate_strategies(self, strategies: List[str]) -> None:
+        unknown = [s for s in strategies if s not in TRUNCATION_STRATEGIES]
+        if unknown:
+            raise ValueError(
+                f"Invalid truncation strategies {unknown}. "
+                f"Valid strategies are: {', '.join(TRUNCATION_STRATEGIES)}"
+            )
 
-        async for request_output in output_generator:
-            output = request_output.outputs[0]
-            output_token_count += 1
-            # Check if one second has passed since last stream
-            now = time.time()
-            if now - last_streamed_time >= self.config.time_consecutive_res:
-                # Generate response outside the loop for efficiency
-                text_output = output.text[num_returned:]
-                response = GenerateResponse(
-                    output=text_output,
-                    prompt_tokens=len(request_output.prompt_token_ids),
-                    output_tokens=output_token_count,
-                    finish_reason=output.finish_reason,
-                )
+    def _render(self, messages: List[Message], context: List[str]) -> List[str]:
+        messages = render_context(
+            messages, context, self.context_template, self.chunk_template
+        )
+        return self.model_config.prompt_format.generate_prompt_segments(messages)
+
+    async def _fit_messages(
+        self,
+        request: Union[GenerateRequest, OpenAIRequest],
+        messages: List[Message],
+    ) -> Tuple[List[str], List[int], Optional[TruncationReport]]:
+        """Render and tokenize the messages, dropping context chunks and
+        turns with the request's truncation strategies until the prompt fits
+        the context window.
+
+        Every strategy is applied step by step and decides on the exact
+        token count of the rendered prompt, the token ids of the segments
+        which are kept come from the tokenizer's cache.
 
-                yield (response.json() + "\n").encode("utf-8")
-                last_streamed_time = now
-                num_returned += len(text_output)
-                output_token_count = 0
+        Raises
+        ------
+        MaximumContextLengthError
+            if the prompt does not fit after all strategies were applied
+        """
+        strategies = request.truncation
+        if strategies is None:
+            strategies = self.truncation_strategies
+        self._validate_strategies(strategies)
+
+        context = list(getattr(request, "context", None) or [])
+        segments = self._render(messages, context)
+        input_ids = await self.prompt_tokenizer.encode(segments)
+        original_len = len(input_ids)
+
+        report = TruncationReport()
+        for strategy in strategies:
+            while not self._fits(len(input_ids), request.max_tokens):
+                truncated = truncate(strategy, messages, context, self.keep_last_turns)
+                if truncated is None:
+                    break
+                report.dropped_messages += len(messages) - len(truncated[0])
+                report.dropped_context += len(context) - len(truncated[1])
+                if strategy not in report.strategies:
+                    report.strategies.append(strategy)
+                messages, context = truncated
+                segments = self._render(messages, context)
+                input_ids = await self.prompt_tokenizer.encode(segments)
+
+        self._check_length(input_ids=input_ids, request=request)
+        if not report.strategies:
+            return segments, input_ids, None
+
+        report.dropped_tokens = original_len - len(input_ids)
+        self.truncated["requests"] += 1
+        self.truncated["messages"] += report.dropped_messages
+        self.truncated["context"] += report.dropped_context
+        self.truncated["tokens"] += report.dropped_tokens
+        self.logger.debug(f"Truncated prompt of {original_len} tokens: {report}")
+        return segments, input_ids, report
+
+    async def _prepare_prompt(
+        self,
+        request: Union[GenerateRequest, OpenAIRequest],
+        prompt: Optional[str] = None,
+        messages: Optional[List[Message]] = None,
+    ) -> Tuple[List[str], List[int], Optional[TruncationReport]]:
+        """Segments and token ids of the prompt and what was truncated,
+        raw prompts are used as they are"""
+        if prompt:
+            segments = [prompt]
+            input_ids = await self._convert_prompt_to_tokens(
+                segments=segments, request=request
+            )
+            return segments, input_ids, None
+        if not messages:
+            raise ValueError("Either prompt or messages must be provided.")
+        if not self.model_config:
+            raise ValueError("Parameter 'messages' requires a model config")
+        return await self._fit_messages(request, messages)
 
-        # Stream any remaining output at the end
-        if output_token_count:
-            text_output = output.text[num_returned:]
+    async def _stream_results(
+        self,
+        output_generator,
+        progress: GenerationProgress,
+        flush_policy: FlushPolicy,
+        truncation: Optional[TruncationReport] = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """Stream the results of the output generator, the first token is
+        sent immediately and the following ones as the policy flushes them.
+        A stream cut off at its deadline ends with a `deadline` frame"""
+        async for request_output, text_output, output_tokens in coalesce(
+            output_generator, flush_policy
+        ):
             response = GenerateResponse(
                 output=text_output,
                 prompt_tokens=len(request_output.prompt_token_ids),
-                output_tokens=output_token_count,
-                finish_reason=output.finish_reason,
+                output_tokens=output_tokens,
+                finish_reason=request_output.outputs[0].finish_reason,
+                truncation=truncation,
             )
+            truncation = None  # reported once
+
+            yield (response.json() + "\n").encode("utf-8")
 
+        if progress.deadline_exceeded:
+            response = GenerateResponse(
+                output="",
+                prompt_tokens=progress.prompt_tokens,
+                output_tokens=0,
+                finish_reason=DEADLINE_FINISH_REASON,
+                truncation=truncation,
+            )
             yield (response.json() + "\n").encode("utf-8")
 
-    async def _abort_request(self, request_id) -> None:
-        await self.engine.abort(request_id=request_id)
+    async def _stream_deltas(
+        self,
+        output_generator,
+        progress: GenerationProgress,
+        flush_policy: FlushPolicy,
+        truncation: Optional[TruncationReport] = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """Stream text-only delta frames as the policy flushes them, the
+        token counts and the finish reason follow in a single last frame.
+        Its finish reason is `deadline` if the stream was cut off"""
+        request_output = None
+        async for request_output, text_output, _ in coalesce(
+            output_generator, flush_policy
+        ):
+            if text_output:
+                yield encode_frame({"output": text_output})
+
+        if progress.deadline_exceeded:
+            finish_reason = DEADLINE_FINISH_REASON
+        elif request_output is not None:
+            finish_reason = request_output.outputs[0].finish_reason
+        else:
+            return
+        yield encode_frame(
+            {
+                "prompt_tokens": progress.prompt_tokens,
+                "output_tokens": progress.output_tokens,
+                "finish_reason": finish_reason,
+                "truncation": truncation.dict() if truncation else None,
+            }
+        )
+
+    async def _abort_unfinished(self, progress: GenerationProgress) -> None:
+        """Abort the engine request if it is still running, i.e. the client
+        disconnected or the response was cancelled, and log the tokens
+        which no longer have to be generated"""
+        if progress.finished or progress.aborted:
+            return
+        progress.aborted = True
+        await self.engine.abort(request_id=progress.request_id)
+
+        if progress.deadline_exceeded:
+            self.deadline_exceeded["aborted"] += 1
+            self.deadline_exceeded["output_tokens"] += progress.output_tokens
+            self.logger.info(
+                f"Aborted request {progress.request_id}, its deadline passed after "
+                f"{progress.output_tokens} tokens"
+            )
+            return
+
+        not_generated = max((progress.max_tokens or 0) - progress.output_tokens, 0)
+        self.aborted["requests"] += 1
+        self.aborted["output_tokens"] += progress.output_tokens
+        self.aborted["max_tokens_not_generated"] += not_generated
+        self.logger.info(
+            f"Aborted request {progress.request_id}, the client went away after "
+            f"{progress.output_tokens} tokens ({not_generated} tokens of "
+            f"max_tokens not generated)"
+        )
+
+    def _sampling_params(self, request: GenerateRequest) -> Any:
+        return self.engine.sampling_params(
+            **{
+                k: v
+                for k, v in request.__dict__.items()
+                if k not in NON_SAMPLING_FIELDS
+            }
+        )
+
+    def _check_deadline(self, deadline: Optional[float]) -> None:
+        """Refuse a request which has not enough time left to generate"""
+        left = time_left(deadline)
+        if left is not None and left < self.min_time_left:
+            self.deadline_exceeded["refused"] += 1
+            raise DeadlineExceededError(
+                f"The request has {max(left, 0):.2f}s left, "
+                f"at least {self.min_time_left}s are needed"
+            )
+
+    async def _admit(
+        self,
+        request: Union[GenerateRequest, OpenAIRequest],
+        prompt_token_ids: List[int],
+        default_priority: Optional[str] = None,
+        deadline: Optional[float] = None,
+    ) -> Optional[Ticket]:
+        """Wait for the budget of the request's priority class, at most
+        until the request has too little time left. Raises AdmissionRejected
+        if the class is overloaded and DeadlineExceededError if the wait used
+        up the request's time"""
+        if self.scheduler is None:
+            return None
+        if default_priority not in self.scheduler.classes:
+            default_priority = None
+        try:
+            priority = self.scheduler.resolve(request.priority or default_priority)
+        except KeyError:
+            raise ValueError(
+                f"Invalid priority. Valid priorities are: "
+                f"{', '.join(self.scheduler.classes)}"
+            )
+        # requests are queued fairly per user, chats without one per session
+        session_id = serve.get_multiplexed_model_id() if SESSION_AFFINITY else None
+        user = request.user or session_id or "anonymous"
+        left = time_left(deadline)
+        try:
+            ticket = await self.scheduler.acquire(
+                priority,
+                user,
+                len(prompt_token_ids) + request.max_tokens,
+                max_wait=None if left is None else left - self.min_time_left,
+            )
+        except AdmissionRejected:
+            self._check_deadline(deadline)
+            raise
+        try:
+            self._check_deadline(deadline)
+        except DeadlineExceededError:
+            self._release(ticket)
+            raise
+        return ticket
+
+    async def _start_generation(
+        self,
+        request: Union[GenerateRequest, OpenAIRequest],
+        segments: List[str],
+        prompt_token_ids: List[int],
+        sampling_params: Any,
+        request_id: str,
+        default_priority: Optional[str] = None,
+        deadline: Optional[float] = None,
+    ) -> Tuple[AsyncGenerator, GenerationProgress, Optional[Ticket]]:
+        """Outputs of the request, replayed from the response cache or
+        generated by the engine once the request was admitted, the outputs
+        stop at the deadline of the request"""
+        key = None
+        if self.response_cache is not None:
+            key = self.response_cache.key(prompt_token_ids, sampling_params)
+        cached = self.response_cache.get(key) if key else None
+        if cached is not None:
+            # nothing runs in the engine, so there is nothing to abort
+            progress = GenerationProgress(
+                request_id,
+                max_tokens=request.max_tokens,
+                prompt_tokens=len(prompt_token_ids),
+                finished=True,
+            )
+            return cached.replay(), progress, None
+
+        self._check_deadline(deadline)
+        ticket = await self._admit(
+            request, prompt_token_ids, default_priority, deadline
+        )
+        output_generator = self.engine.generate(
+            prompt="".join(segments),
+            sampling_params=sampling_params,
+            request_id=request_id,
+            prompt_token_ids=prompt_token_ids,
+        )
+        if key:
+            output_generator = self.response_cache.fill(key, output_generator)
+        progress = GenerationProgress(
+            request_id,
+            max_tokens=request.max_tokens,
+            prompt_tokens=len(prompt_token_ids),
+            deadline=deadline,
+        )
+        return output_generator, progress, ticket
+
+    def _release(self, ticket: Optional[Ticket]) -> None:
+        if ticket is not None:
+            self.scheduler.release(ticket)
+
+    def _rejected_response(self, rejected: AdmissionRejected) -> JSONResponse:
+        response = create_error_response(HTTPStatus.TOO_MANY_REQUESTS, str(rejected))
+        response.headers["Retry-After"] = str(rejected.retry_after)
+        return response
+
+    async def _close_stream(
+        self, progress: GenerationProgress, ticket: Optional[Ticket]
+    ) -> None:
+        """Abort the engine request if it still runs and free its budget"""
+        try:
+            await self._abort_unfinished(progress)
+        finally:
+            self._release(ticket)
+
+    async def _collect(
+        self,
+        output_generator,
+        progress: GenerationProgress,
+        raw_request: Request,
+        ticket: Optional[Ticket] = None,
+    ):
+        """Last output of a non streamed request, None if the client went
+        away before the request finished, raises DeadlineExceededError if
+        the deadline of the request passed"""
+        final_output = None
+        try:
+            async for request_output in track(output_generator, progress):
+                if await raw_request.is_disconnected():
+                    return None
+                final_output = request_output
+            if progress.deadline_exceeded:
+                raise DeadlineExceededError(
+                    f"The deadline passed after {progress.output_tokens} tokens"
+                )
+        finally:
+            await self._close_stream(progress, ticket)
+        return final_output
+
+    @session_affinity
+    async def _load_session(self, session_id: str) -> str:
+        """Nothing is loaded, the engine's prefix cache holds the session's
+        KV blocks, Ray only has to remember the replica of the session"""
+        return session_id
+
+    async def _pin_session(self) -> None:
+        """Mark the request's session as served by this replica, a session
+        whose replica is gone is picked up by the replica Ray routes it to"""
+        if not SESSION_AFFINITY:
+            return
+        session_id = serve.get_multiplexed_model_id()
+        if session_id:
+            await self._load_session(session_id)
+
+    def _openai_chunk(
+        self,
+        request_id: str,
+        created: int,
+        chat: bool,
+        text: Optional[str] = None,
+        role: Optional[str] = None,
+        finish_reason: Optional[str] = None,
+        usage: Optional[UsageInfo] = None,
+        truncation: Optional[TruncationReport] = None,
+    ) -> bytes:
+        """Server-sent event of a streamed OpenAI chunk, without choices if
+        it only carries the usage"""
+        if chat:
+            choices = [
+                ChatCompletionStreamChoice(
+                    index=0,
+                    delta=DeltaMessage(role=role, content=text),
+                    finish_reason=finish_reason,
+                )
+            ]
+            chunk = ChatCompletionStreamResponse(
+                id=request_id,
+                created=created,
+                model=self.config.model_name,
+                choices=[] if usage else choices,
+                usage=usage,
+                truncation=truncation,
+            )
+        else:
+            choices = [
+                CompletionChoice(index=0, text=text or "", finish_reason=finish_reason)
+            ]
+            chunk = CompletionResponse(
+                id=request_id,
+                created=created,
+                model=self.config.model_name,
+                choices=[] if usage else choices,
+                usage=usage,
+            )
+        return f"data: {chunk.json()}\n\n".encode("utf-8")
+
+    async def _stream_openai(
+        self,
+        output_generator,
+        progress: GenerationProgress,
+        request_id: str,
+        chat: bool,
+        include_usage: bool,
+        truncation: Optional[TruncationReport] = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """Stream every new delta of the output as a server-sent event, the
+        usage follows the last delta and the stream ends with `[DONE]`. A
+        stream cut off at its deadline ends with an error event instead of
+        the usage"""
+        created = int(time.time())
+        if chat:
+            yield self._openai_chunk(
+                request_id, created, chat, role="assistant", truncation=truncation
+            )
+
+        num_returned = 0
+        final_output = None
+        async for request_output in output_generator:
+            final_output = request_output
+            output = request_output.outputs[0]
+            delta = output.text[num_returned:]
+            num_returned = len(output.text)
+            if delta or output.finish_reason is not None:
+                yield self._openai_chunk(
+                    request_id,
+                    created,
+                    chat,
+                    text=delta,
+                    finish_reason=output.finish_reason,
+                )
+
+        if progress.deadline_exceeded:
+            error = {
+                "message": f"The deadline passed after {progress.output_tokens} tokens",
+                "type": "deadline_exceeded",
+                "code": HTTPStatus.GATEWAY_TIMEOUT.value,
+            }
+            yield f"data: {json.dumps({'error': error})}\n\n".encode("utf-8")
+        elif include_usage and final_output is not None:
+            prompt_tokens = len(final_output.prompt_token_ids)
+            completion_tokens = len(final_output.outputs[0].token_ids)
+            usage = UsageInfo(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            )
+            yield self._openai_chunk(request_id, created, chat, usage=usage)
+        yield b"data: [DONE]\n\n"
+
+    async def _openai_generate(
+        self,
+        request: OpenAIRequest,
+        raw_request: Request,
+        chat: bool,
+        prompt: Optional[str] = None,
+        messages: Optional[List[Message]] = None,
+    ) -> Union[ChatCompletionResponse, CompletionResponse, Response]:
+        """Run an OpenAI compatible request through the engine"""
+        if request.model and request.model.lower() != self.config.model_name.lower():
+            return create_error_response(
+                HTTPStatus.NOT_FOUND,
+                f"The model '{request.model}' does not exist, "
+                f"this deployment serves '{self.config.model_name}'",
+            )
+        if request.n != 1:
+            return create_error_response(
+                HTTPStatus.BAD_REQUEST, "Only n=1 is supported"
+            )
+
+        segments, prompt_token_ids, truncation = await self._prepare_prompt(
+            request, prompt=prompt, messages=messages
+        )
+        sampling_params = self.engine.sampling_params(**request.sampling_params())
+        request_id = ("chatcmpl-" if chat else "cmpl-") + self._next_request_id()
+        output_generator, progress, ticket = await self._start_generation(
+            request,
+            segments,
+            prompt_token_ids,
+            sampling_params,
+            request_id,
+            deadline=request_deadline(raw_request),
+        )
+
+        if request.stream:
+            include_usage = (
+                request.stream_options.include_usage
+                if request.stream_options
+                else True
+            )
+            # the engine request is aborted as soon as the response is over
+            return CleanupStreamingResponse(
+                self._stream_openai(
+                    track(output_generator, progress),
+                    progress,
+                    request_id,
+                    chat,
+                    include_usage,
+                    truncation,
+                ),
+                on_close=partial(self._close_stream, progress, ticket),
+                media_type="text/event-stream",
+            )
+
+        final_output = await self._collect(
+            output_generator, progress, raw_request, ticket
+        )
+        if final_output is None:
+            return Response(status_code=200)
+
+        output = final_output.outputs[0]
+        usage = UsageInfo(
+            prompt_tokens=len(final_output.prompt_token_ids),
+            completion_tokens=len(output.token_ids),
+            total_tokens=len(final_output.prompt_token_ids) + len(output.token_ids),
+        )
+        if chat:
+            return ChatCompletionResponse(
+                id=request_id,
+                created=int(time.time()),
+                model=self.config.model_name,
+                choices=[
+                    ChatCompletionChoice(
+                        index=0,
+                        message=ChatMessage(role="assistant", content=output.text),
+                        finish_reason=output.finish_reason,
+                    )
+                ],
+                usage=usage,
+                truncation=truncation,
+            )
+        return CompletionResponse(
+            id=request_id,
+            created=int(time.time()),
+            model=self.config.model_name,
+            choices=[
+                CompletionChoice(
+                    index=0, text=output.text, finish_reason=output.finish_reason
+                )
+            ],
+            usage=usage,
+        )
+
+    async def check_health(self) -> None:
+        """Called periodically by Ray Serve, only fails for what a restart of
+        the replica fixes (a dead engine loop), a failed warm-up is reported
+        by /ready since it would fail again after the restart"""
+        await self.engine.check_health()
 
     @APP.get("/health")
     async def health(self) -> Response:
         """Health check endpoint."""
         return Response(status_code=200)
 
+    @APP.get("/ready")
+    async def readiness(self) -> JSONResponse:
+        """Readiness endpoint, succeeds only after the warm-up."""
+        return JSONResponse(
+            status_code=200 if self.ready else 503,
+            content={"ready": self.ready, "warm_up": self.warm_up_timings},
+        )
+
+    @APP.get("/stats")
+    async def stats(self) -> JSONResponse:
+        """Tokenizer cache, truncation, response cache, aborted request,
+        deadline and admission statistics endpoint."""
+        return JSONResponse(
+            content={
+                "tokenizer": self.prompt_tokenizer.stats(),
+                "truncated": self.truncated,
+                "response_cache": (
+                    self.response_cache.stats() if self.response_cache else None
+                ),
+                "aborted": self.aborted,
+                "deadline_exceeded": self.deadline_exceeded,
+                "admission": self.scheduler.stats() if self.scheduler else None,
+            }
+        )
+
     @APP.post("/")
     async def generate(
         self, request: GenerateRequest, raw_request: Request
     ) -> GenerateResponse:
         """Generate Completion for the requested prompt"""
         try:
+            await self._pin_session()
             # either prompt or messages should provided
             if not request.prompt and not request.messages:
                 return create_error_response(
@@ -176,52 +943,51 @@ class LLMDeployment:
                 )
 
             # Handling cases based on either prompt or messages is provided
-            if request.prompt:
-                prompt = request.prompt
-            elif self.model_config:
-                prompt = self.model_config.prompt_format.generate_prompt(
-                    request.messages
-                )
-            else:
+            if not request.prompt and not self.model_config:
                 return create_error_response(
                     status_code=HTTPStatus.BAD_REQUEST,
                     message="Parameter 'messages' requires a model config ",
                 )
 
-            prompt_token_ids = self._convert_prompt_to_tokens(
-                prompt=prompt, request=request
+            segments, prompt_token_ids, truncation = await self._prepare_prompt(
+                request, prompt=request.prompt, messages=request.messages
             )
-            request_dict = {
-                k: v
-                for k, v in request.__dict__.items()
-                if k not in ["prompt", "messages", "stream"]
-            }
-
-            sampling_params = SamplingParams(**request_dict)
+            sampling_params = self._sampling_params(request)
             request_id = self._next_request_id()
-
-            output_generator = self.engine.generate(
-                prompt=prompt,
-                sampling_params=sampling_params,
-                request_id=request_id,
-                prompt_token_ids=prompt_token_ids,
+            output_generator, progress, ticket = await self._start_generation(
+                request,
+                segments,
+                prompt_token_ids,
+                sampling_params,
+                request_id,
+                deadline=request_deadline(raw_request),
             )
 
             # Handle streaming, if the socket connection drops then abort the request processing
             if request.stream:
-                background_tasks = BackgroundTasks()
-                background_tasks.add_task(self._abort_request, request_id)
-                return StreamingResponse(
-                    self._stream_results(output_generator),
-                    background=background_tasks,
+                flush_policy = self.flush_policy.override(
+                    **{field: getattr(request, field) for field in FLUSH_FIELDS}
+                )
+                stream = (
+                    self._stream_deltas
+                    if request.stream_format == "delta"
+                    else self._stream_results
+                )
+                return CleanupStreamingResponse(
+                    stream(
+                        track(output_generator, progress),
+                        progress,
+                        flush_policy,
+                        truncation,
+                    ),
+                    on_close=partial(self._close_stream, progress, ticket),
                 )
             else:
-                final_output = None
-                async for request_output in output_generator:
-                    if await raw_request.is_disconnected():
-                        await self.engine.abort(request_id=request_id)
-                        return Response(status_code=200)
-                    final_output = request_output
+                final_output = await self._collect(
+                    output_generator, progress, raw_request, ticket
+                )
+                if final_output is None:
+                    return Response(status_code=200)
 
                 text_outputs = final_output.outputs[0].text
                 prompt_tokens = len(final_output.prompt_token_ids)
@@ -233,9 +999,210 @@ class LLMDeployment:
                     prompt_tokens=prompt_tokens,
                     output_tokens=output_tokens,
                     finish_reason=finish_reason,
+                    truncation=truncation,
+                )
+
+        except AdmissionRejected as e:
+            return self._rejected_response(e)
+        except DeadlineExceededError as e:
+            return create_error_response(HTTPStatus.GATEWAY_TIMEOUT, str(e))
+        except (MaximumContextLengthError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            self.logger.error("Error in generating completion", exc_info=True)
+            raise HTTPException(status_code=500, detail=str(e))
+
+    async def _generate_item(
+        self,
+        index: int,
+        item: GenerateRequest,
+        batch_id: str,
+        slots: asyncio.Semaphore,
+        progresses: List[GenerationProgress],
+        deadline: Optional[float] = None,
+    ) -> BatchItemResponse:
+        """Run one item of a batch, failures are reported in the response"""
+        try:
+            async with slots:
+                segments, prompt_token_ids, truncation = await self._prepare_prompt(
+                    item, prompt=item.prompt, messages=item.messages
+                )
+                sampling_params = self._sampling_params(item)
+                request_id = f"{batch_id}-{index}"
+                output_generator, progress, ticket = await self._start_generation(
+                    item,
+                    segments,
+                    prompt_token_ids,
+                    sampling_params,
+                    request_id,
+                    default_priority=BATCH_PRIORITY,
+                    deadline=deadline,
+                )
+                try:
+                    progresses.append(progress)
+                    final_output = None
+                    async for request_output in track(output_generator, progress):
+                        final_output = request_output
+                    if progress.deadline_exceeded:
+                        await self._abort_unfinished(progress)
+                        raise DeadlineExceededError(
+                            f"The deadline passed after {progress.output_tokens} tokens"
+                        )
+                finally:
+                    self._release(ticket)
+
+            if final_output is None:
+                # e.g. the engine request was aborted before its first output
+                reason = "aborted" if progress.aborted else "ended"
+                return BatchItemResponse(
+                    index=index,
+                    error=f"The request was {reason} before it generated any output",
+                )
+            output = final_output.outputs[0]
+            return BatchItemResponse(
+                index=index,
+                output=output.text,
+                prompt_tokens=len(final_output.prompt_token_ids),
+                output_tokens=len(output.token_ids),
+                finish_reason=output.finish_reason,
+                truncation=truncation,
+            )
+
+        except AdmissionRejected as e:
+            return BatchItemResponse(
+                index=index, error=f"{e}, retry after {e.retry_after}s"
+            )
+        except (DeadlineExceededError, MaximumContextLengthError, ValueError) as e:
+            return BatchItemResponse(index=index, error=str(e))
+        except Exception as e:
+            self.logger.error(f"Error in batch item {index}", exc_info=True)
+            return BatchItemResponse(index=index, error=f"Internal error: {e}")
+
+    async def _stream_batch(
+        self, tasks: List[asyncio.Task]
+    ) -> AsyncGenerator[bytes, None]:
+        """Stream every item as soon as it completed, then the summary"""
+        failed = []
+        for next_done in asyncio.as_completed(tasks):
+            response: BatchItemResponse = await next_done
+            if response.error is not None:
+                failed.append(response.index)
+            yield (response.json() + "\n").encode("utf-8")
+
+        summary = BatchSummary(
+            total=len(tasks), succeeded=len(tasks) - len(failed), failed=sorted(failed)
+        )
+        yield (json.dumps({"summary": summary.dict()}) + "\n").encode("utf-8")
+
+    async def _close_batch(
+        self, tasks: List[asyncio.Task], progresses: List[GenerationProgress]
+    ) -> None:
+        """Abort the items which are still running once the response is over"""
+        for progress in progresses:
+            await self._abort_unfinished(progress)
+        for task in tasks:
+            task.cancel()
+
+    @APP.post("/batch")
+    async def generate_batch(
+        self, request: BatchGenerateRequest, raw_request: Request
+    ) -> Response:
+        """Generate completions for a batch of prompts or messages
+
+        Every item is submitted to the engine right away (at most
+        `batch.max_concurrency` at a time), so that continuous batching packs
+        them together. The results are streamed as NDJSON lines in the order
+        the items complete, tagged with their `index`, failed items carry an
+        `error` and the last line is `{"summary": ..}`.
+        """
+        if not request.items:
+            return create_error_response(
+                HTTPStatus.BAD_REQUEST, "A batch needs at least one item"
+            )
+        if len(request.items) > self.batch_max_items:
+            return create_error_response(
+                HTTPStatus.BAD_REQUEST,
+                f"A batch holds at most {self.batch_max_items} items, "
+                f"got {len(request.items)}",
+            )
+
+        batch_id = self._next_request_id()
+        deadline = request_deadline(raw_request)
+        slots = asyncio.Semaphore(self.batch_max_concurrency)
+        progresses: List[GenerationProgress] = []
+        tasks = [
+            asyncio.ensure_future(
+                self._generate_item(
+                    index, item, batch_id, slots, progresses, deadline
+                )
+            )
+            for index, item in enumerate(request.items)
+        ]
+        return CleanupStreamingResponse(
+            self._stream_batch(tasks),
+            on_close=partial(self._close_batch, tasks, progresses),
+            media_type="application/x-ndjson",
+        )
+
+    @APP.get("/v1/models")
+    async def models(self) -> JSONResponse:
+        """OpenAI compatible list of the served models"""
+        return JSONResponse(
+            content={
+                "object": "list",
+                "data": [
+                    {
+                        "id": self.config.model_name,
+                        "object": "model",
+                        "owned_by": "ailp",
+                    }
+                ],
+            }
+        )
+
+    @APP.post("/v1/chat/completions")
+    async def chat_completions(
+        self, request: ChatCompletionRequest, raw_request: Request
+    ) -> ChatCompletionResponse:
+        """OpenAI compatible chat completion, the messages are rendered with
+        the model's prompt format and `stream` sends server-sent events"""
+        try:
+            await self._pin_session()
+            if not self.model_config:
+                return create_error_response(
+                    status_code=HTTPStatus.BAD_REQUEST,
+                    message="Parameter 'messages' requires a model config ",
                 )
+            return await self._openai_generate(
+                request, raw_request, chat=True, messages=request.messages
+            )
+
+        except AdmissionRejected as e:
+            return self._rejected_response(e)
+        except DeadlineExceededError as e:
+            return create_error_response(HTTPStatus.GATEWAY_TIMEOUT, str(e))
+        except (MaximumContextLengthError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            self.logger.error("Error in generating chat completion", exc_info=True)
+            raise HTTPException(status_code=500, detail=str(e))
+
+    @APP.post("/v1/completions")
+    async def completions(
+        self, request: CompletionRequest, raw_request: Request
+    ) -> CompletionResponse:
+        """OpenAI compatible completion of a raw prompt"""
+        try:
+            await self._pin_session()
+            return await self._openai_generate(
+                request, raw_request, chat=False, prompt=request.prompt
+            )
 
-        except MaximumContextLengthError as e:
+        except AdmissionRejected as e:
+            return self._rejected_response(e)
+        except DeadlineExceededError as e:
+            return create_error_response(HTTPStatus.GATEWAY_TIMEOUT, str(e))
+        except (MaximumContextLengthError, ValueError) as e:
             raise HTTPException(status_code=400, detail=str(e))
         except Exception as e:
             self.logger.error("Error in generating completion", exc_info=True)
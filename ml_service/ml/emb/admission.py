@@ -0,0 +1,134 @@
+import math
+from functools import partial
+from typing import Callable, Dict, Optional
+
+
+class AdmissionController:
+    """Queue-depth based load shedding, measured in texts
+
+    Interactive query embeds have their own, larger budget which only
+    counts the query lane, bulk passage embeds are shed as soon as the
+    whole replica (both lanes) holds more than `max_pending_texts` texts.
+    Rejected callers get a Retry-After computed from the observed
+    throughput of their lane.
+    """
+
+    def __init__(
+        self,
+        max_pending_texts: int = 512,
+        max_pending_query_texts: int = 1024,
+        max_retry_after: float = 30,
+        smoothing: float = 0.2,
+    ) -> None:
+        """Construct
+
+        Parameters
+        ----------
+        max_pending_texts : int, optional
+            texts in flight or queued on the replica above which passage
+            embeds are rejected, by default 512
+        max_pending_query_texts : int, optional
+            texts in flight or queued on the query lane above which query
+            embeds are rejected, by default 1024
+        max_retry_after : float, optional
+            upper bound of the Retry-After in seconds, by default 30
+        smoothing : float, optional
+            weight of the newest batch in the throughput average, by default 0.2
+        """
+        self.max_pending_texts = max_pending_texts
+        self.max_pending_query_texts = max_pending_query_texts
+        self.max_retry_after = max_retry_after
+        self.smoothing = smoothing
+
+        self.pending: Dict[str, int] = {"query": 0, "passage": 0}
+        self.throughput: Dict[str, Optional[float]] = {"query": None, "passage": None}
+        self.rejected: Dict[str, int] = {"query": 0, "passage": 0}
+
+    def _retry_after(self, lane: str, excess: int) -> int:
+        throughput = self.throughput[lane]
+        if not throughput:
+            return 1
+        return max(1, math.ceil(min(excess / throughput, self.max_retry_after)))
+
+    def try_acquire(self, lane: str, num_texts: int) -> Optional[int]:
+        """Admit `num_texts` texts on the lane
+
+        Returns
+        -------
+        Optional[int]
+            None if admitted, else the seconds the caller should wait
+        """
+        if lane == "query":
+            pending, limit = self.pending["query"], self.max_pending_query_texts
+        else:
+            pending, limit = sum(self.pending.values()), self.max_pending_texts
+
+        # a single request bigger than the limit is admitted on an idle replica
+        if pending and pending + num_texts > limit:
+            self.rejected[lane] += 1
+            return self._retry_after(lane, pending + num_texts - limit)
+
+        self.pending[lane] += num_texts
+        return None
+
+    def estimate(self, lane: str, num_texts: int) -> Optional[float]:
+        """Seconds until `num_texts` more texts on the lane are embedded at
+        the observed throughput, None before the first batch finished"""
+        throughput = self.throughput[lane]
+        if not throughput:
+            return None
+        return (self.pending[lane] + num_texts) / throughput
+
+    def release(self, lane: str, num_texts: int) -> None:
+        self.pending[lane] -= num_texts
+
+    def observe(self, lane: str, num_texts: int, seconds: float, workers: int) -> None:
+        """Update the throughput (texts/sec) of the lane from a finished batch"""
+        if seconds <= 0:
+            return
+        throughput = num_texts / seconds * workers
+        current = self.throughput[lane]
+        self.throughput[lane] = (
+            throughput
+            if current is None
+            else self.smoothing * throughput + (1 - self.smoothing) * current
+        )
+
+    def stats(self) -> Dict[str, Dict]:
+        return {
+            "pending_texts": dict(self.pending),
+            "rejected_requests": dict(self.rejected),
+            "throughput": {
+                lane: round(value, 1) if value else None
+                for lane, value in self.throughput.items()
+            },
+        }
+
+
+class AdmissionTicket:
+    """Texts admitted for one request
+
+    Texts handed over to the batcher are released by it once their batch
+    finished, even if the request gave up on them earlier, so the pending
+    count follows the work which is really queued. `close` releases the
+    texts which were never handed over at the end of the request.
+    """
+
+    def __init__(
+        self, controller: AdmissionController, lane: str, num_texts: int
+    ) -> None:
+        self.controller = controller
+        self.lane = lane
+        self.held = num_texts
+
+    def hand_over(self, num_texts: int) -> Callable[[], None]:
+        """Callback which releases `num_texts` of the held texts"""
+        num_texts = min(num_texts, self.held)
+        self.held -= num_texts
+        return partial(self.controller.release, self.lane, num_texts)
+
+    def release(self, num_texts: int) -> None:
+        self.hand_over(num_texts)()
+
+    def close(self) -> None:
+        self.release(self.held)
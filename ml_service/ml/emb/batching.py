@@ -0,0 +1,199 @@
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, List, Optional, Set, Tuple
+
+BatchHandler = Callable[[List[str]], Awaitable[List[Any]]]
+
+# texts of a caller, the future of their results and the callback run once
+# the texts left the batcher
+Pending = Tuple[List[str], asyncio.Future, Optional[Callable[[], None]]]
+
+
+class DynamicBatcher:
+    """Merges concurrent requests into a single model call
+
+    Every caller submits its own list of texts, the batcher waits at most
+    `max_wait_time` seconds for other callers to show up, runs the handler
+    once on the concatenated texts and hands each caller back its slice of
+    the results, in the order the texts were submitted. Texts of callers
+    which went away before their batch started are dropped.
+    """
+
+    def __init__(
+        self,
+        handler: BatchHandler,
+        max_batch_size: int = 64,
+        max_wait_time: float = 0.01,
+        max_concurrent_batches: int = 1,
+    ) -> None:
+        """Construct
+
+        Parameters
+        ----------
+        handler : BatchHandler
+            coroutine function which takes a list of texts and returns
+            one result per text, in the same order
+        max_batch_size : int, optional
+            maximum number of texts merged into a single handler call,
+            by default 64
+        max_wait_time : float, optional
+            maximum time in seconds the first request of a batch waits
+            for more requests to arrive, by default 0.01
+        max_concurrent_batches : int, optional
+            number of handler calls allowed to run at the same time, should
+            match the number of workers the handler runs on, by default 1
+        """
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+
+        self._pending: Deque[Pending] = deque()
+        self._new_item = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        self._slots = asyncio.Semaphore(max_concurrent_batches)
+        self._running: Set[asyncio.Task] = set()
+
+    async def submit(
+        self, texts: List[str], on_done: Optional[Callable[[], None]] = None
+    ) -> List[Any]:
+        """Queue the texts and wait for their results
+
+        Parameters
+        ----------
+        texts : List[str]
+            texts which has to be processed together with other requests
+        on_done : Optional[Callable[[], None]], optional
+            called once the texts left the batcher, when their batch
+            finished or when they were dropped because the caller went
+            away, by default None
+
+        Returns
+        -------
+        List[Any]
+            results of the handler for the submitted texts, in order
+        """
+        if not texts:
+            if on_done is not None:
+                on_done()
+            return []
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((texts, future, on_done))
+        self._new_item.set()
+
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+        return await future
+
+    async def _wait_for_item(self, timeout: float) -> bool:
+        """wait until a new request is queued or the timeout expires"""
+        self._new_item.clear()
+        try:
+            await asyncio.wait_for(self._new_item.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def _drop_cancelled(self) -> None:
+        """drop the requests at the head of the queue whose caller went away"""
+        while self._pending and self._pending[0][1].done():
+            _finish(self._pending.popleft())
+
+    def _collect_batch(self) -> List[Pending]:
+        """pop requests from the queue until the batch is full, a request
+        bigger than `max_batch_size` is always processed on its own.
+        Cancelled requests are dropped and do not count against the size"""
+        batch: List[Pending] = []
+        batch_size = 0
+
+        while self._pending:
+            self._drop_cancelled()
+            if not self._pending:
+                break
+            next_size = len(self._pending[0][0])
+            if batch and batch_size + next_size > self.max_batch_size:
+                break
+            batch.append(self._pending.popleft())
+            batch_size += next_size
+
+        return batch
+
+    def _pending_size(self) -> int:
+        return sum(
+            len(texts) for texts, future, _ in self._pending if not future.done()
+        )
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            # give other concurrent requests a chance to join the batch
+            deadline = loop.time() + self.max_wait_time
+            while self._pending_size() < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0 or not await self._wait_for_item(timeout):
+                    break
+
+            # requests keep piling up while every slot is busy, so the
+            # next batch gets bigger under load
+            await self._slots.acquire()
+            batch = self._collect_batch()
+            if not batch:
+                self._slots.release()
+                continue
+            task = asyncio.create_task(self._process(batch))
+            self._running.add(task)
+            task.add_done_callback(self._release)
+
+    def _release(self, task: asyncio.Task) -> None:
+        self._running.discard(task)
+        self._slots.release()
+
+    async def _process(self, batch: List[Pending]) -> None:
+        try:
+            await self._run_handler(batch)
+        finally:
+            for item in batch:
+                _finish(item)
+
+    async def _run_handler(self, batch: List[Pending]) -> None:
+        # callers may have gone away while the batch waited for a slot
+        batch = [item for item in batch if not item[1].done()]
+        if not batch:
+            return
+        texts = [text for item_texts, _, _ in batch for text in item_texts]
+        try:
+            results = await self.handler(texts)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        start = 0
+        for item_texts, future, _ in batch:
+            end = start + len(item_texts)
+            if not future.done():
+                future.set_result(results[start:end])
+            start = end
+
+
+def _finish(item: Pending) -> None:
+    on_done = item[2]
+    if on_done is not None:
+        on_done()
+
+
+def length_sorted_order(lengths: List[int]) -> List[int]:
+    """Indices which sort the texts by their tokenized length, running the
+    sorted texts in fixed size batches keeps texts of similar length in the
+    same batch, so less padding is needed"""
+    return sorted(range(len(lengths)), key=lengths.__getitem__)
+
+
+def restore_order(results: List[Any], order: List[int]) -> List[Any]:
+    """Undo `length_sorted_order` on the results of the sorted texts"""
+    restored: List[Any] = [None] * len(order)
+    for result, index in zip(results, order):
+        restored[index] = result
+    return restored
@@ -0,0 +1,341 @@
+import asyncio
+import dbm
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from utils.loggers import Logger
+
+
+class DiskTier:
+    """Memory-mapped vector store which survives replica restarts
+
+    Vectors are written into a fixed capacity ring of slots inside a
+    `np.memmap` file, the key -> slot mapping lives in a dbm database next
+    to it. Once the ring is full the oldest slot gets overwritten. A tier
+    holds the vectors of a single model, so all of them have the same dim.
+    Reads and writes may come from different threads.
+    """
+
+    def __init__(self, directory: str, capacity: int, dtype: str = "float32") -> None:
+        """Construct
+
+        Parameters
+        ----------
+        directory : str
+            directory which holds the vector and the index file
+        capacity : int
+            maximum number of vectors kept on disk
+        dtype : str, optional
+            dtype the vectors are stored with, by default "float32"
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.index = dbm.open(os.path.join(directory, "index"), "c")
+        self.vectors: Optional[np.memmap] = None
+        self._lock = threading.Lock()
+        self._size = 0
+
+        if b"__dim__" in self.index:
+            dim = int(self.index[b"__dim__"])
+            same_capacity = int(self.index.get(b"__capacity__", b"0")) == capacity
+            if same_capacity and os.path.exists(self._vectors_path):
+                self._open_vectors(dim, mode="r+")
+                self._size = self._stored_size()
+            else:
+                self._reset()
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.directory, "vectors.bin")
+
+    @property
+    def dim(self) -> Optional[int]:
+        return None if self.vectors is None else self.vectors.shape[1]
+
+    def _open_vectors(self, dim: int, mode: str) -> None:
+        self.vectors = np.memmap(
+            self._vectors_path,
+            dtype=self.dtype,
+            mode=mode,
+            shape=(self.capacity, dim),
+        )
+
+    def _stored_size(self) -> int:
+        """entries of an existing index, counted once if it predates the
+        `__size__` record"""
+        if b"__size__" in self.index:
+            return int(self.index[b"__size__"])
+        return sum(1 for key in self.index.keys() if not key.startswith(b"__"))
+
+    def _reset(self) -> None:
+        """drop every entry, used when the stored layout does not match"""
+        for key in list(self.index.keys()):
+            del self.index[key]
+        self.vectors = None
+        self._size = 0
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            slot = self.index.get(key.encode())
+            if slot is None or self.vectors is None:
+                return None
+            return np.array(self.vectors[int(slot)], dtype=np.float32)
+
+    def put(self, key: str, vector: np.ndarray) -> None:
+        """Store the vector, raises ValueError if its dim is not the one of
+        the vectors already in the tier"""
+        with self._lock:
+            if self.vectors is None:
+                self.index[b"__dim__"] = str(vector.shape[-1])
+                self.index[b"__capacity__"] = str(self.capacity)
+                self.index[b"__next__"] = b"0"
+                self._open_vectors(vector.shape[-1], mode="w+")
+            elif vector.shape[-1] != self.vectors.shape[1]:
+                raise ValueError(
+                    f"Vector of dim {vector.shape[-1]} does not fit the disk tier "
+                    f"{self.directory} of dim {self.vectors.shape[1]}"
+                )
+
+            # keys are content addressed, a stored key holds the same vector
+            if key.encode() in self.index:
+                return
+
+            slot = int(self.index[b"__next__"])
+            slot_key = f"__slot_{slot}__".encode()
+            old_key = self.index.get(slot_key)
+            if old_key is not None and old_key in self.index:
+                del self.index[old_key]
+                self._size -= 1
+
+            self.vectors[slot] = vector
+            self.index[key.encode()] = str(slot)
+            self.index[slot_key] = key.encode()
+            self.index[b"__next__"] = str((slot + 1) % self.capacity)
+            self._size += 1
+            self.index[b"__size__"] = str(self._size)
+
+    def flush(self) -> None:
+        with self._lock:
+            vectors = self.vectors
+            if hasattr(self.index, "sync"):
+                self.index.sync()
+        # the msync of a large memmap takes long, reads go on meanwhile and
+        # writes come from the thread which flushes
+        if vectors is not None:
+            vectors.flush()
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            self.index.close()
+
+    def __len__(self) -> int:
+        return self._size
+
+
+class EmbeddingCache:
+    """Content addressed LRU cache for embeddings
+
+    Entries are keyed by (model name, embed type, sha256 of the text) and
+    the in-memory tier is bounded by the bytes held by the vectors. Entries
+    evicted from memory stay available in the optional disk tier, which
+    keeps one `DiskTier` per model. Disk reads and writes run on background
+    threads, writes are flushed at most every `disk_flush_interval` seconds
+    and when the cache is closed, never on the event loop.
+    """
+
+    # rough per-entry overhead of the key and the OrderedDict node
+    ENTRY_OVERHEAD = 200
+
+    def __init__(
+        self,
+        max_bytes: int,
+        disk_dir: Optional[str] = None,
+        disk_capacity: int = 100_000,
+        disk_flush_interval: float = 30,
+        logger: Optional[Logger] = None,
+    ) -> None:
+        """Construct
+
+        Parameters
+        ----------
+        max_bytes : int
+            memory budget of the in-memory tier
+        disk_dir : Optional[str], optional
+            directory of the memory-mapped disk tier, disabled if None
+        disk_capacity : int, optional
+            maximum number of vectors per model in the disk tier,
+            by default 100_000
+        disk_flush_interval : float, optional
+            minimum seconds between two flushes of the disk tier,
+            by default 30
+        logger : Optional[Logger], optional
+            reports failed disk writes, by default None
+        """
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.size_bytes = 0
+
+        self.disk_dir = disk_dir
+        self.disk_capacity = disk_capacity
+        self.disk_flush_interval = disk_flush_interval
+        self.logger = logger
+        self.disks: Dict[str, DiskTier] = {}
+        self._disks_lock = threading.Lock()
+        # a single writer keeps the disk writes in order, lookups have their
+        # own thread so that they do not queue behind the writes
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._reader: Optional[ThreadPoolExecutor] = None
+        self._last_flush = time.monotonic()
+        if disk_dir:
+            self._writer = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="emb-cache-disk"
+            )
+            self._reader = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="emb-cache-disk-read"
+            )
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(model_name: str, embed_type: str, text: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{model_name}:{embed_type}:{digest}"
+
+    @staticmethod
+    def _model_name(key: str) -> str:
+        # the embed type and the digest never contain a colon
+        return key.rsplit(":", 2)[0]
+
+    def _disk(self, model_name: str) -> Optional[DiskTier]:
+        """disk tier of the model, in its own directory"""
+        if not self.disk_dir:
+            return None
+        with self._disks_lock:
+            tier = self.disks.get(model_name)
+            if tier is None:
+                directory = re.sub(r"[^A-Za-z0-9_.-]", "_", model_name)
+                tier = DiskTier(
+                    os.path.join(self.disk_dir, directory), self.disk_capacity
+                )
+                self.disks[model_name] = tier
+            return tier
+
+    def _entry_size(self, vector: np.ndarray) -> int:
+        return vector.nbytes + self.ENTRY_OVERHEAD
+
+    def _get_memory(self, key: str) -> Optional[np.ndarray]:
+        vector = self.entries.get(key)
+        if vector is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return vector
+
+    def _read(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        """look the keys up in the disk tier, runs on the reader thread"""
+        return [self._disk(self._model_name(key)).get(key) for key in keys]
+
+    async def get_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        """Vectors of the keys, None for the misses. The memory tier is read
+        on the event loop, its misses are looked up in the disk tier with a
+        single call on the reader thread"""
+        vectors = [self._get_memory(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing and self._reader is not None:
+            found = await asyncio.get_running_loop().run_in_executor(
+                self._reader, self._read, [keys[i] for i in missing]
+            )
+            for i, vector in zip(missing, found):
+                if vector is not None:
+                    self.disk_hits += 1
+                    self._put_memory(keys[i], vector)
+                    vectors[i] = vector
+
+        self.misses += sum(1 for vector in vectors if vector is None)
+        return vectors
+
+    def _put_memory(self, key: str, vector: np.ndarray) -> None:
+        size = self._entry_size(vector)
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.size_bytes -= self._entry_size(self.entries.pop(key))
+
+        self.entries[key] = vector
+        self.size_bytes += size
+        while self.size_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size_bytes -= self._entry_size(evicted)
+            self.evictions += 1
+
+    def put(self, key: str, vector: np.ndarray) -> None:
+        self.put_many([key], [vector])
+
+    def put_many(self, keys: List[str], vectors: List[np.ndarray]) -> None:
+        for key, vector in zip(keys, vectors):
+            self._put_memory(key, vector)
+        if self._writer is not None:
+            future = self._writer.submit(self._write, keys, vectors)
+            future.add_done_callback(self._log_failure)
+
+    def _write(self, keys: List[str], vectors: List[np.ndarray]) -> None:
+        """store the vectors on the disk tier, runs on the writer thread"""
+        for key, vector in zip(keys, vectors):
+            self._disk(self._model_name(key)).put(key, vector)
+        if time.monotonic() - self._last_flush >= self.disk_flush_interval:
+            self._flush()
+
+    def _flush(self) -> None:
+        self._last_flush = time.monotonic()
+        for tier in list(self.disks.values()):
+            tier.flush()
+
+    def _log_failure(self, future: Future) -> None:
+        if future.exception() is not None and self.logger is not None:
+            self.logger.error(
+                "Writing the disk tier of the embedding cache failed",
+                exc_info=future.exception(),
+            )
+
+    def close(self) -> None:
+        """Wait for the pending disk writes and flush the disk tier"""
+        if self._writer is None:
+            return
+        self._reader.shutdown(wait=True)
+        self._reader = None
+        self._writer.shutdown(wait=True)
+        self._writer = None
+        # later lookups only use the memory tier
+        self.disk_dir = None
+        for tier in list(self.disks.values()):
+            tier.close()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+        }
+        if self.disk_dir:
+            stats["disk_entries"] = {
+                name: len(tier) for name, tier in list(self.disks.items())
+            }
+        return stats
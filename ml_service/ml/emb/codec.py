@@ -0,0 +1,141 @@
+import io
+import struct
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+JSON_MEDIA_TYPE = "application/json"
+BINARY_MEDIA_TYPE = "application/x-embedding"
+NPY_MEDIA_TYPE = "application/x-npy"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+STREAM_MEDIA_TYPE = "application/x-embedding-stream"
+
+# binary body: header (version, dtype code, rows, dim) followed by the
+# row-major matrix in little endian byte order. Binary vectors hold their
+# `dim` sign bits packed into ceil(dim / 8) bytes per row
+HEADER = struct.Struct("<BBII")
+VERSION = 1
+# streamed binary body: every frame is prefixed with (body length, index of
+# the first text of the frame) and carries a regular binary body
+FRAME_HEADER = struct.Struct("<II")
+DTYPE_CODES = {"float32": 0, "float16": 1, "int8": 2, "uint8": 3, "binary": 4}
+FLOAT_DTYPES = ["float32", "float16"]
+
+
+def to_matrix(embedding: List[np.ndarray]) -> np.ndarray:
+    """Stack the per text vectors into a single 2D matrix"""
+    if not embedding:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.stack(embedding)
+
+
+def negotiate(accept: Optional[str]) -> Tuple[str, str]:
+    """Pick the response format from the `Accept` header
+
+    Parameters
+    ----------
+    accept : Optional[str]
+        value of the `Accept` request header, media types are tried in
+        the order of their quality value
+
+    Returns
+    -------
+    Tuple[str, str]
+        media type and dtype of the response body, falls back to json
+    """
+    if not accept:
+        return JSON_MEDIA_TYPE, "float32"
+
+    candidates = []
+    for position, media_range in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        options = dict(
+            param.split("=", 1) for param in params if "=" in param
+        )
+        try:
+            quality = float(options.get("q", 1.0))
+        except ValueError:
+            quality = 0.0
+        candidates.append((-quality, position, media_type.lower(), options))
+
+    for quality, _, media_type, options in sorted(candidates):
+        if quality == 0:
+            continue
+        dtype = options.get("dtype", "float32").lower()
+        binary = media_type in (BINARY_MEDIA_TYPE, NPY_MEDIA_TYPE)
+        if binary and dtype in FLOAT_DTYPES:
+            return media_type, dtype
+        if media_type in (JSON_MEDIA_TYPE, "application/*", "*/*"):
+            return JSON_MEDIA_TYPE, "float32"
+
+    return JSON_MEDIA_TYPE, "float32"
+
+
+def encode(
+    matrix: np.ndarray,
+    media_type: str,
+    dtype: str = "float32",
+    dim: Optional[int] = None,
+) -> bytes:
+    """Serialize the embedding matrix into a binary body
+
+    Parameters
+    ----------
+    matrix : np.ndarray
+        2D matrix of shape (rows, dim)
+    media_type : str
+        either `BINARY_MEDIA_TYPE` or `NPY_MEDIA_TYPE`
+    dtype : str, optional
+        any one of `DTYPE_CODES`, int8, uint8 and binary (packed bits) are
+        used for quantized output, by default "float32"
+    dim : Optional[int], optional
+        components of a binary vector before packing, by default 8 per
+        byte of the matrix. Npy bodies only hold the packed bytes
+
+    Returns
+    -------
+    bytes
+        serialized body
+    """
+    storage = "uint8" if dtype == "binary" else dtype
+    matrix = np.ascontiguousarray(matrix, dtype=np.dtype(storage).newbyteorder("<"))
+
+    if media_type == NPY_MEDIA_TYPE:
+        buffer = io.BytesIO()
+        np.save(buffer, matrix, allow_pickle=False)
+        return buffer.getvalue()
+
+    rows, columns = matrix.shape
+    if dtype != "binary":
+        dim = columns
+    elif dim is None:
+        dim = columns * 8
+    return HEADER.pack(VERSION, DTYPE_CODES[dtype], rows, dim) + matrix.tobytes()
+
+
+def encode_frame(
+    matrix: np.ndarray,
+    start: int,
+    dtype: str = "float32",
+    dim: Optional[int] = None,
+) -> bytes:
+    """Serialize a streamed sub-batch into a length-prefixed binary frame
+
+    Parameters
+    ----------
+    matrix : np.ndarray
+        2D matrix of the sub-batch
+    start : int
+        index of the first text of the sub-batch in the request
+    dtype : str, optional
+        any one of `DTYPE_CODES`, by default "float32"
+    dim : Optional[int], optional
+        components of a binary vector before packing, see `encode`
+
+    Returns
+    -------
+    bytes
+        frame header followed by the binary body
+    """
+    body = encode(matrix, BINARY_MEDIA_TYPE, dtype, dim)
+    return FRAME_HEADER.pack(len(body), start) + body
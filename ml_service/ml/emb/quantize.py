@@ -0,0 +1,57 @@
+from typing import Optional
+
+import numpy as np
+
+QUANTIZATION_TYPES = ["int8", "uint8", "binary"]
+
+
+def truncate(matrix: np.ndarray, dimensions: int) -> np.ndarray:
+    """Matryoshka style truncation, keeps the first `dimensions` components
+    and renormalizes the vectors to unit length
+
+    Parameters
+    ----------
+    matrix : np.ndarray
+        embedding matrix of shape (rows, dim)
+    dimensions : int
+        number of leading components to keep
+
+    Returns
+    -------
+    np.ndarray
+        matrix of shape (rows, dimensions)
+    """
+    truncated = matrix[:, :dimensions]
+    norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+    return truncated / np.maximum(norms, np.finfo(truncated.dtype).tiny)
+
+
+def quantize(matrix: np.ndarray, quantization: Optional[str]) -> np.ndarray:
+    """Quantize unit length vectors
+
+    int8 maps [-1, 1] symmetrically onto [-127, 127], uint8 onto [0, 255]
+    (the vector datatype supported by qdrant) and binary keeps the sign of
+    every component packed into bits, 8 components per byte.
+
+    Parameters
+    ----------
+    matrix : np.ndarray
+        embedding matrix of shape (rows, dim) with unit length rows
+    quantization : Optional[str]
+        any one of `QUANTIZATION_TYPES`, the matrix is returned unchanged
+        if None
+
+    Returns
+    -------
+    np.ndarray
+        quantized matrix, binary matrices have shape (rows, ceil(dim / 8))
+    """
+    if quantization is None:
+        return matrix
+    if quantization == "int8":
+        return np.clip(np.rint(matrix * 127), -127, 127).astype(np.int8)
+    if quantization == "uint8":
+        return np.clip(np.rint((matrix + 1) * 127.5), 0, 255).astype(np.uint8)
+    if quantization == "binary":
+        return np.packbits(matrix > 0, axis=1)
+    raise ValueError(f"Unsupported quantization: {quantization}")
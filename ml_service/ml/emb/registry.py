@@ -0,0 +1,207 @@
+import asyncio
+import gc
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from utils.loggers import Logger
+
+
+@dataclass
+class LoadedModel:
+    """model instance with its bookkeeping"""
+
+    name: str
+    model: Any
+    memory_mb: float
+    loaded_at: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+    in_use: int = 0
+    pinned: bool = False
+
+
+class ModelRegistry:
+    """Serves several named models from one deployment
+
+    Models are loaded on their first request, off the event loop, and
+    unloaded once they were idle for `idle_ttl` seconds or when loading
+    another model would exceed `max_memory_mb`. A model which is running
+    inference or was preloaded is never unloaded.
+    """
+
+    def __init__(
+        self,
+        models: Dict[str, Dict],
+        default_model: str,
+        loaders: Dict[str, Callable[..., Any]],
+        logger: Logger,
+        idle_ttl: Optional[float] = None,
+        max_memory_mb: Optional[float] = None,
+    ) -> None:
+        """Construct
+
+        Parameters
+        ----------
+        models : Dict[str, Dict]
+            model configs by name, `serve_config` is passed to the loader of
+            the model's `kind` (dense by default) and `memory_mb` is the
+            estimated memory footprint of the model
+        default_model : str
+            model used when a request does not select one
+        loaders : Dict[str, Callable[..., Any]]
+            builds a model of the kind from its `serve_config`,
+            e.g. {"dense": TextEmbedding}
+        logger : Logger
+            object which will be used for logging
+        idle_ttl : Optional[float], optional
+            seconds after which an unused model is unloaded, by default None
+        max_memory_mb : Optional[float], optional
+            memory budget of the loaded models, by default None
+        """
+        if default_model not in models:
+            raise KeyError(f"Default model '{default_model}' has no config")
+        for name, config in models.items():
+            if config.get("kind", "dense") not in loaders:
+                raise KeyError(f"No loader for the kind of model '{name}'")
+
+        self.configs = models
+        self.default_model = default_model
+        self.loaders = loaders
+        self.logger = logger
+        self.idle_ttl = idle_ttl
+        self.max_memory_mb = max_memory_mb
+
+        self.loaded: Dict[str, LoadedModel] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._evictor: Optional[asyncio.Task] = None
+
+    def resolve(self, name: Optional[str]) -> str:
+        """Name of the model to use, raises KeyError for unknown models"""
+        name = name or self.default_model
+        if name not in self.configs:
+            raise KeyError(name)
+        return name
+
+    def model_name(self, name: str) -> str:
+        """Upstream name of the model, used to address cached embeddings"""
+        return self.configs[name]["serve_config"].get("model_name", name)
+
+    def kind(self, name: str) -> str:
+        """Kind of the model, e.g. dense or sparse"""
+        return self.configs[name].get("kind", "dense")
+
+    def load_sync(self, name: str) -> LoadedModel:
+        """Load and pin the model on the calling thread, used at init time"""
+        if name not in self.loaded:
+            self._make_room(self.configs[name].get("memory_mb", 0))
+            self.loaded[name] = self._build(name)
+        self.loaded[name].pinned = True
+        return self.loaded[name]
+
+    def _build(self, name: str) -> LoadedModel:
+        config = self.configs[name]
+        start = time.perf_counter()
+        model = self.loaders[self.kind(name)](**config["serve_config"])
+        self.logger.info(
+            f"Loaded model {name} in {time.perf_counter() - start:.2f}s"
+        )
+        return LoadedModel(
+            name=name, model=model, memory_mb=config.get("memory_mb", 0)
+        )
+
+    async def _load(self, name: str) -> LoadedModel:
+        if name in self.loaded:
+            return self.loaded[name]
+
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            if name not in self.loaded:
+                self._make_room(self.configs[name].get("memory_mb", 0))
+                loop = asyncio.get_running_loop()
+                self.loaded[name] = await loop.run_in_executor(
+                    None, self._build, name
+                )
+        return self.loaded[name]
+
+    @asynccontextmanager
+    async def use(self, name: str) -> AsyncIterator[Any]:
+        """Lend the model for the duration of an inference call"""
+        entry = await self._load(name)
+        if self.idle_ttl and (self._evictor is None or self._evictor.done()):
+            self._evictor = asyncio.create_task(self._evict_idle_loop())
+
+        entry.in_use += 1
+        try:
+            yield entry.model
+        finally:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+
+    def _unload(self, name: str, reason: str) -> None:
+        del self.loaded[name]
+        gc.collect()
+        self.logger.info(f"Unloaded model {name} ({reason})")
+
+    def _make_room(self, memory_mb: float) -> None:
+        """unload the least recently used idle models until the new model
+        fits into the memory budget"""
+        if self.max_memory_mb is None:
+            return
+
+        idle = sorted(
+            (
+                entry
+                for entry in self.loaded.values()
+                if entry.in_use == 0 and not entry.pinned
+            ),
+            key=lambda entry: entry.last_used,
+        )
+        for entry in idle:
+            if self.memory_mb() + memory_mb <= self.max_memory_mb:
+                break
+            self._unload(entry.name, reason="memory cap")
+
+        if self.memory_mb() + memory_mb > self.max_memory_mb:
+            self.logger.warning(
+                f"Loading a {memory_mb}MB model exceeds the memory cap of "
+                f"{self.max_memory_mb}MB, every loaded model is in use or pinned"
+            )
+
+    def evict_idle(self) -> None:
+        if not self.idle_ttl:
+            return
+        now = time.monotonic()
+        for entry in list(self.loaded.values()):
+            idle = entry.in_use == 0 and not entry.pinned
+            if idle and now - entry.last_used > self.idle_ttl:
+                self._unload(entry.name, reason="idle")
+
+    async def _evict_idle_loop(self) -> None:
+        while any(not entry.pinned for entry in self.loaded.values()):
+            await asyncio.sleep(self.idle_ttl / 2)
+            self.evict_idle()
+
+    def memory_mb(self) -> float:
+        return sum(entry.memory_mb for entry in self.loaded.values())
+
+    def status(self) -> List[Dict]:
+        now = time.monotonic()
+        return [
+            {
+                "name": name,
+                "model_name": self.model_name(name),
+                "kind": self.kind(name),
+                "default": name == self.default_model,
+                "loaded": name in self.loaded,
+                "pinned": self.loaded[name].pinned if name in self.loaded else False,
+                "in_use": self.loaded[name].in_use if name in self.loaded else 0,
+                "idle_seconds": (
+                    round(now - self.loaded[name].last_used, 1)
+                    if name in self.loaded
+                    else None
+                ),
+                "memory_mb": self.configs[name].get("memory_mb", 0),
+            }
+            for name in self.configs
+        ]
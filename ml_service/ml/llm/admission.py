@@ -0,0 +1,235 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Optional, Tuple
+
+
+class AdmissionRejected(Exception):
+    """This Exception is raised when a request can not be admitted, the
+    caller should retry after `retry_after` seconds"""
+
+    def __init__(self, priority: str, reason: str, retry_after: int):
+        super().__init__(f"Priority class '{priority}' is {reason}, retry later")
+        self.retry_after = retry_after
+
+
+@dataclass
+class Ticket:
+    """Admitted request, has to be released once its generation is over"""
+
+    priority: str
+    tokens: int
+    admitted_at: float = field(default_factory=time.monotonic)
+    released: bool = False
+
+
+class PriorityClass:
+    """Budgets, fair queue and statistics of one priority class"""
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int = 32,
+        max_tokens: Optional[int] = None,
+        max_queue: int = 128,
+        max_wait: float = 30,
+        smoothing: float = 0.2,
+    ) -> None:
+        """Construct
+
+        Parameters
+        ----------
+        name : str
+            name of the class, e.g. interactive
+        max_concurrency : int, optional
+            requests of the class running in the engine, by default 32
+        max_tokens : Optional[int], optional
+            prompt plus max_tokens of the running requests, by default None
+        max_queue : int, optional
+            requests waiting for admission above which new ones are
+            rejected, by default 128
+        max_wait : float, optional
+            seconds a request waits for admission before it is rejected,
+            by default 30
+        smoothing : float, optional
+            weight of the newest request in the averages, by default 0.2
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_tokens = max_tokens
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.smoothing = smoothing
+
+        self.running = 0
+        self.tokens = 0
+        # one queue per user, served round robin
+        self.queues: "OrderedDict[str, Deque[Tuple[asyncio.Future, Ticket, float]]]" = (
+            OrderedDict()
+        )
+        self.queued = 0
+
+        self.admitted = 0
+        self.rejected = 0
+        self.avg_wait = 0.0
+        self.max_seen_wait = 0.0
+        self.avg_duration: Optional[float] = None
+
+    def fits(self, tokens: int) -> bool:
+        # a single request bigger than the token budget runs on an idle class
+        if self.running == 0:
+            return True
+        if self.running >= self.max_concurrency:
+            return False
+        return self.max_tokens is None or self.tokens + tokens <= self.max_tokens
+
+    def start(self, ticket: Ticket, wait: float) -> None:
+        self.running += 1
+        self.tokens += ticket.tokens
+        self.admitted += 1
+        ticket.admitted_at = time.monotonic()
+        self.avg_wait += self.smoothing * (wait - self.avg_wait)
+        self.max_seen_wait = max(self.max_seen_wait, wait)
+
+    def retry_after(self) -> int:
+        """seconds until the queue in front of a new request drained"""
+        if not self.avg_duration:
+            return 1
+        rounds = (self.queued + 1) / max(self.max_concurrency, 1)
+        return max(1, min(math.ceil(rounds * self.avg_duration), 60))
+
+    def stats(self) -> Dict:
+        return {
+            "running": self.running,
+            "tokens_in_flight": self.tokens,
+            "queued": self.queued,
+            "queued_users": len(self.queues),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait_seconds": round(self.avg_wait, 3),
+            "max_wait_seconds": round(self.max_seen_wait, 3),
+        }
+
+
+class PriorityScheduler:
+    """Admission control of the engine by priority class
+
+    Every class has its own concurrency and token budget, so a flood of
+    bulk requests can not take the engine away from interactive ones.
+    Requests which do not fit wait in a per-user queue of their class and
+    are admitted round robin across users, a full queue or a too long wait
+    rejects the request early with a Retry-After.
+    """
+
+    def __init__(self, classes: Dict[str, Dict], default_priority: str) -> None:
+        """Construct
+
+        Parameters
+        ----------
+        classes : Dict[str, Dict]
+            budgets of every class by name, see `PriorityClass`
+        default_priority : str
+            class of the requests which do not select one
+        """
+        if default_priority not in classes:
+            raise KeyError(f"Default priority '{default_priority}' has no config")
+        self.classes = {
+            name: PriorityClass(name, **config) for name, config in classes.items()
+        }
+        self.default_priority = default_priority
+
+    def resolve(self, priority: Optional[str]) -> str:
+        """Name of the class to use, raises KeyError for unknown classes"""
+        priority = priority or self.default_priority
+        if priority not in self.classes:
+            raise KeyError(priority)
+        return priority
+
+    async def acquire(
+        self, priority: str, user: str, tokens: int, max_wait: Optional[float] = None
+    ) -> Ticket:
+        """Wait until the request fits into the budgets of its class, at
+        most `max_wait` seconds if it is shorter than the class' limit
+
+        Raises
+        ------
+        AdmissionRejected
+            if the queue of the class is full or the wait exceeded `max_wait`
+        """
+        cls = self.classes[priority]
+        ticket = Ticket(priority=priority, tokens=tokens)
+        if cls.queued == 0 and cls.fits(tokens):
+            cls.start(ticket, wait=0)
+            return ticket
+
+        if cls.queued >= cls.max_queue:
+            cls.rejected += 1
+            raise AdmissionRejected(priority, "overloaded", cls.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        enqueued_at = time.monotonic()
+        cls.queues.setdefault(user, deque()).append((future, ticket, enqueued_at))
+        cls.queued += 1
+        try:
+            timeout = cls.max_wait if max_wait is None else min(cls.max_wait, max_wait)
+            await asyncio.wait_for(asyncio.shield(future), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            if not future.done():
+                self._dequeue(cls, user, future)
+                cls.rejected += 1
+                raise AdmissionRejected(priority, "overloaded", cls.retry_after())
+        except asyncio.CancelledError:
+            if future.done():
+                self.release(ticket)
+            else:
+                self._dequeue(cls, user, future)
+            raise
+        return ticket
+
+    def _dequeue(self, cls: PriorityClass, user: str, future: asyncio.Future) -> None:
+        queue = cls.queues.get(user)
+        for entry in list(queue or ()):
+            if entry[0] is future:
+                queue.remove(entry)
+                cls.queued -= 1
+        if queue is not None and not queue:
+            del cls.queues[user]
+        future.cancel()
+
+    def release(self, ticket: Ticket) -> None:
+        """Give the budget of a finished request back and admit waiters"""
+        if ticket.released:
+            return
+        ticket.released = True
+        cls = self.classes[ticket.priority]
+        cls.running -= 1
+        cls.tokens -= ticket.tokens
+        duration = time.monotonic() - ticket.admitted_at
+        cls.avg_duration = (
+            duration
+            if cls.avg_duration is None
+            else cls.avg_duration + cls.smoothing * (duration - cls.avg_duration)
+        )
+        self._dispatch(cls)
+
+    def _dispatch(self, cls: PriorityClass) -> None:
+        """Admit the head request of the users in round robin order while
+        they fit into the budgets"""
+        while cls.queues:
+            user, queue = next(iter(cls.queues.items()))
+            future, ticket, enqueued_at = queue[0]
+            if not cls.fits(ticket.tokens):
+                break
+            queue.popleft()
+            cls.queued -= 1
+            # the user goes to the back of the round
+            del cls.queues[user]
+            if queue:
+                cls.queues[user] = queue
+            cls.start(ticket, wait=time.monotonic() - enqueued_at)
+            future.set_result(None)
+
+    def stats(self) -> Dict[str, Dict]:
+        return {name: cls.stats() for name, cls in self.classes.items()}
@@ -0,0 +1,140 @@
+import hashlib
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, List, Optional, Tuple
+
+# vllm samples greedily below this temperature
+GREEDY_TEMPERATURE = 1e-5
+
+
+class CachedOutput:
+    """Finished generation of a request, replayed in the shape of vllm's
+    RequestOutput so that a cache hit goes through the same response code"""
+
+    __slots__ = ("prompt_len", "text", "token_ids", "finish_reason", "size")
+
+    def __init__(self, request_output: Any) -> None:
+        output = request_output.outputs[0]
+        self.prompt_len = len(request_output.prompt_token_ids)
+        self.text: str = output.text
+        self.token_ids = array("i", output.token_ids)
+        self.finish_reason: Optional[str] = output.finish_reason
+        self.size = (
+            sys.getsizeof(self.text)
+            + self.token_ids.itemsize * len(self.token_ids)
+            + sys.getsizeof(self)
+        )
+
+    async def replay(self) -> AsyncGenerator[Any, None]:
+        """Single output holding the whole generation"""
+        yield SimpleNamespace(
+            prompt_token_ids=range(self.prompt_len),
+            outputs=[
+                SimpleNamespace(
+                    text=self.text,
+                    token_ids=self.token_ids,
+                    finish_reason=self.finish_reason,
+                )
+            ],
+        )
+
+
+class ResponseCache:
+    """Exact-match cache of the outputs of deterministic requests
+
+    Requests are keyed by a hash of their prompt token ids and sampling
+    parameters, only greedy requests are cached as any other sampling
+    gives a different output on every run. The least recently used entries
+    are evicted once the entry or byte bound is exceeded, entries expire
+    after `ttl` seconds.
+    """
+
+    def __init__(
+        self, max_entries: int = 4096, max_bytes: int = 64 * 2**20, ttl: float = 3600
+    ) -> None:
+        """Construct
+
+        Parameters
+        ----------
+        max_entries : int, optional
+            entries kept in the cache, by default 4096
+        max_bytes : int, optional
+            size of the cached outputs in bytes, by default 64 MiB
+        ttl : float, optional
+            seconds an entry is served, by default 3600
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries: "OrderedDict[str, Tuple[float, CachedOutput]]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key(prompt_token_ids: List[int], sampling_params: Any) -> Optional[str]:
+        """Cache key of the request, None if its sampling is not deterministic"""
+        temperature = sampling_params.temperature
+        if temperature is None or temperature >= GREEDY_TEMPERATURE:
+            return None
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(array("i", prompt_token_ids).tobytes())
+        digest.update(repr(sampling_params).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[CachedOutput]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, output = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return output
+
+    def put(self, key: str, output: CachedOutput) -> None:
+        if output.size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, output)
+        self.bytes += output.size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, output = self._entries.pop(key)
+        self.bytes -= output.size
+
+    async def fill(
+        self, key: str, outputs: AsyncIterator[Any]
+    ) -> AsyncGenerator[Any, None]:
+        """Pass the outputs of a vllm request through and cache the last one
+        if the request finished, aborted requests are not cached"""
+        async for request_output in outputs:
+            finish_reason = request_output.outputs[0].finish_reason
+            if finish_reason is not None and finish_reason != "abort":
+                self.put(key, CachedOutput(request_output))
+            yield request_output
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
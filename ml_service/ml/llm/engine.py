@@ -0,0 +1,319 @@
+import asyncio
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Union
+
+try:
+    from vllm.engine.arg_utils import AsyncEngineArgs
+    from vllm.engine.async_llm_engine import AsyncLLMEngine
+    from vllm.sampling_params import SamplingParams
+
+    VLLM = True
+except ImportError:
+    VLLM = False
+
+try:
+    from transformers import AutoTokenizer
+
+    TRANSFORMERS = True
+except ImportError:
+    TRANSFORMERS = False
+
+
+class EngineBackend(ABC):
+    """Engine behind the LLMDeployment
+
+    The deployment tokenizes, formats, admits and streams requests, the
+    backend only turns prompt token ids into a stream of vllm
+    RequestOutput-like objects (`prompt_token_ids` and `outputs[0]` with
+    the `text`, `token_ids` and `finish_reason` generated so far).
+    """
+
+    # huggingface tokenizer of the model
+    tokenizer: Any
+
+    @abstractmethod
+    def sampling_params(self, **kwargs: Any) -> Any:
+        """Sampling parameters of a request, see vllm/sampling_params.py"""
+
+    @abstractmethod
+    def generate(
+        self,
+        prompt: str,
+        sampling_params: Any,
+        request_id: str,
+        prompt_token_ids: List[int],
+    ) -> AsyncIterator[Any]:
+        """Outputs of the request, every output holds everything generated
+        so far"""
+
+    @abstractmethod
+    async def abort(self, request_id: str) -> None:
+        """Stop generating the request"""
+
+    @abstractmethod
+    def warm_up(
+        self,
+        prompt: str,
+        prompt_token_ids: List[int],
+        sampling_params: Any,
+        request_id: str,
+    ) -> bool:
+        """Generate the request synchronously before the replica serves
+        traffic, False if the backend can not be warmed up this way"""
+
+    async def check_health(self) -> None:
+        """Raise if the backend stopped working and needs a restart"""
+
+
+class VLLMEngine(EngineBackend):
+    """vllm's AsyncLLMEngine"""
+
+    def __init__(self, serve_config: Dict[str, Any]) -> None:
+        """Construct
+
+        Parameters
+        ----------
+        serve_config : Dict[str, Any]
+            AsyncEngineArgs of the engine
+        """
+        if not VLLM:
+            raise ImportError("The vllm engine needs vllm to be installed")
+        self.engine_args = AsyncEngineArgs(**serve_config)
+        self.engine = AsyncLLMEngine.from_engine_args(self.engine_args)
+        # the engine holds a TokenizerGroup around the huggingface tokenizer
+        tokenizer = self.engine.engine.tokenizer
+        self.tokenizer = getattr(tokenizer, "tokenizer", tokenizer)
+
+    def __repr__(self) -> str:
+        return f"VLLMEngine({self.engine_args})"
+
+    def sampling_params(self, **kwargs: Any) -> "SamplingParams":
+        return SamplingParams(**kwargs)
+
+    def generate(
+        self,
+        prompt: str,
+        sampling_params: "SamplingParams",
+        request_id: str,
+        prompt_token_ids: List[int],
+    ) -> AsyncIterator[Any]:
+        return self.engine.generate(
+            prompt=prompt,
+            sampling_params=sampling_params,
+            request_id=request_id,
+            prompt_token_ids=prompt_token_ids,
+        )
+
+    async def abort(self, request_id: str) -> None:
+        await self.engine.abort(request_id=request_id)
+
+    async def check_health(self) -> None:
+        # raises AsyncEngineDeadError once the background loop has died
+        await self.engine.check_health()
+
+    def warm_up(
+        self,
+        prompt: str,
+        prompt_token_ids: List[int],
+        sampling_params: "SamplingParams",
+        request_id: str,
+    ) -> bool:
+        # the background loop of the AsyncLLMEngine only starts with the
+        # first request, until then the engine can be stepped directly
+        if self.engine.engine_use_ray:
+            return False
+        engine = self.engine.engine
+        engine.add_request(
+            request_id=request_id,
+            prompt=prompt,
+            sampling_params=sampling_params,
+            prompt_token_ids=prompt_token_ids,
+        )
+        while engine.has_unfinished_requests():
+            engine.step()
+        return True
+
+
+@dataclass
+class FakeSamplingParams:
+    """Sampling parameters accepted by the FakeEngine, only `max_tokens`
+    and `ignore_eos` change its output"""
+
+    max_tokens: Optional[int] = 16
+    temperature: float = 1.0
+    top_p: float = 1.0
+    top_k: int = -1
+    n: int = 1
+    best_of: Optional[int] = None
+    presence_penalty: float = 0.0
+    frequency_penalty: float = 0.0
+    repetition_penalty: float = 1.0
+    seed: Optional[int] = None
+    stop: Optional[Union[str, List[str]]] = None
+    ignore_eos: bool = False
+
+
+@dataclass
+class FakeCompletionOutput:
+    text: str = ""
+    token_ids: List[int] = field(default_factory=list)
+    finish_reason: Optional[str] = None
+
+
+@dataclass
+class FakeRequestOutput:
+    request_id: str
+    prompt: str
+    prompt_token_ids: List[int]
+    outputs: List[FakeCompletionOutput]
+    finished: bool = False
+
+
+class FakeEngine(EngineBackend):
+    """Deterministic engine which runs on CPU, to exercise and load-test
+    the serving layer without GPUs
+
+    The prompt is tokenized with the model's real tokenizer and echoed
+    back token by token, after `ttft` seconds for the first token and
+    `inter_token_latency` seconds for each following one. Requests beyond
+    `max_num_seqs` wait for a free sequence like in the engine's scheduler.
+    """
+
+    def __init__(
+        self,
+        tokenizer: str,
+        ttft: float = 0.2,
+        inter_token_latency: float = 0.03,
+        max_num_seqs: int = 256,
+        output_tokens: Optional[int] = None,
+    ) -> None:
+        """Construct
+
+        Parameters
+        ----------
+        tokenizer : str
+            name or path of the huggingface tokenizer
+        ttft : float, optional
+            seconds until the first token, by default 0.2
+        inter_token_latency : float, optional
+            seconds between two tokens, by default 0.03
+        max_num_seqs : int, optional
+            requests generated at the same time, by default 256
+        output_tokens : Optional[int], optional
+            tokens after which a request stops with `stop` unless it ignores
+            the eos, by default None (it runs until max_tokens)
+        """
+        if not TRANSFORMERS:
+            raise ImportError("The fake engine needs transformers to be installed")
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+        self.ttft = ttft
+        self.inter_token_latency = inter_token_latency
+        self.max_num_seqs = max_num_seqs
+        self.output_tokens = output_tokens
+
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._running: Set[str] = set()
+        self._aborted: Set[str] = set()
+
+    def __repr__(self) -> str:
+        return (
+            f"FakeEngine(tokenizer={self.tokenizer.name_or_path}, ttft={self.ttft}, "
+            f"inter_token_latency={self.inter_token_latency}, "
+            f"max_num_seqs={self.max_num_seqs})"
+        )
+
+    def sampling_params(self, **kwargs: Any) -> FakeSamplingParams:
+        return FakeSamplingParams(**kwargs)
+
+    def _output_token_ids(self, prompt_token_ids: List[int], n: int) -> List[int]:
+        """the prompt without special tokens, repeated to n tokens"""
+        special = set(self.tokenizer.all_special_ids)
+        tokens = [t for t in prompt_token_ids if t not in special] or [0]
+        return [tokens[i % len(tokens)] for i in range(n)]
+
+    def _finish_reason(self, sampling_params: FakeSamplingParams, n: int):
+        if self.output_tokens is not None and not sampling_params.ignore_eos:
+            if n >= self.output_tokens:
+                return "stop"
+        if sampling_params.max_tokens is not None and n >= sampling_params.max_tokens:
+            return "length"
+        return None
+
+    async def generate(
+        self,
+        prompt: str,
+        sampling_params: FakeSamplingParams,
+        request_id: str,
+        prompt_token_ids: List[int],
+    ) -> AsyncIterator[FakeRequestOutput]:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_num_seqs)
+
+        max_tokens = sampling_params.max_tokens or 16
+        if self.output_tokens is not None and not sampling_params.ignore_eos:
+            max_tokens = min(max_tokens, self.output_tokens)
+        token_ids = self._output_token_ids(prompt_token_ids, max_tokens)
+
+        output = FakeCompletionOutput()
+        request_output = FakeRequestOutput(
+            request_id=request_id,
+            prompt=prompt,
+            prompt_token_ids=prompt_token_ids,
+            outputs=[output],
+        )
+        self._running.add(request_id)
+        try:
+            async with self._slots:
+                await asyncio.sleep(self.ttft)
+                for position, token_id in enumerate(token_ids):
+                    if position:
+                        await asyncio.sleep(self.inter_token_latency)
+                    if request_id in self._aborted:
+                        return
+                    output.token_ids.append(token_id)
+                    output.text = self.tokenizer.decode(
+                        output.token_ids, skip_special_tokens=True
+                    )
+                    output.finish_reason = self._finish_reason(
+                        sampling_params, len(output.token_ids)
+                    )
+                    request_output.finished = output.finish_reason is not None
+                    yield request_output
+        finally:
+            self._running.discard(request_id)
+            self._aborted.discard(request_id)
+
+    async def abort(self, request_id: str) -> None:
+        if request_id in self._running:
+            self._aborted.add(request_id)
+
+    def warm_up(
+        self,
+        prompt: str,
+        prompt_token_ids: List[int],
+        sampling_params: FakeSamplingParams,
+        request_id: str,
+    ) -> bool:
+        # only the tokenizer can be warmed up
+        self._output_token_ids(prompt_token_ids, 1)
+        return True
+
+
+def load_engine(name: str, serve_config: Dict[str, Any], **kwargs: Any) -> EngineBackend:
+    """Build the engine backend selected by `llm.engine`
+
+    Parameters
+    ----------
+    name : str
+        `vllm` or `fake`
+    serve_config : Dict[str, Any]
+        AsyncEngineArgs of the vllm engine
+    kwargs : Any
+        arguments of the fake engine, see `FakeEngine`
+    """
+    if name == "vllm":
+        return VLLMEngine(serve_config)
+    if name == "fake":
+        return FakeEngine(**kwargs)
+    raise ValueError(f"Invalid engine '{name}'. Valid engines are: vllm, fake")
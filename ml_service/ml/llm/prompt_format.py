@@ -1,19 +1,21 @@
 # Adapted from:
 # https://github.com/ray-project/ray-llm/blob/master/rayllm/common/models.py
 
+from string import Formatter
 from typing import (
     Any,
     Dict,
     List,
     Literal,
     Optional,
+    Tuple,
     Type,
     TypeVar,
     Union,
 )
 
 import yaml
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, PrivateAttr, validator
 
 T = TypeVar("T")
 ModelT = TypeVar("ModelT", bound=BaseModel)
@@ -51,6 +53,8 @@ class PromptFormat(BaseModel):
     accept_sys_from_req: bool = False
     recursive_sys_prompt: bool = True
 
+    _renderer: "PromptRenderer" = PrivateAttr()
+
     @validator("assistant")
     def check_assistant(cls, value):
         assert (
@@ -65,6 +69,18 @@ class PromptFormat(BaseModel):
         ), "user must be a string containing '{instruction}'"
         return value
 
+    class Config:
+        # the compiled renderer is built from the fields, they must not change
+        allow_mutation = False
+
+    def __init__(self, **data: Any) -> None:
+        super().__init__(**data)
+        self._renderer = PromptRenderer(self)
+
+    @property
+    def renderer(self) -> "PromptRenderer":
+        return self._renderer
+
     def generate_prompt(self, messages: List[Message]) -> str:
         """Generate prompt from system messages
         
@@ -82,57 +98,133 @@ class PromptFormat(BaseModel):
         ------
             ValueError: If the input messages only contain a system message.
         """
-        
-        # Extract system message (if present)
-        system_message_index = -1
-        for i, message in enumerate(messages):
-            if message.role == "system":
-                if not self.accept_sys_from_req:
-                    KeyError("system prompt is not accepted from user")
-                system_message_index = i
-                break
-
-        if system_message_index != -1:
-            self.system = messages.pop(system_message_index).content
-        
-        messages.insert(0, Message(role='system', content=self.system))
+        return self._renderer.render(messages)
+
+    def generate_prompt_segments(self, messages: List[Message]) -> List[str]:
+        """Generate the prompt as the list of its rendered pieces, joined
+        they form the prompt of `generate_prompt`. Every piece but the last
+        ends with a rendered user turn (the system prompt and the first turn,
+        then each assistant turn with the following user turn), so the pieces
+        of a chat's earlier prompts are reused by its next turn and are split
+        right after the role tags of the template
 
-        if all(message.role == "system" for message in messages):
+        Parameters
+        ----------
+        messages: List[Message]
+            list of messages with OpenAI format
+
+        Returns
+        -------
+        segments: List[str]
+            rendered pieces of the prompt
+
+        Raises
+        ------
+            ValueError: If the input messages only contain a system message.
+        """
+        return self._renderer.render_segments(messages)
+
+
+class CompiledTemplate:
+    """Turn template (e.g. `USER: {system} {instruction} ASSISTANT:`) split
+    once into its literal text and fields, rendering only concatenates"""
+
+    __slots__ = ("parts",)
+
+    FIELDS = ("instruction", "system")
+
+    def __init__(self, template: str) -> None:
+        parts: List[Tuple[str, Optional[str]]] = []
+        for literal, field, spec, conversion in Formatter().parse(template):
+            if field is not None and field not in self.FIELDS:
+                raise ValueError(f"Unknown field '{field}' in template {template!r}")
+            if spec or conversion:
+                raise ValueError(f"Format specs are not supported: {template!r}")
+            parts.append((literal, field))
+        self.parts = tuple(parts)
+
+    def render(self, instruction: str, system: str = "") -> str:
+        pieces = []
+        for literal, field in self.parts:
+            pieces.append(literal)
+            if field == "instruction":
+                pieces.append(instruction)
+            elif field == "system":
+                pieces.append(system)
+        return "".join(pieces)
+
+
+class PromptRenderer:
+    """Pure renderer of a PromptFormat, templates are compiled once and the
+    messages are rendered in a single pass without being modified, so one
+    renderer is shared by all requests (and threads) of a replica.
+
+    The system prompt of a request replaces the configured one for that
+    request only, if the format accepts system prompts from requests.
+    """
+
+    def __init__(self, prompt_format: PromptFormat) -> None:
+        self.system = prompt_format.system
+        self.user = CompiledTemplate(prompt_format.user)
+        self.assistant = CompiledTemplate(prompt_format.assistant)
+        self.trailing_assistant = prompt_format.trailing_assistant
+        self.system_in_user = prompt_format.system_in_user
+        self.strip_whitespace = prompt_format.strip_whitespace
+        self.accept_sys_from_req = prompt_format.accept_sys_from_req
+
+    def render_segments(self, messages: List[Message]) -> List[str]:
+        """Rendered pieces of the prompt, see `PromptFormat.generate_prompt_segments`"""
+        system = self.system
+        system_seen = False
+        first: Optional[str] = None
+        # the first turn is rendered once the system prompt is known
+        segments: List[str] = [""]
+        turns: List[str] = []
+        for message in messages:
+            role = message.role
+            if role == "system":
+                if not system_seen and self.accept_sys_from_req:
+                    system = message.content
+                system_seen = True
+            elif first is None:
+                first = message.content
+            else:
+                content = message.content
+                if self.strip_whitespace:
+                    content = content.strip()
+                if role == "user":
+                    turns.append(self.user.render(content))
+                    # a segment ends after the role tag of the user template
+                    segments.append("".join(turns))
+                    turns.clear()
+                else:
+                    turns.append(self.assistant.render(content))
+
+        if first is None:
             raise ValueError("Only System messages are not allowed")
-        
-        prompt = []
-        
         if self.system_in_user:
-            prompt.append(
-                self.user.format(
-                    system=messages[0].content,
-                    instruction=messages[1].content,
-                )
-            )
+            segments[0] = self.user.render(first, system)
         else:
-            prompt.append(messages[0].content)
-            prompt.append(
-                self.user.format(
-                    instruction=messages[1].content
-                )
-            )
-
-        for message in messages[2:]:
-            message_content = message.content
-            if self.strip_whitespace:
-                message_content = message_content.strip()
-            
-            if message.role == "user":
-                if self.system_in_user:
-                    user_prompt = self.user.format(instruction=message_content, system="")    
-                else:
-                    user_prompt = self.user.format(instruction=message_content)
-                prompt.append(user_prompt)
-            elif message.role == "assistant":
-                prompt.append(self.assistant.format(instruction=message_content))
-        
-        prompt.append(self.trailing_assistant)
-        return "".join(prompt)
+            segments[0] = system + self.user.render(first)
+        turns.append(self.trailing_assistant)
+        segments.append("".join(turns))
+        return segments
+
+    def render(self, messages: List[Message]) -> str:
+        """Prompt of the messages, see `PromptFormat.generate_prompt`"""
+        return "".join(self.render_segments(messages))
+
+    def render_segments_batch(
+        self, conversations: List[List[Message]]
+    ) -> List[List[str]]:
+        """Rendered pieces of the prompts of many conversations"""
+        render_segments = self.render_segments
+        return [render_segments(messages) for messages in conversations]
+
+    def render_batch(self, conversations: List[List[Message]]) -> List[str]:
+        """Prompts of many conversations"""
+        render = self.render
+        return [render(messages) for messages in conversations]
 
 
 class ModelConfig(BaseModelExtended):
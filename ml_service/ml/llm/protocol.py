@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import Dict, List, Literal, Optional, Union
 from pydantic import BaseModel
 from ml.llm.prompt_format import Message
 
@@ -11,6 +11,10 @@ class GenerateRequest(BaseModel):
         prompt -> str: Prompt to use for this generation
         messages -> List[Message]: List of messages to use for this generation
         stream -> Bool: flag whether to stream the output or not
+        stream_format -> str: `full` streams a GenerateResponse per flush,
+            `delta` streams `{"output": ..}` text deltas followed by a single
+            `{"prompt_tokens": .., "output_tokens": .., "finish_reason": ..}`
+            frame
         max_tokens -> int: Maximum number of tokens to generate per output sequence
         temperature -> float: Controls the randomness of the sampling.
             Lower temperature results in less random completions. As the
@@ -19,6 +23,17 @@ class GenerateRequest(BaseModel):
         ignore_eos -> bool: Whether to ignore EOS token when generating
             output. Default to True as we always want to generate the full
             sequence.
+        flush_interval -> float: Max seconds a streamed token is held back
+        flush_tokens -> int: Max number of streamed tokens held back
+        flush_bytes -> int: Max size of the held back streamed text in bytes
+            (the deployment's `stream` config is used for unset limits)
+        priority -> str: Priority class of the request, e.g. interactive
+        user -> str: Requests of a priority class are queued fairly per user
+        context -> List[str]: Retrieved chunks, most relevant first, rendered
+            in front of the last user message
+        truncation -> List[str]: Strategies applied in order if the prompt
+            does not fit the context window, see `ml.llm.truncation` (the
+            deployment's `truncation` config is used if not set)
 
         Sampling parameters
         -------------------
@@ -28,9 +43,34 @@ class GenerateRequest(BaseModel):
     prompt: Optional[str]
     messages: Optional[List[Message]]
     stream: Optional[bool] = False
+    stream_format: Optional[Literal["full", "delta"]] = "full"
     max_tokens: Optional[int] = 128
     temperature: Optional[float] = 0.7
     ignore_eos: Optional[bool] = False
+    flush_interval: Optional[float] = None
+    flush_tokens: Optional[int] = None
+    flush_bytes: Optional[int] = None
+    priority: Optional[str] = None
+    user: Optional[str] = None
+    context: Optional[List[str]] = None
+    truncation: Optional[List[str]] = None
+
+
+class TruncationReport(BaseModel):
+    """What was dropped to fit the prompt into the context window
+
+    Attributes
+    ----------
+        strategies -> List[str]: Strategies which dropped something
+        dropped_messages -> int: Number of dropped messages
+        dropped_context -> int: Number of dropped retrieved chunks
+        dropped_tokens -> int: Number of prompt tokens saved
+    """
+
+    strategies: List[str] = []
+    dropped_messages: int = 0
+    dropped_context: int = 0
+    dropped_tokens: int = 0
 
 
 class GenerateResponse(BaseModel):
@@ -42,9 +82,219 @@ class GenerateResponse(BaseModel):
         prompt_tokens -> int: Number of tokens in the prompt
         output_tokens -> int: Number of generated tokens
         finish_reason -> str: Reason the genertion has finished
+        truncation -> TruncationReport: What was dropped from the prompt,
+            only set on the first streamed response
     """
 
     output: str
     prompt_tokens: int
     output_tokens: int
     finish_reason: Optional[str]
+    truncation: Optional[TruncationReport] = None
+
+
+class BatchGenerateRequest(BaseModel):
+    """Batch of completions for offline jobs
+
+    Attributes
+    ----------
+        items -> List[GenerateRequest]: prompts or messages, each with its own
+            sampling parameters (`stream` and the flush limits are ignored)
+    """
+
+    items: List[GenerateRequest]
+
+
+class BatchItemResponse(BaseModel):
+    """Result of one item of a batch, streamed as soon as the item finished
+
+    Attributes
+    ----------
+        index -> int: Position of the item in the batch
+        output -> str: Model output, None if the item failed
+        prompt_tokens -> int: Number of tokens in the prompt
+        output_tokens -> int: Number of generated tokens
+        finish_reason -> str: Reason the genertion has finished
+        error -> str: Why the item failed, None if it succeeded
+        truncation -> TruncationReport: What was dropped from the prompt
+    """
+
+    index: int
+    output: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    finish_reason: Optional[str] = None
+    error: Optional[str] = None
+    truncation: Optional[TruncationReport] = None
+
+
+class BatchSummary(BaseModel):
+    """Last line of a batch response
+
+    Attributes
+    ----------
+        total -> int: Number of items in the batch
+        succeeded -> int: Number of items with an output
+        failed -> List[int]: Indices of the items which failed
+    """
+
+    total: int
+    succeeded: int
+    failed: List[int]
+
+
+class StreamOptions(BaseModel):
+    """OpenAI stream options
+
+    Attributes
+    ----------
+        include_usage -> bool: Whether a last chunk with the token usage and
+            no choices is streamed before `data: [DONE]`
+    """
+
+    include_usage: Optional[bool] = True
+
+
+class OpenAIRequest(BaseModel):
+    """Fields shared by the OpenAI compatible completion requests, unknown
+    fields (e.g. `user`, `logit_bias`) are ignored
+
+    Attributes
+    ----------
+        model -> str: Name of the model, only the served model is accepted
+        max_tokens -> int: Maximum number of tokens to generate, fills the
+            context window of the model if not set
+        temperature -> float: Sampling temperature
+        top_p -> float: Nucleus sampling probability mass
+        n -> int: Number of choices, only 1 is supported
+        stop -> Union[str, List[str]]: Sequences where the generation stops
+        presence_penalty -> float: Penalizes tokens which were generated
+        frequency_penalty -> float: Penalizes tokens by their frequency
+        seed -> int: Random seed of the sampling
+        stream -> bool: Stream the deltas as server-sent events
+        stream_options -> StreamOptions: Options of the stream
+        priority -> str: Priority class of the request, e.g. interactive
+        user -> str: Requests of a priority class are queued fairly per user
+        truncation -> List[str]: Strategies applied in order if the prompt
+            does not fit the context window
+    """
+
+    model: Optional[str]
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = 1.0
+    top_p: Optional[float] = 1.0
+    n: Optional[int] = 1
+    stop: Optional[Union[str, List[str]]] = None
+    presence_penalty: Optional[float] = 0.0
+    frequency_penalty: Optional[float] = 0.0
+    seed: Optional[int] = None
+    stream: Optional[bool] = False
+    stream_options: Optional[StreamOptions] = None
+    priority: Optional[str] = None
+    user: Optional[str] = None
+    truncation: Optional[List[str]] = None
+
+    def sampling_params(self) -> Dict:
+        """Keyword arguments of vllm's SamplingParams, OpenAI clients send
+        `null` for unset fields which falls back to the field's default"""
+        params = {
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "stop": self.stop,
+            "presence_penalty": self.presence_penalty,
+            "frequency_penalty": self.frequency_penalty,
+            "seed": self.seed,
+        }
+        for name in ("temperature", "top_p", "presence_penalty", "frequency_penalty"):
+            if params[name] is None:
+                params[name] = self.__fields__[name].default
+        return params
+
+
+class ChatCompletionRequest(OpenAIRequest):
+    """OpenAI compatible chat completion request
+
+    Attributes
+    ----------
+        messages -> List[Message]: Conversation rendered with the model's
+            prompt format
+    """
+
+    messages: List[Message]
+
+
+class CompletionRequest(OpenAIRequest):
+    """OpenAI compatible completion request
+
+    Attributes
+    ----------
+        prompt -> str: Raw prompt, the prompt format is not applied
+    """
+
+    prompt: str
+
+
+class UsageInfo(BaseModel):
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+
+
+class ChatMessage(BaseModel):
+    role: str
+    content: str
+
+
+class DeltaMessage(BaseModel):
+    role: Optional[str] = None
+    content: Optional[str] = None
+
+
+class ChatCompletionChoice(BaseModel):
+    index: int
+    message: ChatMessage
+    finish_reason: Optional[str]
+
+
+class ChatCompletionStreamChoice(BaseModel):
+    index: int
+    delta: DeltaMessage
+    finish_reason: Optional[str] = None
+
+
+class CompletionChoice(BaseModel):
+    index: int
+    text: str
+    finish_reason: Optional[str] = None
+
+
+class ChatCompletionResponse(BaseModel):
+    id: str
+    object: str = "chat.completion"
+    created: int
+    model: str
+    choices: List[ChatCompletionChoice]
+    usage: UsageInfo
+    truncation: Optional[TruncationReport] = None
+
+
+class ChatCompletionStreamResponse(BaseModel):
+    id: str
+    object: str = "chat.completion.chunk"
+    created: int
+    model: str
+    choices: List[ChatCompletionStreamChoice]
+    usage: Optional[UsageInfo] = None
+    truncation: Optional[TruncationReport] = None
+
+
+class CompletionResponse(BaseModel):
+    """Completion response, also used for the streamed chunks"""
+
+    id: str
+    object: str = "text_completion"
+    created: int
+    model: str
+    choices: List[CompletionChoice]
+    usage: Optional[UsageInfo] = None
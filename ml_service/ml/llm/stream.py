@@ -0,0 +1,187 @@
+import asyncio
+import dataclasses
+import json
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, Optional, Tuple
+
+try:
+    import orjson
+
+    ORJSON = True
+except ImportError:
+    ORJSON = False
+
+# finish reason of the last frame of a stream cut off at its deadline, the
+# output is incomplete and must not be used as an answer
+DEADLINE_FINISH_REASON = "deadline"
+
+
+def encode_frame(frame: Dict[str, Any]) -> bytes:
+    """NDJSON line of a compact stream frame, with orjson if installed"""
+    if ORJSON:
+        return orjson.dumps(frame) + b"\n"
+    line = json.dumps(frame, ensure_ascii=False, separators=(",", ":"))
+    return (line + "\n").encode("utf-8")
+
+
+@dataclass(frozen=True)
+class FlushPolicy:
+    """When a streamed response sends the text generated so far
+
+    The first token is always sent immediately, after that the pending
+    tokens are sent as soon as any one of the limits is reached.
+
+    Attributes
+    ----------
+        flush_interval -> float: max seconds a generated token is held back
+        flush_tokens -> int: max number of tokens held back
+        flush_bytes -> int: max size of the held back text in bytes
+    """
+
+    flush_interval: float = 0.5
+    flush_tokens: int = 16
+    flush_bytes: int = 512
+
+    def override(self, **overrides: Optional[float]) -> "FlushPolicy":
+        """Policy with the limits which are not None replaced"""
+        overrides = {k: v for k, v in overrides.items() if v is not None}
+        return dataclasses.replace(self, **overrides) if overrides else self
+
+    def should_flush(self, tokens: int, num_bytes: int, elapsed: float) -> bool:
+        return (
+            tokens >= self.flush_tokens
+            or num_bytes >= self.flush_bytes
+            or elapsed >= self.flush_interval
+        )
+
+
+async def coalesce(
+    outputs: AsyncIterator[Any], policy: FlushPolicy
+) -> AsyncGenerator[Tuple[Any, str, int], None]:
+    """Group the outputs of a vllm request into flushes
+
+    The time limit holds even while the engine produces no new output,
+    the next output is awaited with a timeout instead of being polled.
+
+    Parameters
+    ----------
+    outputs : AsyncIterator[Any]
+        RequestOutput generator of the engine
+    policy : FlushPolicy
+        limits of a flush
+
+    Yields
+    ------
+    Tuple[Any, str, int]
+        latest RequestOutput, the text and the number of tokens generated
+        since the previous flush
+    """
+    iterator = outputs.__aiter__()
+    next_output: Optional[asyncio.Future] = None
+    request_output = None
+    last_sent = None
+    num_returned = 0  # characters of the text already sent
+    tokens_returned = 0
+    last_flush: Optional[float] = None
+
+    def pending() -> Tuple[str, int]:
+        output = request_output.outputs[0]
+        return output.text[num_returned:], len(output.token_ids) - tokens_returned
+
+    try:
+        while True:
+            if next_output is None:
+                next_output = asyncio.ensure_future(iterator.__anext__())
+
+            timeout = None
+            if request_output is not None and last_flush is not None:
+                _, tokens = pending()
+                if tokens:
+                    elapsed = time.monotonic() - last_flush
+                    timeout = max(policy.flush_interval - elapsed, 0)
+
+            done, _ = await asyncio.wait({next_output}, timeout=timeout)
+            if done:
+                try:
+                    request_output = next_output.result()
+                except StopAsyncIteration:
+                    next_output = None
+                    break
+                next_output = None
+
+            text, tokens = pending()
+            finished = request_output.outputs[0].finish_reason is not None
+            # nothing was sent yet, the first token goes out immediately
+            first = last_flush is None and tokens > 0
+            elapsed = 0 if last_flush is None else time.monotonic() - last_flush
+            if tokens and (
+                first
+                or finished
+                or policy.should_flush(tokens, len(text.encode("utf-8")), elapsed)
+            ):
+                yield request_output, text, tokens
+                last_sent = request_output
+                num_returned += len(text)
+                tokens_returned += tokens
+                last_flush = time.monotonic()
+
+        # stream whatever is left, e.g. the finish reason of the last output
+        if request_output is not None and request_output is not last_sent:
+            text, tokens = pending()
+            yield request_output, text, tokens
+    finally:
+        if next_output is not None:
+            next_output.cancel()
+
+
+@dataclass
+class GenerationProgress:
+    """What an engine request generated so far, shared between its output
+    stream and the response which has to abort it if the client went away
+
+    Attributes
+    ----------
+        request_id -> str: id of the engine request
+        max_tokens -> int: token budget of the request
+        prompt_tokens -> int: tokens of the prompt
+        output_tokens -> int: tokens generated so far
+        finished -> bool: whether the engine finished the request
+        aborted -> bool: whether the request was aborted
+        deadline -> float: monotonic time at which the caller gives up
+        deadline_exceeded -> bool: whether the outputs stopped at the deadline
+    """
+
+    request_id: str
+    max_tokens: Optional[int] = None
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    finished: bool = False
+    aborted: bool = False
+    deadline: Optional[float] = None
+    deadline_exceeded: bool = False
+
+
+async def track(
+    outputs: AsyncIterator[Any], progress: GenerationProgress
+) -> AsyncGenerator[Any, None]:
+    """Pass the outputs of a vllm request through, recording its progress.
+    The outputs stop once the deadline of the request passed, the request
+    still has to be aborted by the caller"""
+    iterator = outputs.__aiter__()
+    while True:
+        try:
+            if progress.deadline is None:
+                request_output = await iterator.__anext__()
+            else:
+                timeout = max(progress.deadline - time.monotonic(), 0)
+                request_output = await asyncio.wait_for(iterator.__anext__(), timeout)
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            progress.deadline_exceeded = True
+            return
+        output = request_output.outputs[0]
+        progress.output_tokens = len(output.token_ids)
+        progress.finished = output.finish_reason is not None
+        yield request_output
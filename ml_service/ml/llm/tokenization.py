@@ -0,0 +1,152 @@
+import asyncio
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.loggers import Logger
+
+# encoded in front of every segment but the first and stripped again, so
+# that sentencepiece tokenizers (llama, yi, mistral) do not add the prefix
+# space they put at the start of a text
+CONTINUATION_PREFIX = "\n"
+
+
+class PromptTokenizer:
+    """Tokenizes prompts on a thread pool, off the replica's event loop
+
+    Prompts are tokenized segment by segment (system prompt, every rendered
+    turn, ..) and the token ids of every segment are cached, so a new turn
+    of a chat only tokenizes the text which was not seen before. Tokenizing
+    segments separately is only exact if the tokenizer does not merge
+    tokens across the segment boundaries, `verify` checks that for the
+    prompt format and whole prompts are cached otherwise.
+
+    Only the first segment gets the special tokens (e.g. BOS), the others
+    are encoded as a continuation of the text in front of them.
+    """
+
+    def __init__(
+        self,
+        tokenizer: Any,
+        max_workers: int = 1,
+        max_cached_tokens: int = 4_000_000,
+        logger: Optional[Logger] = None,
+    ) -> None:
+        """Construct
+
+        Parameters
+        ----------
+        tokenizer : Any
+            huggingface tokenizer of the engine
+        max_workers : int, optional
+            threads tokenizing prompts, by default 1
+        max_cached_tokens : int, optional
+            token ids kept in the cache (4 bytes each), by default 4_000_000
+        logger : Optional[Logger], optional
+            reports why `verify` falls back to whole prompts, by default None
+        """
+        self.tokenizer = tokenizer
+        self.logger = logger
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="tokenize"
+        )
+        self.max_cached_tokens = max_cached_tokens
+        self.segmented = True
+
+        self._prefix_ids: List[int] = tokenizer.encode(
+            CONTINUATION_PREFIX, add_special_tokens=False
+        )
+        self._cache: "OrderedDict[Tuple[bool, str], array]" = OrderedDict()
+        self._cached_tokens = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key: Tuple[bool, str]):
+        with self._lock:
+            ids = self._cache.get(key)
+            if ids is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return ids
+
+    def _put(self, key: Tuple[bool, str], ids: array) -> None:
+        if len(ids) > self.max_cached_tokens:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = ids
+            self._cached_tokens += len(ids)
+            while self._cached_tokens > self.max_cached_tokens:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_tokens -= len(evicted)
+
+    def _encode_segment(self, segment: str, first: bool) -> List[int]:
+        if first:
+            return self.tokenizer.encode(segment, add_special_tokens=True)
+        ids = self.tokenizer.encode(
+            CONTINUATION_PREFIX + segment, add_special_tokens=False
+        )
+        prefix = len(self._prefix_ids)
+        if ids[:prefix] == self._prefix_ids:
+            return ids[prefix:]
+        # the prefix merged into the segment
+        return self.tokenizer.encode(segment, add_special_tokens=False)
+
+    def encode_sync(self, segments: List[str]) -> List[int]:
+        """Token ids of the concatenated segments, only the first segment
+        gets the special tokens (e.g. BOS) of the tokenizer"""
+        if not self.segmented:
+            segments = ["".join(segments)]
+
+        input_ids: List[int] = []
+        for position, segment in enumerate(segments):
+            if not segment:
+                continue
+            # the first segment carries the special tokens, so it is cached apart
+            key = (position == 0, segment)
+            ids = self._get(key)
+            if ids is None:
+                ids = array("i", self._encode_segment(segment, key[0]))
+                self._put(key, ids)
+            input_ids.extend(ids)
+        return input_ids
+
+    async def encode(self, segments: List[str]) -> List[int]:
+        """Token ids of the concatenated segments, tokenized on the pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.encode_sync, segments)
+
+    def verify(self, segments: List[str]) -> bool:
+        """Check that tokenizing the segments separately gives the token ids
+        of the whole prompt, whole prompts are cached from now on if not"""
+        self.segmented = True
+        segmented = self.encode_sync(segments)
+        whole = self.tokenizer.encode("".join(segments))
+        self.segmented = segmented == whole
+        if not self.segmented and self.logger is not None:
+            position = next(
+                (i for i, (a, b) in enumerate(zip(segmented, whole)) if a != b),
+                min(len(segmented), len(whole)),
+            )
+            self.logger.warning(
+                "Tokens merge across the segments of the prompt format, caching "
+                f"the token ids of whole prompts only (first difference at token "
+                f"{position}: {segmented[position:position + 4]} segmented, "
+                f"{whole[position:position + 4]} whole)"
+            )
+        return self.segmented
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "segmented": self.segmented,
+            "entries": len(self._cache),
+            "cached_tokens": self._cached_tokens,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,102 @@
+from typing import List, Optional, Tuple
+
+from ml.llm.prompt_format import Message
+
+TRUNCATION_STRATEGIES = ["trim_context", "keep_last", "drop_oldest"]
+
+Conversation = Tuple[List[Message], List[str]]
+
+
+def render_context(
+    messages: List[Message], context: List[str], template: str, chunk_template: str
+) -> List[Message]:
+    """Put the retrieved chunks in front of the last user message
+
+    Parameters
+    ----------
+    messages : List[Message]
+        conversation, it is not modified
+    context : List[str]
+        retrieved chunks, most relevant first
+    template : str
+        format of the last user message with `{context}` and `{message}`
+    chunk_template : str
+        format of a chunk with `{index}` (starting at 1) and `{chunk}`
+
+    Returns
+    -------
+    List[Message]
+        copy of the conversation with the context rendered
+    """
+    messages = list(messages)
+    if not context:
+        return messages
+
+    rendered = "".join(
+        chunk_template.format(index=index, chunk=chunk)
+        for index, chunk in enumerate(context, start=1)
+    )
+    for position in range(len(messages) - 1, -1, -1):
+        if messages[position].role == "user":
+            messages[position] = Message(
+                role="user",
+                content=template.format(
+                    context=rendered, message=messages[position].content
+                ),
+            )
+            break
+    return messages
+
+
+def _turns(messages: List[Message]) -> List[int]:
+    """positions of the messages which are not system messages"""
+    return [i for i, message in enumerate(messages) if message.role != "system"]
+
+
+def _drop(messages: List[Message], positions: List[int]) -> List[Message]:
+    dropped = set(positions)
+    kept = [message for i, message in enumerate(messages) if i not in dropped]
+    # a conversation restarts with a user message after the system prompt
+    turns = _turns(kept)
+    while len(turns) > 1 and kept[turns[0]].role == "assistant":
+        del kept[turns[0]]
+        turns = _turns(kept)
+    return kept
+
+
+def truncate(
+    strategy: str, messages: List[Message], context: List[str], keep_last_turns: int
+) -> Optional[Conversation]:
+    """Apply one step of the strategy to the conversation
+
+    trim_context drops the least relevant retrieved chunk, keep_last keeps
+    the system prompt and the last `keep_last_turns` messages and
+    drop_oldest drops the oldest turn. The system prompt and the last
+    message are always kept.
+
+    Returns
+    -------
+    Optional[Conversation]
+        shorter conversation, None if the strategy can not drop anything
+    """
+    if strategy == "trim_context":
+        if not context:
+            return None
+        return messages, context[:-1]
+
+    turns = _turns(messages)
+    if strategy == "keep_last":
+        keep = max(keep_last_turns, 1)
+        if len(turns) <= keep:
+            return None
+        return _drop(messages, turns[:-keep]), context
+
+    if strategy == "drop_oldest":
+        if len(turns) <= 1:
+            return None
+        return _drop(messages, turns[:1]), context
+
+    raise ValueError(
+        f"Invalid truncation strategy '{strategy}'. "
+        f"Valid strategies are: {', '.join(TRUNCATION_STRATEGIES)}"
+    )
@@ -0,0 +1,276 @@
+import asyncio
+import os
+import time
+import numpy as np
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from ray.serve import Application
+from fastapi import FastAPI
+from ray import serve
+from starlette.responses import JSONResponse, Response
+from starlette.requests import Request
+from utils.base import load_env
+from utils.loggers import Logger, load_loggers
+from utils.parsers import DictObjectParser, YamlParser
+from utils.exception import ConfigFileMissingError
+from ml.emb.batching import DynamicBatcher, length_sorted_order, restore_order
+from ml.emb.registry import ModelRegistry
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi.exceptions import RequestValidationError
+from utils.http import create_error_response
+from http import HTTPStatus
+
+try:
+    from fastembed.rerank.cross_encoder import TextCrossEncoder
+
+    CROSS_ENCODER = True
+except ImportError:
+    CROSS_ENCODER = False
+
+# FastAPI app
+APP = FastAPI()
+
+Pair = Tuple[str, str]
+
+
+@APP.exception_handler(RequestValidationError)
+async def validation_exception_handler(
+    request: Request, exc: RequestValidationError
+) -> JSONResponse:
+    return create_error_response(HTTPStatus.BAD_REQUEST, str(exc))
+
+
+@serve.deployment()
+@serve.ingress(app=APP)
+class RerankDeployment:
+    """Cross-Encoder Rerank Deployment Class"""
+
+    def __init__(self, config: DictObjectParser, logger: Logger):
+        """Construct
+
+        Parameters
+        ----------
+        config : DictObjectParser
+            contains config for the deployment of the cross-encoders
+        logger : Logger
+            object which will be used for logging
+        """
+        self.logger = logger
+        self.logger.info("Rerank Deployment Initialized")
+
+        # a missing cross-encoder can not be fixed by restarting the replica,
+        # the deployment fails once (DEPLOY_FAILED) instead
+        if not CROSS_ENCODER:
+            raise ImportError("Reranking needs fastembed with TextCrossEncoder")
+
+        # replica only reports ready once the models are warm
+        self.ready = False
+        self.warm_up_timings: Dict[str, float] = {}
+
+        registry = config.registry.to_dict() if hasattr(config, "registry") else {}
+        self.registry = ModelRegistry(
+            models=config.models.to_dict(),
+            default_model=config.default_model,
+            loaders={"cross-encoder": TextCrossEncoder},
+            logger=self.logger,
+            idle_ttl=registry.get("idle_ttl"),
+            max_memory_mb=registry.get("max_memory_mb"),
+        )
+        for name in registry.get("preload", [config.default_model]):
+            self.registry.load_sync(name)
+
+        # onnxruntime releases the GIL, so inference runs on a thread pool
+        # instead of blocking the replica's event loop
+        executor = config.executor.to_dict() if hasattr(config, "executor") else {}
+        self.workers: int = executor.get("workers", 1)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="rerank"
+        )
+
+        batching = config.batching.to_dict() if hasattr(config, "batching") else {}
+        self.batching = batching
+        self.bucket_size: int = batching.get("bucket_size", 16)
+        self.batchers: Dict[str, DynamicBatcher] = {}
+
+        self._warm_up(config.warm_up.to_dict() if hasattr(config, "warm_up") else {})
+
+    def _warm_up(self, warm_up: Dict) -> None:
+        """Score a representative pair with every loaded model on every
+        executor thread before Ray routes traffic to the replica"""
+        if not warm_up.get("enabled", True):
+            self.ready = True
+            return
+
+        query = warm_up.get("query") or "What is a binary search tree?"
+        passage = warm_up.get("passage") or " ".join(["warm up"] * 256)
+        try:
+            for name, entry in list(self.registry.loaded.items()):
+                start = time.perf_counter()
+                futures = [
+                    self.executor.submit(
+                        self._score_sync, entry.model, [(query, passage)]
+                    )
+                    for _ in range(self.workers)
+                ]
+                for future in futures:
+                    future.result()
+                self.warm_up_timings[name] = round(time.perf_counter() - start, 3)
+            self.ready = True
+        except Exception:
+            self.logger.error("Warm-up failed, replica is not ready", exc_info=True)
+
+        self.logger.info(f"Warm-up finished: {self.warm_up_timings}")
+
+    def _batcher(self, model: str) -> DynamicBatcher:
+        """one batcher per model, pairs of concurrent requests are scored
+        together whatever their query"""
+        if model not in self.batchers:
+            self.batchers[model] = DynamicBatcher(
+                handler=partial(self._score, model),
+                max_batch_size=self.batching.get("max_batch_size", 64),
+                max_wait_time=self.batching.get("max_wait_time", 0.01),
+                max_concurrent_batches=self.workers,
+            )
+        return self.batchers[model]
+
+    def _score_sync(self, model: Any, pairs: List[Pair]) -> List[float]:
+        """Score a merged batch of (query, passage) pairs
+
+        Pairs are sorted by length so that the onnx calls pad as little as
+        possible, then the original order is restored
+        """
+        order = length_sorted_order([len(q) + len(p) for q, p in pairs])
+        sorted_pairs = [pairs[i] for i in order]
+
+        if hasattr(model, "rerank_pairs"):
+            scores = list(
+                model.rerank_pairs(sorted_pairs, batch_size=self.bucket_size)
+            )
+        else:
+            # older cross-encoders only score one query against its passages
+            positions: Dict[str, List[int]] = defaultdict(list)
+            for position, (query, _) in enumerate(sorted_pairs):
+                positions[query].append(position)
+            scores = [0.0] * len(sorted_pairs)
+            for query, indices in positions.items():
+                passages = [sorted_pairs[i][1] for i in indices]
+                results = model.rerank(query, passages, batch_size=self.bucket_size)
+                for i, score in zip(indices, results):
+                    scores[i] = score
+
+        return restore_order([float(score) for score in scores], order)
+
+    async def _score(self, model: str, pairs: List[Pair]) -> List[float]:
+        """Run the inference on the executor"""
+        loop = asyncio.get_running_loop()
+        async with self.registry.use(model) as instance:
+            return await loop.run_in_executor(
+                self.executor, self._score_sync, instance, pairs
+            )
+
+    @APP.get("/health")
+    async def health(self) -> Response:
+        """Health check endpoint."""
+        return Response(status_code=200)
+
+    @APP.get("/ready")
+    async def readiness(self) -> JSONResponse:
+        """Readiness endpoint, succeeds only after the warm-up."""
+        return JSONResponse(
+            status_code=200 if self.ready else 503,
+            content={"ready": self.ready, "warm_up": self.warm_up_timings},
+        )
+
+    @APP.get("/models")
+    async def models(self) -> JSONResponse:
+        """Configured models and which of them are currently loaded."""
+        self.registry.evict_idle()
+        return JSONResponse(
+            content={
+                "models": self.registry.status(),
+                "memory_mb": self.registry.memory_mb(),
+            }
+        )
+
+    def _validate(self, data: Dict) -> Tuple[str, List[str], Optional[int]]:
+        query, passages = data.get("query"), data.get("passages")
+        if not isinstance(query, str) or not query:
+            detail = "query must be a non empty string"
+            raise RequestValidationError(
+                [{"loc": ("query", "query"), "msg": detail, "type": "value_error"}]
+            )
+        if not isinstance(passages, list) or not all(
+            isinstance(passage, str) for passage in passages
+        ):
+            detail = "passages must be a list of strings"
+            raise RequestValidationError(
+                [{"loc": ("query", "passages"), "msg": detail, "type": "value_error"}]
+            )
+
+        top_k = data.get("top_k")
+        if top_k is not None and (not isinstance(top_k, int) or top_k <= 0):
+            detail = "top_k must be a positive integer"
+            raise RequestValidationError(
+                [{"loc": ("query", "top_k"), "msg": detail, "type": "value_error"}]
+            )
+        return query, passages, top_k
+
+    @APP.post("/")
+    async def rerank(self, request: Request) -> Response:
+        """Score every passage against the query with a cross-encoder
+
+        The request holds a `query`, its candidate `passages` and optionally
+        `top_k` and `model`. The response holds the raw `scores` in passage
+        order and the `ranking`, `{"index": .., "score": ..}` sorted by
+        descending score and cut to `top_k`.
+        """
+        if not self.ready:
+            return create_error_response(
+                HTTPStatus.SERVICE_UNAVAILABLE, "Rerank deployment is not ready"
+            )
+
+        data: Dict = await request.json()
+        query, passages, top_k = self._validate(data)
+        try:
+            model = self.registry.resolve(data.get("model"))
+        except KeyError:
+            detail = f"Invalid model. Valid models are: {', '.join(self.registry.configs)}"
+            raise RequestValidationError(
+                [{"loc": ("query", "model"), "msg": detail, "type": "value_error"}]
+            )
+
+        scores = await self._batcher(model).submit(
+            [(query, passage) for passage in passages]
+        )
+        order = np.argsort(-np.asarray(scores, dtype=np.float32), kind="stable")
+        ranking = [{"index": int(i), "score": scores[i]} for i in order[:top_k]]
+
+        return JSONResponse(content={"scores": scores, "ranking": ranking})
+
+
+def main(args: Dict[str, str]) -> Application:
+    # load env
+    load_env()
+    ROOT_PATH = os.environ.get("ROOT_PATH", None)
+    CONFIG_FILE = os.path.join(ROOT_PATH, "config.yaml")
+    if os.path.exists(CONFIG_FILE) is None:
+        raise ConfigFileMissingError(
+            "MAIN_CONFIG_FILE_PATH environmental variable is missing."
+        )
+
+    # load main config file
+    yaml_parser = YamlParser(filepath=CONFIG_FILE)
+    CONFIG: DictObjectParser = yaml_parser.get_data()
+
+    # load loggers
+    logger: Logger = load_loggers(CONFIG.loggers, name="ray.serve")
+    config_key: str = args.get("config_key")
+    return RerankDeployment.bind(getattr(CONFIG, config_key, None), logger=logger)
+
+
+if __name__ == "__main__":
+    app = main({"config_key": "rerank"})
+    serve.run(app)
@@ -0,0 +1,99 @@
+"""Tokens/sec of passage embedding with and without length bucketing.
+
+Chunks a course PDF the same way the upload endpoint does (needs `meglib`
+installed from server/lib) and embeds the chunks in arrival order and in
+length sorted order, as done by EMBDeployment.
+
+    python test/emb_bucketing_benchmark.py --pdf course.pdf --end-page 40
+"""
+import random
+import sys
+import time
+from typing import List
+
+import click
+from fastembed import TextEmbedding
+
+sys.path.append(".")
+from ml.emb.batching import length_sorted_order  # noqa: E402
+
+
+def load_chunks(
+    pdf: str, start_page: int, end_page: int, min_size: int, overlap: int
+) -> List[str]:
+    from meglib.ml.loaders import PDFLoader
+    from meglib.ml.preprocessor import DocumentProcessor
+
+    documents = PDFLoader().parse_document(
+        path=pdf, meta_data={"start_page": start_page, "end_page": end_page}
+    )
+    processor = DocumentProcessor()
+    return [
+        doc.page_content
+        for raw_doc in documents
+        for doc in processor.recursive_split_overlap(raw_doc, min_size, overlap)
+    ]
+
+
+def padded_tokens(lengths: List[int], batch_size: int) -> int:
+    return sum(
+        max(lengths[i : i + batch_size]) * len(lengths[i : i + batch_size])
+        for i in range(0, len(lengths), batch_size)
+    )
+
+
+@click.command()
+@click.option("--pdf", required=True, help="Course PDF")
+@click.option("--start-page", default=1, help="First page to parse")
+@click.option("--end-page", default=20, help="Last page to parse")
+@click.option("--model-name", default="BAAI/bge-large-en-v1.5", help="Model")
+@click.option("--batch-size", default=16, help="Texts per onnx call")
+@click.option("--min-size", default=1000, help="Chunk size (doc_processor)")
+@click.option("--overlap", default=500, help="Chunk overlap (doc_processor)")
+@click.option("--repeat", default=3, help="Runs per mode, best one is reported")
+def main(
+    pdf: str,
+    start_page: int,
+    end_page: int,
+    model_name: str,
+    batch_size: int,
+    min_size: int,
+    overlap: int,
+    repeat: int,
+):
+    chunks = load_chunks(pdf, start_page, end_page, min_size, overlap)
+    # uploads arrive in document order, shuffle to mimic merged requests
+    random.Random(0).shuffle(chunks)
+
+    model = TextEmbedding(model_name=model_name)
+    tokenizer = model.model.tokenizer
+    lengths = [sum(enc.attention_mask) for enc in tokenizer.encode_batch(chunks)]
+    total_tokens = sum(lengths)
+    print(f"{len(chunks)} chunks, {total_tokens} tokens")
+
+    # warm up the onnx session
+    list(model.passage_embed(chunks[:batch_size], batch_size=batch_size))
+
+    order = length_sorted_order(lengths)
+    sorted_chunks = [chunks[i] for i in order]
+    sorted_lengths = [lengths[i] for i in order]
+
+    for name, texts, texts_lengths in [
+        ("unsorted", chunks, lengths),
+        ("bucketed", sorted_chunks, sorted_lengths),
+    ]:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(model.passage_embed(texts, batch_size=batch_size))
+            best = min(best, time.perf_counter() - start)
+
+        padded = padded_tokens(texts_lengths, batch_size)
+        print(
+            f"{name:>9}: {total_tokens / best:10.1f} tokens/sec, "
+            f"{best:7.2f} s, padding waste {1 - total_tokens / padded:6.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -47,6 +47,25 @@ def test_embedding_endpoint():
         print(time.time() - start)
 
 
+def test_binary_format():
+    import struct
+
+    for dtype in ["float32", "float16"]:
+        response = requests.post(
+            EMBEDDING_URL,
+            json=test_cases[0],
+            headers={"Accept": f"application/x-embedding; dtype={dtype}"},
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-embedding"
+
+        _, _, rows, dim = struct.unpack_from("<BBII", response.content)
+        embedding = np.frombuffer(
+            response.content, dtype=dtype, offset=struct.calcsize("<BBII")
+        ).reshape(rows, dim)
+        print(dtype, embedding.shape, len(response.content))
+
+
 def test_invalid_request_type():
     response = requests.post(
         EMBEDDING_URL, json={"type": "INVALID_TYPE", "data": "Text"}
@@ -56,4 +75,5 @@ def test_invalid_request_type():
 
 if __name__ == "__main__":
     test_embedding_endpoint()
+    test_binary_format()
     test_invalid_request_type()
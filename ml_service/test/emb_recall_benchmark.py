@@ -0,0 +1,101 @@
+"""recall@k and payload size of the truncated / quantized embedding modes.
+
+Passages and queries are read from text files (one per line). The top-k
+passages of every query under the full float32 vectors are the ground
+truth, each mode is scored by how many of them it retrieves.
+
+    python test/emb_recall_benchmark.py --passages chunks.txt --queries q.txt
+"""
+import struct
+from typing import Dict, List, Optional
+
+import click
+import numpy as np
+import requests
+
+HEADER = struct.Struct("<BBII")
+DTYPES = {0: "<f4", 1: "<f2", 2: "int8", 3: "uint8", 4: "uint8"}
+BINARY_CODE = 4
+
+MODES = [
+    {"dimensions": None, "quantization": None},
+    {"dimensions": 512, "quantization": None},
+    {"dimensions": 256, "quantization": None},
+    {"dimensions": None, "quantization": "int8"},
+    {"dimensions": None, "quantization": "uint8"},
+    {"dimensions": None, "quantization": "binary"},
+    {"dimensions": 512, "quantization": "binary"},
+]
+
+
+def embed(url: str, texts: List[str], embed_type: str, mode: Dict):
+    vectors, size = [], 0
+    for i in range(0, len(texts), 64):
+        response = requests.post(
+            url,
+            json={"type": embed_type, "data": texts[i : i + 64], **mode},
+            headers={"Accept": "application/x-embedding"},
+        )
+        response.raise_for_status()
+        _, code, rows, dim = HEADER.unpack_from(response.content)
+        # binary vectors stay packed, `dim` counts their bits
+        columns = -(-dim // 8) if code == BINARY_CODE else dim
+        vectors.append(
+            np.frombuffer(response.content, dtype=DTYPES[code], offset=HEADER.size)
+            .reshape(rows, columns)
+        )
+        size += len(response.content)
+    return np.concatenate(vectors), size
+
+
+def scores(queries: np.ndarray, passages: np.ndarray, quantization: Optional[str]):
+    if quantization == "binary":
+        # hamming similarity of the packed sign bits
+        bits = np.unpackbits(queries[:, None, :] ^ passages[None, :, :], axis=2)
+        return -bits.sum(axis=2)
+    if quantization == "uint8":
+        return (queries.astype(np.float32) - 127.5) @ (
+            passages.astype(np.float32) - 127.5
+        ).T
+    return queries.astype(np.float32) @ passages.astype(np.float32).T
+
+
+def top_k(similarity: np.ndarray, k: int) -> np.ndarray:
+    return np.argsort(-similarity, axis=1, kind="stable")[:, :k]
+
+
+@click.command()
+@click.option("--url", default="http://localhost:5000/v1/embed", help="Endpoint")
+@click.option("--passages", required=True, help="File with one passage per line")
+@click.option("--queries", required=True, help="File with one query per line")
+@click.option("--k", default=5, help="k of recall@k")
+def main(url: str, passages: str, queries: str, k: int):
+    with open(passages) as file:
+        passage_texts = [line.strip() for line in file if line.strip()]
+    with open(queries) as file:
+        query_texts = [line.strip() for line in file if line.strip()]
+
+    truth = None
+    for mode in MODES:
+        passage_vectors, size = embed(url, passage_texts, "PASSAGE_EMBED", mode)
+        query_vectors, _ = embed(url, query_texts, "QUERY_EMBED", mode)
+        ranking = top_k(
+            scores(query_vectors, passage_vectors, mode["quantization"]), k
+        )
+        if truth is None:
+            truth = ranking
+
+        recall = np.mean(
+            [len(set(r) & set(t)) / k for r, t in zip(ranking, truth)]
+        )
+        print(
+            f"dimensions={str(mode['dimensions']):>5} "
+            f"quantization={str(mode['quantization']):>6}: "
+            f"recall@{k} {recall:.3f}, "
+            f"{passage_vectors.nbytes / len(passage_texts):7.1f} bytes/vector, "
+            f"{size / 1024:9.1f} KiB over the wire"
+        )
+
+
+if __name__ == "__main__":
+    main()
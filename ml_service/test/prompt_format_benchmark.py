@@ -0,0 +1,124 @@
+"""Rendering time of long conversations with the compiled PromptRenderer
+and with the previous per-turn `str.format` implementation.
+
+Both produce the same prompt, which is checked before timing.
+
+    python test/prompt_format_benchmark.py --model nous-capybara-34b --turns 64
+"""
+import copy
+import os
+import random
+import sys
+import time
+from typing import Callable, List
+
+import click
+
+sys.path.append(".")
+from ml.llm.prompt_format import Message, PromptFormat  # noqa: E402
+from utils.base import load_model_config  # noqa: E402
+
+
+def legacy_segments(prompt_format: PromptFormat, messages: List[Message]) -> List[str]:
+    """generate_prompt_segments before the renderer, without the mutation
+    of the shared format (the system prompt is kept in a local)"""
+    messages = list(messages)
+    system = prompt_format.system
+    for i, message in enumerate(messages):
+        if message.role == "system":
+            if prompt_format.accept_sys_from_req:
+                system = message.content
+            messages.pop(i)
+            break
+    messages = [m for m in messages if m.role != "system"]
+    messages.insert(0, Message(role="system", content=system))
+    if len(messages) == 1:
+        raise ValueError("Only System messages are not allowed")
+
+    prompt = []
+    if prompt_format.system_in_user:
+        prompt.append(
+            prompt_format.user.format(
+                system=messages[0].content, instruction=messages[1].content
+            )
+        )
+    else:
+        prompt.append(messages[0].content)
+        prompt.append(prompt_format.user.format(instruction=messages[1].content))
+
+    for message in messages[2:]:
+        content = message.content
+        if prompt_format.strip_whitespace:
+            content = content.strip()
+        if message.role == "user":
+            if prompt_format.system_in_user:
+                prompt.append(prompt_format.user.format(instruction=content, system=""))
+            else:
+                prompt.append(prompt_format.user.format(instruction=content))
+        elif message.role == "assistant":
+            prompt.append(prompt_format.assistant.format(instruction=content))
+    prompt.append(prompt_format.trailing_assistant)
+    return prompt
+
+
+def conversation(rng: random.Random, turns: int, words: int) -> List[Message]:
+    vocabulary = ["merge", "sort", "tree", "{node}", "O(n log n)", "proof", "step"]
+    messages = []
+    for turn in range(turns):
+        role = "user" if turn % 2 == 0 else "assistant"
+        content = " ".join(rng.choice(vocabulary) for _ in range(words))
+        messages.append(Message(role=role, content=f" {content} \n"))
+    return messages
+
+
+def best_of(repeat: int, func: Callable[[], object]) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@click.command()
+@click.option("--model", default="nous-capybara-34b", help="config/model/<model>.yaml")
+@click.option("--conversations", default=256, help="Conversations per run")
+@click.option("--turns", default=64, help="Messages per conversation")
+@click.option("--words", default=60, help="Words per message")
+@click.option("--repeat", default=5, help="Runs per mode, best one is reported")
+def main(model: str, conversations: int, turns: int, words: int, repeat: int):
+    prompt_format = load_model_config(
+        os.path.join("config", "model", f"{model}.yaml")
+    ).prompt_format
+    rng = random.Random(0)
+    batch = [conversation(rng, turns, words) for _ in range(conversations)]
+    renderer = prompt_format.renderer
+
+    for messages in batch:
+        assert "".join(renderer.render_segments(messages)) == "".join(
+            legacy_segments(prompt_format, messages)
+        )
+    snapshot = copy.deepcopy(batch)
+    renderer.render_segments_batch(batch)
+    assert batch == snapshot, "the renderer modified the messages"
+
+    timings = {
+        "str.format": best_of(
+            repeat, lambda: [legacy_segments(prompt_format, m) for m in batch]
+        ),
+        "compiled": best_of(
+            repeat, lambda: [renderer.render_segments(m) for m in batch]
+        ),
+        "batch": best_of(repeat, lambda: renderer.render_segments_batch(batch)),
+    }
+    print(f"{conversations} conversations of {turns} messages ({model})")
+    baseline = timings["str.format"]
+    for name, seconds in timings.items():
+        print(
+            f"{name:>10}: {seconds / conversations * 1e6:8.1f} us/conversation, "
+            f"{baseline / seconds:5.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import requests
+
+RERANK_URL = (
+    "http://localhost:5000/v1/rerank"  # Adjust if your deployment is on a different port
+)
+
+# Test data
+test_case = {
+    "query": "How is the time complexity of merge sort derived?",
+    "passages": [
+        "Merge sort splits the array in halves and merges them in linear time.",
+        "A binary search tree keeps smaller keys in the left subtree.",
+        "The recurrence T(n) = 2T(n/2) + O(n) solves to O(n log n).",
+        "Python lists are dynamic arrays.",
+    ],
+    "top_k": 2,
+}
+
+
+def test_rerank_endpoint():
+    import time
+
+    start = time.time()
+    response = requests.post(RERANK_URL, json=test_case)
+
+    assert response.status_code == 200
+
+    data = response.json()
+    assert len(data["scores"]) == len(test_case["passages"])
+    assert len(data["ranking"]) == test_case["top_k"]
+    print(data["ranking"])
+    print(time.time() - start)
+
+
+def test_invalid_request():
+    response = requests.post(RERANK_URL, json={"query": "", "passages": []})
+    assert response.status_code == 400  # Expect some bad request error
+
+
+if __name__ == "__main__":
+    test_rerank_endpoint()
+    test_invalid_request()
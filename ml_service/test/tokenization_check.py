@@ -0,0 +1,90 @@
+"""Check that the segment token cache of PromptTokenizer is exact for a
+model's prompt format and tokenizer.
+
+Renders random conversations with the prompt format and compares the
+segment by segment token ids with the tokenization of the whole prompt.
+SentencePiece tokenizers (llama, yi, mistral) add a prefix space to every
+encoded text, which the continuation encoding of the segments has to undo.
+Needs `transformers` (and `sentencepiece` for slow tokenizers).
+
+    python test/tokenization_check.py --tokenizer /data/nous-34b --slow
+"""
+import os
+import random
+import sys
+from typing import List
+
+import click
+from transformers import AutoTokenizer
+
+sys.path.append(".")
+from ml.llm.prompt_format import Message  # noqa: E402
+from ml.llm.tokenization import PromptTokenizer  # noqa: E402
+from utils.base import load_model_config  # noqa: E402
+
+# pieces which tend to merge with their neighbours: punctuation, digits,
+# leading spaces and newlines
+VOCABULARY = [
+    "tree",
+    "sorted",
+    "keys",
+    "lookup",
+    "O(n log n)",
+    "42",
+    "merge-sort",
+    "?",
+    ".",
+    ",",
+    "\n",
+    "  indented",
+    "ASSISTANT",
+    "user:",
+    "naïve",
+    "树",
+]
+
+
+def conversation(rng: random.Random) -> List[Message]:
+    messages = []
+    for turn in range(rng.randint(1, 9)):
+        role = "user" if turn % 2 == 0 else "assistant"
+        words = [rng.choice(VOCABULARY) for _ in range(rng.randint(1, 16))]
+        messages.append(Message(role=role, content=" ".join(words)))
+    return messages
+
+
+@click.command()
+@click.option("--tokenizer", default="/data/nous-34b", help="Huggingface tokenizer")
+@click.option("--model", default="nous-capybara-34b", help="config/model/<model>.yaml")
+@click.option("--conversations", default=500, help="Random conversations checked")
+@click.option("--slow", is_flag=True, help="Use the slow (sentencepiece) tokenizer")
+def main(tokenizer: str, model: str, conversations: int, slow: bool):
+    hf_tokenizer = AutoTokenizer.from_pretrained(tokenizer, use_fast=not slow)
+    prompt_format = load_model_config(
+        os.path.join("config", "model", f"{model}.yaml")
+    ).prompt_format
+    prompt_tokenizer = PromptTokenizer(hf_tokenizer)
+
+    messages = [
+        Message(role="user", content="What is a binary search tree?"),
+        Message(role="assistant", content="A tree which keeps its keys sorted."),
+        Message(role="user", content="How fast is a lookup in it?"),
+    ]
+    verified = prompt_tokenizer.verify(prompt_format.generate_prompt_segments(messages))
+    print(f"{type(hf_tokenizer).__name__} with {model}: verify {verified}")
+
+    rng = random.Random(0)
+    mismatches = 0
+    for _ in range(conversations):
+        segments = prompt_format.generate_prompt_segments(conversation(rng))
+        whole = hf_tokenizer.encode("".join(segments))
+        if prompt_tokenizer.encode_sync(segments) != whole:
+            mismatches += 1
+            if mismatches <= 3:
+                print(f"mismatch: {segments!r}")
+    print(f"{mismatches}/{conversations} conversations tokenize differently")
+    sys.exit(1 if not verified or mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,3 +17,11 @@ class MaximumContextLengthError(Exception):
             f"(len of the message is {prompt_len}, completion len {request_max_len}) "
             f"Please reduce the length of the messages or completion."
         )
+
+
+class DeadlineExceededError(Exception):
+    """This Exception is raised when the deadline of a request passed or
+    the time left is too short to do its work"""
+
+    def __init__(self, msg):
+        super().__init__(msg)
@@ -1,7 +1,50 @@
+import time
 from http import HTTPStatus
+from typing import Any, Awaitable, Callable, Optional
 
-from starlette.responses import JSONResponse
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+# seconds the caller still waits for the response, a relative budget so
+# that the clocks of the caller and the replica do not have to agree
+DEADLINE_HEADER = "x-request-timeout"
 
 
 def create_error_response(status_code: HTTPStatus, message: str) -> JSONResponse:
     return JSONResponse(status_code=status_code.value, content={"detail": message})
+
+
+class CleanupStreamingResponse(StreamingResponse):
+    """StreamingResponse which awaits `on_close` once the response is over,
+    whether the body was sent completely, the client disconnected or the
+    request was cancelled"""
+
+    def __init__(
+        self, content: Any, on_close: Callable[[], Awaitable[None]], **kwargs
+    ) -> None:
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
+
+
+def request_deadline(request: Request) -> Optional[float]:
+    """Deadline of the request on the monotonic clock from its budget
+    header, None if the caller did not send a valid one"""
+    try:
+        budget = float(request.headers[DEADLINE_HEADER])
+    except (KeyError, ValueError):
+        return None
+    return time.monotonic() + budget
+
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    """Seconds until the deadline, None if there is no deadline"""
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
@@ -1,5 +1,7 @@
 import asyncio
+import httpx
 import logging
+import time
 
 from django.http import StreamingHttpResponse
 from asgiref.sync import async_to_sync
@@ -12,14 +14,16 @@ from rest_framework.request import Request
 
 from .models import Chat
 from .serializers import ChatSerializer
-from typing import Dict
+from typing import Dict, List
 
 from meglib.ml.store import VectorDB
-from meglib.ml.api import Llm, Embedding
+from meglib.ml.api import Llm, Embedding, Rerank
+from meglib.ml.errors import DeadlineExceededError
 
 logger = logging.getLogger("django")
 llm_api: Llm = settings.LLM_API
 embed_api: Embedding = settings.EMBED_API
+rerank_api: Rerank = settings.RERANK_API
 qdrant_db: VectorDB = settings.QDRANT_DB
 qdrant_config: Dict = settings.QDRANT_CONFIG
 llm_config: Dict = settings.LLM_CONFIG
@@ -73,6 +77,9 @@ class ChatCompletionAPIView(mixins.UpdateModelMixin, generics.GenericAPIView):
     async def post(
         self, request: Request, *args, **kwargs
     ) -> Response | StreamingHttpResponse:
+        # budget of the whole request, what is left of it is sent along with
+        # every call to the ml service
+        deadline = time.monotonic() + llm_config.get("deadline", 120)
         chat = self.get_object()
         payload: Dict = request.data
         messages = request.data["messages"]
@@ -86,69 +93,135 @@ class ChatCompletionAPIView(mixins.UpdateModelMixin, generics.GenericAPIView):
             payload={
                 "data": [embedding_msg],
                 "type": "QUERY_EMBED",
-            }
+                **qdrant_config["main"].get("embed", {}),
+            },
+            timeout=deadline - time.monotonic(),
         )
-        embedding = embedding["embedding"][0]
-        # vector search
+        embedding = embedding["embedding"][0].tolist()
+        # vector search, a wider candidate set is fetched when reranking
+        rerank_config: Dict = qdrant_config["infer"].get("rerank") or {}
+        rerank = rerank_config.get("enabled", False)
         retrieved_content: Dict = qdrant_db.proto_to_dict(
             await qdrant_db.search(
                 collection_name=qdrant_config["main"]["collection_name"],
                 vector=embedding,
-                limit=qdrant_config["infer"]["limit"],
+                limit=(
+                    rerank_config.get("candidates", qdrant_config["infer"]["limit"])
+                    if rerank
+                    else qdrant_config["infer"]["limit"]
+                ),
                 filters={"course_id": str(payload["course_id"])},
             )
         )
 
-        if "result" not in retrieved_content.keys():  # only contains time
-            content = ""
-            pass
-        else:
-            content = ""
-            cont_no = 1
-            # logger.info()
-            for result in retrieved_content["result"]:
-                score = result["score"]
-                if score >= qdrant_config["infer"]["min_score"]:
-                    content += (
-                        f" \n{cont_no}. {result['payload']['content']['stringValue']}"
-                    )
-                    cont_no += 1
-
-            if len(content) >= 1:
-                messages[-1]["content"] = (
-                    "Related Content: " + content + "\n" + messages[-1]["content"]
-                )
+        # retrieved chunks are rendered into the last message by the llm
+        # deployment, which drops the least relevant ones first if the
+        # prompt does not fit the context window
+        context: List[str] = []
+        if "result" in retrieved_content.keys():  # otherwise only contains time
+            results = [
+                result
+                for result in retrieved_content["result"]
+                if result["score"] >= qdrant_config["infer"]["min_score"]
+            ]
+            if rerank and results:
+                results = await self._rerank(messages[-1]["content"], results)
+            context = [
+                result["payload"]["content"]["stringValue"] for result in results
+            ]
 
-        
         # llm generation
         payload = {
             "messages": messages,
+            "context": context,
             "stream": payload.get("stream", True),
             "max_tokens": llm_config.get("max_tokens", 1024),
             "temperature": llm_config.get("temperature", 0.7),
+            "priority": llm_config.get("priority", "interactive"),
+            "user": str(chat.user_id),
         }
         logger.info(payload)
 
         if payload.get("stream", True):
             llm_response = self._consume_and_append(
-                llm_response=llm_api.query(payload=payload),
+                llm_response=llm_api.query(
+                    payload=payload,
+                    session_id=str(chat.chat_id),
+                    timeout=deadline - time.monotonic(),
+                ),
                 chat=chat,
                 messages=messages,
             )
             return StreamingHttpResponse(llm_response)
 
         else:
-            llm_response = await llm_api.query_no_stream(payload=payload)
+            llm_response = await llm_api.query_no_stream(
+                payload=payload,
+                session_id=str(chat.chat_id),
+                timeout=deadline - time.monotonic(),
+            )
             message = {"role": "assistant", "content": llm_response['output']}
             messages.append(message)
             asyncio.create_task(chat.update_messages(messages))
             return Response(data={"messages": llm_response})
 
+    async def _rerank(self, query: str, results: List[Dict]) -> List[Dict]:
+        """Keep the `limit` best vector search results by cross-encoder score,
+        falls back to the vector search order if the rerank service fails"""
+        rerank_config: Dict = qdrant_config["infer"]["rerank"]
+        try:
+            reranked: Dict = await rerank_api.query(
+                payload={
+                    "query": query,
+                    "passages": [
+                        result["payload"]["content"]["stringValue"]
+                        for result in results
+                    ],
+                    "top_k": qdrant_config["infer"]["limit"],
+                }
+            )
+        except httpx.HTTPError:
+            logger.warning("Rerank failed, using the vector search order")
+            return results[: qdrant_config["infer"]["limit"]]
+
+        min_score = rerank_config.get("min_score")
+        return [
+            results[ranked["index"]]
+            for ranked in reranked["ranking"]
+            if min_score is None or ranked["score"] >= min_score
+        ]
+
     async def _consume_and_append(self, llm_response, chat, messages):
         content = ""
-        async for data in llm_response:
-            content += data
-            yield data
+        completed = False
+        try:
+            async for data in llm_response:
+                content += data
+                yield data
+            completed = True
+            logger.info(
+                f"Chat {chat.chat_id} finished with {llm_response.finish_reason}: "
+                f"{llm_response.prompt_tokens} prompt tokens, "
+                f"{llm_response.output_tokens} output tokens, "
+                f"truncation {llm_response.truncation}"
+            )
+        except DeadlineExceededError as e:
+            # the answer was cut off, it is not kept in the chat history
+            logger.warning(
+                f"Chat {chat.chat_id} answer discarded after {len(content)} "
+                f"characters: {e}"
+            )
+            return
+        finally:
+            if not completed:
+                # the client went away (django cancels or closes the stream),
+                # closing the upstream stream drops the connection to the llm
+                # deployment, which aborts the generation
+                await llm_response.aclose()
+                logger.info(
+                    f"Chat {chat.chat_id} stream closed, generation stopped "
+                    f"after {len(content)} characters"
+                )
 
         message = {"role": "assistant", "content": content}
         messages.append(message)
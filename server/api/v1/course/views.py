@@ -113,11 +113,6 @@ class CourseDocumentUploadAPIView(
     # StaffEditorPermissionMixin,
     generics.GenericAPIView,
 ):
-    def _get_batches(self, lst, n):
-        """Yield successive n-sized chunks from lst."""
-        for i in range(0, len(lst), n):
-            yield lst[i : i + n]
-
     async def _process_file(self, file_path: str, meta_data: Dict, course_id):
         documents = pdf_loader.parse_document(path=file_path, meta_data=meta_data)
         proc_docs = []
@@ -131,42 +126,41 @@ class CourseDocumentUploadAPIView(
                 proc_docs.append(doc.page_content)
                 meta_data.append(doc.metadata)
 
-        vector_batch = []
-        coroutines_lst = []
-        for batch in self._get_batches(
-            proc_docs, doc_proc_config["embed_max_batch_size"]
+        # vectors are upserted sub-batch by sub-batch while the rest of the
+        # document is still being embedded
+        num_vectors = 0
+        async for start, vectors in embed_api.query_stream(
+            payload={
+                "type": "PASSAGE_EMBED",
+                "data": proc_docs,
+                "stream_batch_size": doc_proc_config["embed_max_batch_size"],
+                **qdrant_config["main"].get("embed", {}),
+            }
         ):
-            logger.info(len(batch))
-            coroutines_lst.append(
-                embed_api.query(
-                    payload={"type": "PASSAGE_EMBED", "data": batch}
-                )
+            logger.info(len(vectors))
+            end = start + len(vectors)
+            await qdrant_db.insert(
+                collection_name=qdrant_config["main"]["collection_name"],
+                data=[
+                    {
+                        "vector": vector,
+                        "payload": {
+                            "content": page_content,
+                            "course_id": str(course_id),
+                            "metadata": metadata,
+                        },
+                    }
+                    for page_content, vector, metadata in zip(
+                        proc_docs[start:end], vectors.tolist(), meta_data[start:end]
+                    )
+                ],
+                wait=False,
             )
+            num_vectors += len(vectors)
 
-        for coroutine in coroutines_lst:
-            res = await coroutine
-            vector_batch.extend(res["embedding"])
-
-        await qdrant_db.insert(
-            collection_name=qdrant_config["main"]["collection_name"],
-            data=[
-                {
-                    "vector": vector,
-                    "payload": {
-                        "content": page_content,
-                        "course_id": str(course_id),
-                        "metadata": metadata,
-                    },
-                }
-                for page_content, vector, metadata in zip(
-                    proc_docs, vector_batch, meta_data
-                )
-            ],
-            wait=False,
-        )
         os.remove(file_path)
 
-        return len(vector_batch)
+        return num_vectors
 
     @async_to_sync
     async def post(self, request: Request, *args, **kwargs) -> Response:
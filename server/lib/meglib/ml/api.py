@@ -1,20 +1,41 @@
+import io
 import json
 import asyncio
+import struct
+import time
 import httpx
 import sys
+import numpy as np
 
-from typing import Dict, AsyncGenerator
+from typing import Dict, AsyncGenerator, Optional, Tuple
 from abc import ABC, abstractmethod
 
-__all__ = ["API", "Llm", "Embedding"]
+from meglib.ml.errors import DeadlineExceededError
+
+__all__ = ["API", "Llm", "LlmStream", "Embedding", "Rerank"]
 
 
 class API(ABC):
     """BaseClass, This class can be inherited to communicated with Ray Deployments"""
 
+    # seconds the caller still waits for the response, the deployments refuse
+    # work which can not finish in time and abort it once the budget is used up
+    DEADLINE_HEADER = "X-Request-Timeout"
+    DEFAULT_TIMEOUT = 30
+
     def __init__(self, host: str, port: int, endpoint: str):
         self.endpoint_url = f"http://{host}:{port}{endpoint}"
 
+    def _with_deadline(self, headers: Dict, timeout: Optional[float]) -> Dict:
+        """Add the remaining budget of the request to the headers"""
+        if timeout is not None:
+            headers[self.DEADLINE_HEADER] = f"{max(timeout, 0):.3f}"
+        return headers
+
+    def _timeout(self, timeout: Optional[float]) -> float:
+        """httpx timeout of a request with the remaining budget"""
+        return self.DEFAULT_TIMEOUT if timeout is None else max(timeout, 0.001)
+
     @abstractmethod
     async def query(self, payload) -> Dict:
         """Abstract method to query the API."""
@@ -31,51 +52,137 @@ class API(ABC):
             response = await client.get(url=self.endpoint_url + "/health")
             return response.status_code
 
+    async def check_ready(self) -> bool:
+        """Checks whether the deployment finished its warm-up by sending a GET request to the "/ready" endpoint.
+        Returns
+        -------
+        bool
+            True if the deployment is warm and ready to serve traffic.
+        """
+        async with httpx.AsyncClient() as client:
+            response = await client.get(url=self.endpoint_url + "/ready")
+            return response.status_code == 200
+
+
+class LlmStream:
+    """Text deltas of a streamed completion, the token usage and the finish reason are
+    set once the stream ended. A stream which the deployment cut off at its deadline
+    raises DeadlineExceededError instead of ending, its text is incomplete"""
+
+    # finish reason of the last frame of a stream stopped at its deadline
+    DEADLINE_FINISH_REASON = "deadline"
+
+    def __init__(self, frames: AsyncGenerator[Dict, None]):
+        self._frames = frames
+        self.prompt_tokens: Optional[int] = None
+        self.output_tokens: Optional[int] = None
+        self.finish_reason: Optional[str] = None
+        self.truncation: Optional[Dict] = None
+
+    def __aiter__(self) -> "LlmStream":
+        return self
+
+    async def __anext__(self) -> str:
+        while True:
+            frame = await self._frames.__anext__()
+            if "finish_reason" in frame:
+                self.finish_reason = frame["finish_reason"]
+                self.prompt_tokens = frame["prompt_tokens"]
+                self.truncation = frame.get("truncation") or self.truncation
+                if "output" in frame:
+                    # full frames count the tokens of every flush
+                    self.output_tokens = (self.output_tokens or 0) + frame["output_tokens"]
+                else:
+                    self.output_tokens = frame["output_tokens"]
+                if self.finish_reason == self.DEADLINE_FINISH_REASON:
+                    raise DeadlineExceededError(
+                        f"The deadline passed after {self.output_tokens} tokens"
+                    )
+            if frame.get("output"):
+                return frame["output"]
+
+    async def aclose(self) -> None:
+        await self._frames.aclose()
+
 
 class Llm(API):
-    async def query(self, payload) -> AsyncGenerator:
+    # ray serve routes requests with the same multiplexed model id to the
+    # same replica, the llm deployment uses it as the chat session key
+    SESSION_HEADER = "serve_multiplexed_model_id"
+
+    def _headers(self, session_id: Optional[str], timeout: Optional[float] = None) -> Dict:
+        headers = {"Content-Type": "application/json"}
+        if session_id:
+            headers[self.SESSION_HEADER] = session_id
+        return self._with_deadline(headers, timeout)
+
+    def query(
+        self, payload, session_id: Optional[str] = None, timeout: Optional[float] = None
+    ) -> LlmStream:
         """This method streams results from a POST request to the endpoint.
 
         Parameters
         ----------
         payload : dict
             The payload for the query. It should contain the necessary information for the request.
+            The compact `delta` stream format is requested unless it sets `stream_format`.
+        session_id : Optional[str], optional
+            session key (e.g. the chat_id), every turn of a session is routed to
+            the same replica so that its prompt prefix is served from the KV cache
+        timeout : Optional[float], optional
+            remaining budget of the caller in seconds, the generation is refused or
+            stopped once it is used up, by default none (30s per read)
 
-        Yields
-        ------
-        str
-            The output from the response, parsed from a JSON to `output` string.
+        Returns
+        -------
+        LlmStream
+            Yields the `output` text deltas, `prompt_tokens`, `output_tokens`, `finish_reason`
+            and `truncation` are set once the stream ended.
 
         Raises
         ------
         HTTPStatusError
             If the response status code is not 200, an exception is raised.
+        DeadlineExceededError
+            While iterating, if the generation was stopped at the deadline.
         """
-        headers = {"Content-Type": "application/json"}
+        return LlmStream(
+            self._query_frames({"stream_format": "delta", **payload}, session_id, timeout)
+        )
+
+    async def _query_frames(
+        self, payload, session_id: Optional[str], timeout: Optional[float]
+    ) -> AsyncGenerator[Dict, None]:
+        headers = self._headers(session_id, timeout)
         async with httpx.AsyncClient() as client:
             async with client.stream(
                 method="POST",
                 url=self.endpoint_url,
                 json=payload,
                 headers=headers,
-                timeout=30,
+                timeout=self._timeout(timeout),
                 follow_redirects=True,
             ) as response:
                 if response.status_code == 200:
                     async for line in response.aiter_lines():
-                        line_dict = json.loads(line)
-                        res = line_dict["output"]
-                        yield res
+                        if line:
+                            yield json.loads(line)
                 else:
                     response.raise_for_status()
 
-    async def query_no_stream(self, payload) -> Dict:
+    async def query_no_stream(
+        self, payload, session_id: Optional[str] = None, timeout: Optional[float] = None
+    ) -> Dict:
         """This method returns a single result from a POST request to the endpoint.
 
         Parameters
         ----------
         payload : dict
             The payload for the query. It should contain the necessary information for the request.
+        session_id : Optional[str], optional
+            session key (e.g. the chat_id) used to route the request, see `query`
+        timeout : Optional[float], optional
+            remaining budget of the caller in seconds, see `query`
 
         Returns
         -------
@@ -87,33 +194,323 @@ class Llm(API):
         HTTPStatusError
             If the response status code is not 200, an exception is raised.
         """
-        headers = {"Content-Type": "application/json"}
+        headers = self._headers(session_id, timeout)
         async with httpx.AsyncClient() as client:
             response = await client.post(
                 self.endpoint_url,
                 json=payload,
                 headers=headers,
-                timeout=30,
+                timeout=self._timeout(timeout),
                 follow_redirects=True,
             )
             response.raise_for_status()
             result = response.json()
             return result
 
+    async def query_batch(self, items) -> AsyncGenerator[Dict, None]:
+        """This method runs a batch of completions for offline jobs.
+
+        Parameters
+        ----------
+        items : list
+            Payloads of the completions (prompt or messages and their sampling parameters).
+
+        Yields
+        ------
+        dict
+            The result of every item as soon as it completed, {index, output, ..}, failed
+            items carry an `error`. The last result is the `summary` of the batch.
+
+        Raises
+        ------
+        HTTPStatusError
+            If the response status code is not 200, an exception is raised.
+        """
+        headers = {"Content-Type": "application/json"}
+        async with httpx.AsyncClient() as client:
+            async with client.stream(
+                method="POST",
+                url=self.endpoint_url + "/batch",
+                json={"items": items},
+                headers=headers,
+                # items may run for minutes before the first one completes
+                timeout=httpx.Timeout(30, read=None),
+                follow_redirects=True,
+            ) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if line:
+                        yield json.loads(line)
+
 
 class Embedding(API):
-    async def query(self, payload) -> Dict:
+    # wire formats understood by the embedding deployment, json is always
+    # accepted as a fallback for servers without binary support
+    ACCEPT_HEADERS = {
+        "json": "application/json",
+        "float32": "application/x-embedding; dtype=float32, application/json; q=0.1",
+        "float16": "application/x-embedding; dtype=float16, application/json; q=0.1",
+        "npy": "application/x-npy, application/json; q=0.1",
+    }
+    _HEADER = struct.Struct("<BBII")
+    _FRAME_HEADER = struct.Struct("<II")
+    _DTYPES = {
+        0: np.dtype("<f4"),
+        1: np.dtype("<f2"),
+        2: np.dtype("int8"),
+        3: np.dtype("uint8"),
+        # sign bits, packed 8 per byte
+        4: np.dtype("uint8"),
+    }
+    _BINARY_CODE = 4
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        endpoint: str,
+        response_format: str = "json",
+        max_retries: int = 5,
+    ):
+        """Embedding API
+
+        Parameters
+        ----------
+        host : str
+            host of the ml service
+        port : int
+            port of the ml service
+        endpoint : str
+            route prefix of the embedding deployment
+        response_format : str, optional
+            default wire format, any one of ['json', 'float32', 'float16', 'npy'],
+            by default "json"
+        max_retries : int, optional
+            retries of a request shed by the overloaded deployment (429), the
+            client waits for the `Retry-After` of the response, by default 5
+        """
+        super().__init__(host=host, port=port, endpoint=endpoint)
+        if response_format not in self.ACCEPT_HEADERS:
+            raise ValueError(f"Unsupported response format: {response_format}")
+        self.response_format = response_format
+        self.max_retries = max_retries
+
+    def _retry_after(self, response: httpx.Response, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying a shed request, None if the
+        response is not retried"""
+        if response.status_code != 429 or attempt >= self.max_retries:
+            return None
+        try:
+            return float(response.headers["retry-after"])
+        except (KeyError, ValueError):
+            return min(2**attempt, 30)
+
+    def _decode(self, response: httpx.Response, response_format: str) -> Dict:
+        """Decode the response body based on its content type, binary formats
+        are returned as a matrix of shape (rows, dim) even when the server
+        fell back to json. Float vectors are returned as float32, quantized
+        vectors (int8, uint8) keep their integer dtype and binary vectors are
+        unpacked into a bool matrix of their signs (packed bytes in json and
+        npy bodies)"""
+        content_type = response.headers.get("content-type", "").split(";")[0]
+
+        if content_type == "application/x-embedding":
+            return {"embedding": self._decode_body(response.content)}
+
+        if content_type == "application/x-npy":
+            matrix = np.load(io.BytesIO(response.content), allow_pickle=False)
+            return {"embedding": self._as_output(matrix)}
+
+        result = response.json()
+        if response_format != "json":
+            result["embedding"] = self._from_json(result["embedding"])
+        return result
+
+    def _from_json(self, embedding):
+        """json embeddings as a matrix, sparse embeddings ({indices, values}
+        per text) are returned unchanged"""
+        if embedding and isinstance(embedding[0], dict):
+            return embedding
+        return self._as_output(np.asarray(embedding))
+
+    def _decode_body(self, body: bytes) -> np.ndarray:
+        _, dtype_code, rows, dim = self._HEADER.unpack_from(body)
+        columns = -(-dim // 8) if dtype_code == self._BINARY_CODE else dim
+        matrix = np.frombuffer(
+            body,
+            dtype=self._DTYPES[dtype_code],
+            count=rows * columns,
+            offset=self._HEADER.size,
+        ).reshape(rows, columns)
+        if dtype_code == self._BINARY_CODE:
+            return np.unpackbits(matrix, axis=1, count=dim).astype(bool)
+        return self._as_output(matrix)
+
+    def _as_output(self, matrix: np.ndarray) -> np.ndarray:
+        if matrix.dtype.kind == "f":
+            return matrix.astype(np.float32)
+        return matrix
+
+    async def query(
+        self,
+        payload,
+        response_format: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Dict:
         """This method returns a single result from a POST request to the endpoint.
 
         Parameters
         ----------
         payload : dict
             The payload for the query. It should contain the necessary information for the request.
+            Optional `dimensions` and `quantization` (int8, uint8, binary) keys shrink the vectors.
+        response_format : Optional[str], optional
+            wire format for this request, by default the one given at construction
+        timeout : Optional[float], optional
+            remaining budget of the caller in seconds, the deployment refuses texts it can not
+            embed in time and shed requests are not retried past it, by default none (30s)
 
         Returns
         -------
         dict
-            The result from the response, parsed from a JSON string to a dictionary.
+            The result from the response, `embedding` is a list of lists for json
+            responses and a numpy matrix for binary responses. Sparse models
+            (selected with the `model` key) return a list of {indices, values}.
+
+        Raises
+        ------
+        HTTPStatusError
+            If the response status code is not 200, an exception is raised.
+        """
+        response_format = response_format or self.response_format
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": self.ACCEPT_HEADERS[response_format],
+        }
+        deadline = None if timeout is None else time.monotonic() + timeout
+        async with httpx.AsyncClient() as client:
+            attempt = 0
+            while True:
+                left = None if deadline is None else deadline - time.monotonic()
+                response = await client.post(
+                    url=self.endpoint_url,
+                    json=payload,
+                    headers=self._with_deadline(dict(headers), left),
+                    timeout=self._timeout(left),
+                    follow_redirects=True,
+                )
+                delay = self._retry_after(response, attempt)
+                if delay is None or (
+                    deadline is not None and time.monotonic() + delay >= deadline
+                ):
+                    break
+                attempt += 1
+                await asyncio.sleep(delay)
+            response.raise_for_status()
+
+            embeddings = self._decode(response, response_format)
+            return embeddings
+
+    async def query_stream(
+        self, payload, response_format: Optional[str] = None
+    ) -> AsyncGenerator[Tuple[int, np.ndarray], None]:
+        """This method streams the embeddings of a large batch, sub-batch by sub-batch.
+
+        Parameters
+        ----------
+        payload : dict
+            The payload for the query, `stream` is set by this method and
+            `stream_batch_size` optionally sets the number of texts per sub-batch.
+        response_format : Optional[str], optional
+            wire format for this request, by default the one given at construction
+
+        Yields
+        ------
+        Tuple[int, np.ndarray]
+            index of the first text of the sub-batch and its embedding matrix,
+            for the json format the matrix is a list of lists
+
+        Raises
+        ------
+        HTTPStatusError
+            If the response status code is not 200, an exception is raised.
+        """
+        response_format = response_format or self.response_format
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": self.ACCEPT_HEADERS[response_format],
+        }
+        async with httpx.AsyncClient() as client:
+            attempt = 0
+            while True:
+                async with client.stream(
+                    method="POST",
+                    url=self.endpoint_url,
+                    json={**payload, "stream": True},
+                    headers=headers,
+                    timeout=30,
+                    follow_redirects=True,
+                ) as response:
+                    if response.status_code != 200:
+                        await response.aread()
+                        delay = self._retry_after(response, attempt)
+                        if delay is None:
+                            response.raise_for_status()
+                    else:
+                        async for frame in self._iter_frames(response, response_format):
+                            yield frame
+                        return
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _iter_frames(
+        self, response: httpx.Response, response_format: str
+    ) -> AsyncGenerator[Tuple[int, np.ndarray], None]:
+        """Parse the sub-batches of a streamed response, NDJSON lines or
+        length-prefixed binary frames"""
+        content_type = response.headers.get("content-type", "").split(";")[0]
+        if content_type != "application/x-embedding-stream":
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                frame = json.loads(line)
+                embedding = frame["embedding"]
+                if response_format != "json":
+                    embedding = self._from_json(embedding)
+                yield frame["index"], embedding
+            return
+
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes():
+            buffer.extend(chunk)
+            while len(buffer) >= self._FRAME_HEADER.size:
+                length, start = self._FRAME_HEADER.unpack_from(buffer)
+                end = self._FRAME_HEADER.size + length
+                if len(buffer) < end:
+                    break
+                yield start, self._decode_body(
+                    bytes(buffer[self._FRAME_HEADER.size : end])
+                )
+                del buffer[:end]
+
+
+class Rerank(API):
+    async def query(self, payload) -> Dict:
+        """This method scores passages against a query with a cross-encoder.
+
+        Parameters
+        ----------
+        payload : dict
+            The payload for the query, `query` and its candidate `passages`,
+            optionally `top_k` and `model`.
+
+        Returns
+        -------
+        dict
+            `scores` of the passages in the order they were sent and the
+            `ranking`, a list of {index, score} sorted by descending score.
 
         Raises
         ------
@@ -130,9 +527,7 @@ class Embedding(API):
                 follow_redirects=True,
             )
             response.raise_for_status()
-
-            embeddings = response.json()
-            return embeddings
+            return response.json()
 
 
 async def _test_workflow(llm: Llm, emb: Embedding):
@@ -1,4 +1,4 @@
-__all__ = ["PDFError", "APIError"]
+__all__ = ["PDFError", "APIError", "DeadlineExceededError"]
 
 
 class PDFError(Exception):
@@ -19,3 +19,11 @@ class APIError(Exception):
 
     def __str__(self) -> str:
         return f"APIError: {self.message}"
+
+
+class DeadlineExceededError(APIError):
+    """Raised when a deployment stopped the request at its deadline, the output
+    received so far is incomplete"""
+
+    def __str__(self) -> str:
+        return f"DeadlineExceededError: {self.message}"
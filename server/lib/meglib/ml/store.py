@@ -32,6 +32,32 @@ class VectorDB:
         elif metric == "manhattan":
             return grpc.Distance.Manhattan
 
+    def _get_datatype(self, datatype: str) -> Any:
+        """Vector datatype, any one of ['float32', 'float16', 'uint8']"""
+        datatypes = getattr(grpc, "Datatype", None)
+        if datatypes is None:
+            raise ValueError(
+                f"Vector datatype '{datatype}' requires a newer qdrant-client"
+            )
+        if datatype == "float32":
+            return datatypes.Float32
+        elif datatype == "float16":
+            return datatypes.Float16
+        elif datatype == "uint8":
+            return datatypes.Uint8
+        raise ValueError(f"Unsupported vector datatype: {datatype}")
+
+    def _get_quantization_config(self, quantization_type: str, config: Dict) -> Any:
+        if quantization_type == "scalar":
+            return grpc.QuantizationConfig(
+                scalar=grpc.ScalarQuantization(
+                    type=grpc.QuantizationType.Int8, **config
+                )
+            )
+        elif quantization_type == "binary":
+            return grpc.QuantizationConfig(binary=grpc.BinaryQuantization(**config))
+        raise ValueError(f"Unsupported quantization type: {quantization_type}")
+
     def _generate_uuid(self):
         """generates uuid4"""
         return str(uuid.uuid4())
@@ -105,6 +131,9 @@ class VectorDB:
         timeout: Optional[int] = 10,
         quantization_config: Optional[Dict] = None,
         hnsw_config: Optional[Dict] = None,
+        datatype: Optional[str] = None,
+        quantization_type: str = "scalar",
+        sparse_vector_name: Optional[str] = None,
     ):
         """Create collection specified by name
 
@@ -122,6 +151,15 @@ class VectorDB:
             config dict of quantization, by default None
         hnsw_config : Optional[Dict], optional
             config dict of hnsw, by default None
+        datatype : Optional[str], optional
+            storage datatype of the vectors, any one of ['float32', 'float16', 'uint8'],
+            should match the `quantization` requested from the embedding service
+            (uint8 for uint8 vectors), by default None (float32)
+        quantization_type : str, optional
+            index quantization, any one of ['scalar', 'binary'], by default "scalar"
+        sparse_vector_name : Optional[str], optional
+            adds a sparse named vector next to the dense one, for hybrid search
+            with the sparse models of the embedding service, by default None
 
         Returns
         -------
@@ -129,24 +167,31 @@ class VectorDB:
             response of create query
         """
         # quadrant collection : env variable
+        vector_params = {
+            "size": dim,
+            "distance": self._get_distance_metric(distance),
+        }
+        if datatype:
+            vector_params["datatype"] = self._get_datatype(datatype)
+
         params = {
             "collection_name": collection_name,
             "vectors_config": grpc.VectorsConfig(
-                params=grpc.VectorParams(
-                    size=dim,
-                    distance=self._get_distance_metric(distance),
-                )
+                params=grpc.VectorParams(**vector_params)
             ),
             "timeout": timeout,
         }
 
-        if quantization_config:
+        if sparse_vector_name:
+            params["sparse_vectors_config"] = grpc.SparseVectorConfig(
+                map={sparse_vector_name: grpc.SparseVectorParams()}
+            )
+
+        if quantization_config is not None:
             params.update(
                 {
-                    "quantization_config": grpc.QuantizationConfig(
-                        scalar=grpc.ScalarQuantization(
-                            type=grpc.QuantizationType.Int8, **quantization_config
-                        )
+                    "quantization_config": self._get_quantization_config(
+                        quantization_type, quantization_config
                     )
                 }
             )
@@ -182,7 +227,32 @@ class VectorDB:
 
         return response
 
-    async def insert(self, collection_name: str, data: List[Dict], wait: bool = False):
+    def _get_vectors(self, data_point: Dict, sparse_vector_name: Optional[str]) -> Any:
+        """dense vector of the point, plus the sparse named vector if given"""
+        dense = grpc.Vector(data=data_point["vector"])
+        sparse = data_point.get("sparse_vector")
+        if not sparse_vector_name or sparse is None:
+            return grpc.Vectors(vector=dense)
+
+        return grpc.Vectors(
+            vectors=grpc.NamedVectors(
+                vectors={
+                    "": dense,
+                    sparse_vector_name: grpc.Vector(
+                        data=sparse["values"],
+                        indices=grpc.SparseIndices(data=sparse["indices"]),
+                    ),
+                }
+            )
+        )
+
+    async def insert(
+        self,
+        collection_name: str,
+        data: List[Dict],
+        wait: bool = False,
+        sparse_vector_name: Optional[str] = None,
+    ):
         """Insert List of points to the collection
 
         Parameters
@@ -195,11 +265,15 @@ class VectorDB:
                 Dict{
                     "vector": List
                     "payload": Dict
+                    "sparse_vector": Optional[Dict{"indices": List, "values": List}]
                 }
             ]
         wait : bool, optional
             should the query wait until changes have been applied,
             by default False
+        sparse_vector_name : Optional[str], optional
+            name of the sparse vector of the collection, `sparse_vector` of the
+            data points is ignored if None, by default None
 
         Returns
         -------
@@ -217,7 +291,7 @@ class VectorDB:
                 grpc.PointStruct(
                     id=grpc.PointId(uuid=self._generate_uuid()),
                     payload=payload,
-                    vectors=grpc.Vectors(vector=grpc.Vector(data=data_point["vector"])),
+                    vectors=self._get_vectors(data_point, sparse_vector_name),
                 )
             )
 
@@ -6,7 +6,7 @@ from pathlib import Path
 from utils import base
 from django.core.files.storage import FileSystemStorage
 
-from meglib.ml.api import Llm, Embedding
+from meglib.ml.api import Llm, Embedding, Rerank
 from meglib.ml.store import VectorDB
 from meglib.ml.preprocessor import DocumentProcessor
 from meglib.ml.loaders import PDFLoader
@@ -208,6 +208,13 @@ EMBED_API = Embedding(
     host=os.environ.get("ML_SERVICE_HOST"),
     port=os.environ.get("ML_SERVICE_PORT"),
     endpoint=os.environ.get("EMBEDDING_ENDPOINT"),
+    response_format="float32",
+)
+
+RERANK_API = Rerank(
+    host=os.environ.get("ML_SERVICE_HOST"),
+    port=os.environ.get("ML_SERVICE_PORT"),
+    endpoint=os.environ.get("RERANK_ENDPOINT"),
 )
 
 QDRANT_CONFIG = CONFIG["store"]
@@ -29,11 +29,15 @@ async def create_main_qdrant_collection():
     if not await qdrant_db.verify(
         collection_name=qdrant_config["main"]["collection_name"]
     ):
+        main_config = qdrant_config["main"]
         return await qdrant_db.create(
-            collection_name=qdrant_config["main"]["collection_name"],
-            dim=1024,
-            distance="cosine",
+            collection_name=main_config["collection_name"],
+            dim=main_config["dim"],
+            distance=main_config["distance"],
             timeout=5,
+            datatype=main_config.get("datatype"),
+            quantization_type=main_config.get("quantization_type") or "scalar",
+            quantization_config=main_config.get("quantization_config"),
         )
     if os.environ.get("DEBUG"):
         await qdrant_db.insert(